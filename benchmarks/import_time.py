@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Measures how long a fresh interpreter takes to import bzz (and its hives).
+
+Usage::
+
+    $ python -m benchmarks.import_time [runs]
+'''
+
+from __future__ import print_function
+
+import sys
+import time
+import subprocess
+
+
+STATEMENTS = (
+    ('python', 'pass'),
+    ('import bzz', 'import bzz'),
+    ('bzz.ModelHive', 'import bzz; bzz.ModelHive'),
+    ('bzz.AuthHive', 'import bzz; bzz.AuthHive'),
+    ('all hives', 'import bzz; bzz.ModelHive; bzz.AuthHive; bzz.MockHive'),
+)
+
+
+def measure(statement, runs):
+    timings = []
+    for run in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(runs=10):
+    print('%-16s %10s' % ('import', 'best (ms)'))
+    for name, statement in STATEMENTS:
+        print('%-16s %10.1f' % (name, measure(statement, runs) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
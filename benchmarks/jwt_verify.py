@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Compares the cost of verifying a bzz auth token with each supported algorithm.
+
+Usage::
+
+    $ python -m benchmarks.jwt_verify [iterations]
+'''
+
+from __future__ import print_function
+
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import jwt.algorithms
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+import bzz.utils as utils
+
+
+def to_pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+
+def get_tokenizers():
+    backend = default_backend()
+    yield 'HS512', utils.Jwt('SECRET')
+
+    rsa_pem = to_pem(rsa.generate_private_key(65537, 2048, backend))
+    yield 'RS256', utils.KeySetJwt([utils.JwtKey('rs', 'RS256', private_key=rsa_pem)])
+
+    ec_pem = to_pem(ec.generate_private_key(ec.SECP256R1(), backend))
+    yield 'ES256', utils.KeySetJwt([utils.JwtKey('es', 'ES256', private_key=ec_pem)])
+
+    if 'EdDSA' in jwt.algorithms.get_default_algorithms():
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        ed_pem = to_pem(ed25519.Ed25519PrivateKey.generate())
+        yield 'EdDSA', utils.KeySetJwt([utils.JwtKey('ed', 'EdDSA', private_key=ed_pem)])
+
+
+def main(iterations=5000):
+    payload = dict(
+        sub='user@email.com', iss='google', token='1234567890abcdef',
+        data={'id': 'user@email.com', 'name': 'Some User', 'provider': 'google'},
+        iat=datetime.utcnow(), exp=datetime.utcnow() + timedelta(seconds=1200)
+    )
+
+    print('%-8s %14s %14s' % ('algo', 'sign (us/op)', 'verify (us/op)'))
+    for algo, tokenizer in get_tokenizers():
+        token = tokenizer.encode(payload)
+        sign = timeit.timeit(lambda: tokenizer.encode(payload), number=iterations)
+        verify = timeit.timeit(lambda: tokenizer.decode(token), number=iterations)
+        print('%-8s %14.1f %14.1f' % (
+            algo, sign * 1e6 / iterations, verify * 1e6 / iterations
+        ))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Compares bzz.utils.parse_form with the request body parsing ModelProvider did
+before it (splitting on `&` and `=` for every call) on large forms.
+
+Usage::
+
+    $ python -m benchmarks.request_parser [iterations]
+'''
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+from six.moves.urllib.parse import unquote
+
+import bzz.utils as utils
+
+
+def legacy_parse(body):
+    data = {}
+    for item in body.decode('utf-8').split('&'):
+        if '=' in item:
+            key, value = item.split('=')
+        else:
+            key, value = 'item', item
+
+        if key in data:
+            if not isinstance(data[key], (tuple, list)):
+                old = data[key]
+                data[key] = []
+                data[key].append(old)
+            data[key].append(unquote(value))
+        else:
+            if '[]' in key:
+                data[key] = [unquote(value)]
+            else:
+                data[key] = unquote(value)
+    return data
+
+
+def get_body(fields):
+    items = []
+    for index in range(fields):
+        items.append('field_%d=some%%20value%%20%d' % (index, index))
+        items.append('members[]=user-%d' % index)
+    return '&'.join(items).encode('utf-8')
+
+
+def main(iterations=200):
+    # ModelProvider parsed the body up to 3 times per PUT request
+    print('%-8s %18s %18s' % ('fields', 'legacy x3 (us)', 'parse_form (us)'))
+    for fields in (10, 100, 1000):
+        body = get_body(fields)
+        legacy = timeit.timeit(lambda: [legacy_parse(body) for i in range(3)], number=iterations)
+        new = timeit.timeit(lambda: utils.parse_form(body), number=iterations)
+        print('%-8d %18.1f %18.1f' % (
+            fields, legacy * 1e6 / iterations, new * 1e6 / iterations
+        ))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
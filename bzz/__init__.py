@@ -9,13 +9,45 @@
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
 import sys
+import types
+import importlib
 
 from bzz.version import __version__  # NOQA
-try:
-    from bzz.model import ModelHive  # NOQA
-    from bzz.mock import MockHive  # NOQA
-    from bzz.auth import AuthHive, AuthProvider, authenticated  # NOQA
-    from bzz.utils import flatten  # NOQA
-except ImportError:
-    err = sys.exc_info()[1]
-    print("%s. Probably setup.py" % err)
+
+# names available in the bzz namespace and the modules they come from.
+# modules are only imported when one of their names is first used.
+LAZY_ATTRIBUTES = {
+    'ModelHive': 'bzz.model',
+    'MockHive': 'bzz.mock',
+    'AuthHive': 'bzz.auth',
+    'AuthProvider': 'bzz.auth',
+    'MetricsHive': 'bzz.metrics',
+    'authenticated': 'bzz.auth',
+    'flatten': 'bzz.utils',
+}
+
+__all__ = ['__version__'] + sorted(LAZY_ATTRIBUTES.keys())
+
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        module_name = LAZY_ATTRIBUTES.get(name, None)
+        if module_name is None:
+            raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, name))
+
+        value = getattr(importlib.import_module(module_name), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(LAZY_ATTRIBUTES.keys()))
+
+
+if sys.version_info >= (3, 5):
+    sys.modules[__name__].__class__ = LazyModule
+else:
+    module = LazyModule(__name__)
+    module.__dict__.update(sys.modules[__name__].__dict__)
+    # keeps the original module alive, or python 2 clears its globals
+    module.__original_module__ = sys.modules[__name__]
+    sys.modules[__name__] = module
@@ -12,13 +12,13 @@
 The bzz framework gives you a AuthHive class to allow easy OAuth2 authentication with a few steps.
 '''
 
+import time
 import functools
 from datetime import datetime, timedelta
 
 import tornado.web
 import tornado.gen as gen
 from tornado import ioloop
-from tornado import httpclient
 
 import bzz.signals as signals
 import bzz.utils as utils
@@ -26,10 +26,8 @@ import bzz.core as core
 
 
 def _authenticated(handler):
-    authenticated, payload = AuthHandler.is_authenticated(handler)
-    if authenticated:
-        AuthHandler._renew_authentication(handler, payload)
-    else:
+    authenticated, payload = AuthHandler.authenticate_request(handler)
+    if not authenticated:
         AuthHandler._set_unauthorized(handler)
 
 def authenticated(method):
@@ -39,7 +37,11 @@ def authenticated(method):
     a 401 unauthorized status code will be returned.
 
     If the user is authenticated, the token cookie will be renewed
-    with more `expiration` seconds (configured in `AuthHive.configure` method).
+    with more `expiration` seconds (configured in `AuthHive.configure` method)
+    and the decoded token payload is available as `self.current_user`.
+
+    The token is decoded only once per request, no matter how many times
+    authentication is checked (by this decorator or by the AuthHive signals).
 
     Usage:
 
@@ -67,10 +69,11 @@ class AuthHive(object):
     '''
     @classmethod
     def configure(
-            cls, app, secret_key, expiration=1200, cookie_name='AUTH_TOKEN',
+            cls, app, secret_key=None, expiration=1200, cookie_name='AUTH_TOKEN',
             authenticated_create=True, authenticated_update=True,
             authenticated_delete=True, proxy_host=None, proxy_port=None,
-            proxy_username=None, proxy_password=None, authenticated_get=True
+            proxy_username=None, proxy_password=None, authenticated_get=True,
+            jwt=None, session_store=None
             ):
         '''Configure the application to the authentication ecosystem.
 
@@ -108,8 +111,22 @@ class AuthHive(object):
                                      `bzz.pre-delete-instance` signal. Default is
                                      `True`
         :type authenticated_delete: bool
+        :param jwt: Tokenizer to use instead of a `secret_key` based one, i.e.:
+                    a `bzz.utils.KeySetJwt` with asymmetric keys, so nodes
+                    that only verify tokens don't need the signing key.
+                    Tokens are not renewed if the tokenizer can't sign them.
+        :type jwt: bzz.utils.Jwt instance
+        :param session_store: If specified, user data and the provider access
+                              token are kept in this store and the cookie
+                              only carries a signed session id
+        :type session_store: bzz.sessions.SessionStore instance
 
         '''
+        if jwt is None:
+            if secret_key is None:
+                raise ValueError('Either secret_key or jwt must be specified.')
+            jwt = utils.Jwt(secret_key)
+
         app.authentication_options = {
             'secret_key': secret_key,
             'expiration': expiration,
@@ -120,7 +137,8 @@ class AuthHive(object):
                 'proxy_username': proxy_username,
                 'proxy_password': proxy_password,
             },
-            'jwt': utils.Jwt(secret_key),
+            'jwt': jwt,
+            'session_store': session_store,
         }
         if authenticated_get:
             signals.pre_get_instance.connect(cls.handle_check_auth)
@@ -184,21 +202,83 @@ class AuthHandler(tornado.web.RequestHandler):
 
     @classmethod
     def is_authenticated(cls, handler):
-        jwt = handler.application.authentication_options['jwt']
-        cookie_name = handler.application.authentication_options['cookie_name']
-        return jwt.try_to_decode(handler.get_cookie(cookie_name))
+        options = handler.application.authentication_options
+        jwt = options['jwt']
+        authenticated, payload = jwt.try_to_decode(handler.get_cookie(options['cookie_name']))
+        signals.token_decoded.send(jwt, authenticated=authenticated, handler=handler)
+
+        store = options.get('session_store')
+        if authenticated and store is not None:
+            session = store.get(payload.get('sid'))
+            if session is None:
+                return False, None
+            session.update(payload)
+            payload = session
+
+        return authenticated, payload
+
+    @classmethod
+    def _encode_token(cls, handler, payload):
+        options = handler.application.authentication_options
+        store = options.get('session_store')
+
+        if store is not None:
+            claims = dict(iat=payload['iat'], exp=payload['exp'])
+            session_id = payload.get('sid')
+            if session_id is None:
+                session = dict([
+                    (key, value) for key, value in payload.items()
+                    if key not in claims
+                ])
+                session_id = store.create(session, options['expiration'])
+            else:
+                store.touch(session_id, options['expiration'])
+
+            claims['sid'] = session_id
+            payload = claims
+
+        return options['jwt'].encode(payload)
+
+    @classmethod
+    def authenticate_request(cls, handler):
+        '''Checks (and renews) the authentication for the request being
+        handled by `handler`. The result is memoized in the handler, so the
+        token is decoded only once per request. If authenticated, the token
+        payload is set as `handler.current_user`.
+        '''
+        result = getattr(handler, '_authentication_result', None)
+        if result is not None:
+            return result
+
+        result = cls.is_authenticated(handler)
+        authenticated, payload = result
+        if authenticated:
+            cls._renew_authentication(handler, payload)
+            handler.current_user = payload
+
+        handler._authentication_result = result
+        return result
 
     @classmethod
     def _renew_authentication(cls, handler, payload):
+        '''Renews the token (and the session) once more than half of its
+        lifetime has passed, so most requests don't sign a new token nor
+        touch the session store'''
+        jwt = handler.application.authentication_options['jwt']
+        if not jwt.can_sign:
+            return
+
+        expiration = handler.application.authentication_options['expiration']
+        issued_at = payload.get('iat', None)
+        if isinstance(issued_at, (int, float)) and time.time() - issued_at < expiration / 2.0:
+            return
+
         payload.update(dict(
             iat=datetime.utcnow(),
-            exp=datetime.utcnow() + timedelta(
-                seconds=handler.application.authentication_options['expiration']
-            )
+            exp=datetime.utcnow() + timedelta(seconds=expiration)
         ))
         cookie_name = handler.application.authentication_options['cookie_name']
-        jwt = handler.application.authentication_options['jwt']
-        token = jwt.encode(payload)
+        token = cls._encode_token(handler, payload)
         handler.set_cookie(cookie_name, token)
 
 
@@ -249,7 +329,7 @@ class AuthSigninHandler(AuthHandler):
                 iat=datetime.utcnow(),
                 exp=datetime.utcnow() + timedelta(seconds=self.expiration)
             )
-            auth_token = self.jwt.encode(payload)
+            auth_token = AuthHandler._encode_token(self, payload)
 
             user_data['authenticated'] = True
             signals.authorized_user.send(
@@ -265,16 +345,46 @@ class AuthSigninHandler(AuthHandler):
 class AuthSignoutHandler(AuthHandler):
 
     def post(self):
+        store = self.application.authentication_options.get('session_store')
+        if store is not None:
+            authenticated, payload = self.jwt.try_to_decode(self.get_cookie(self.cookie_name))
+            if authenticated:
+                store.delete(payload.get('sid'))
+
         self.clear_cookie(self.cookie_name)
         self.write({'loggedOut': True})
 
 
 class AuthProvider(object):
 
-    def __init__(self, io_loop=None):
-        if not io_loop:
-            io_loop = ioloop.IOLoop.instance()
-        self.http_client = httpclient.AsyncHTTPClient(io_loop=io_loop)
+    def __init__(self, io_loop=None, http_client=None, max_clients=None):
+        '''
+        :param io_loop: The IOLoop the provider http client runs on
+        :param http_client: An optional `AsyncHTTPClient` to share among providers
+        :param max_clients: If specified (and no `http_client` given), creates a
+                            dedicated `AsyncHTTPClient` limited to this many
+                            simultaneous connections
+        '''
+        self.io_loop = io_loop
+        self.max_clients = max_clients
+        self._http_client = http_client
+
+    @property
+    def http_client(self):
+        '''The http client of the provider. Unless given, it is created when
+        first used, so processes forked after creating the provider (see
+        bzz.cli) each get their own.'''
+        if self._http_client is None:
+            from tornado import httpclient
+
+            kwargs = {}
+            if self.max_clients is not None:
+                kwargs = dict(force_instance=True, max_clients=self.max_clients)
+            self._http_client = httpclient.AsyncHTTPClient(
+                io_loop=self.io_loop or ioloop.IOLoop.current(), **kwargs
+            )
+
+        return self._http_client
 
     @classmethod
     def get_name(cls):
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Event bus relaying the changes to instances among the processes of a
+pre-forked server, so caches and change feeds in every process see the
+changes done by the others.
+'''
+
+import os
+import errno
+import socket
+import logging
+
+from tornado.ioloop import IOLoop
+
+from bzz.feeds import ChangeListener
+import bzz.signals as signals
+import bzz.utils as utils
+
+
+class EventBus(ChangeListener):
+    '''
+    Sends the changes done in this process (as told by the `post_*_instance`
+    signals) to the other processes using the same `path`, where they are
+    sent as the `remote_instance_changed` signal. The instance and list
+    caches and the change feeds listen to it.
+
+    Each process binds a unix datagram socket in `path`, so the bus works
+    with no broker process, among the processes of the same machine.
+
+    Usage::
+
+        bus = EventBus('/tmp/my-app-bus')
+        tornado.process.fork_processes(0)
+        bus.start()  # in each process, after forking
+
+    :param path: Directory for the sockets of the processes (created if needed)
+    :param max_message_size: Maximum size in bytes of the messages received
+    '''
+
+    def __init__(self, path, max_message_size=65536):
+        self.path = path
+        self.max_message_size = max_message_size
+        self.address = None
+        self.socket = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def start(self, name=None):
+        '''Binds the socket of this process and starts relaying changes'''
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+        if name is None:
+            name = str(os.getpid())
+
+        self.address = os.path.join(self.path, '%s.sock' % name)
+        self.remove_socket_file(self.address)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(self.address)
+
+        IOLoop.current().add_handler(self.socket.fileno(), self.on_readable, IOLoop.READ)
+        self.connect()
+
+    def stop(self):
+        if self.socket is None:
+            return
+
+        self.disconnect()
+        IOLoop.current().remove_handler(self.socket.fileno())
+        self.socket.close()
+        self.socket = None
+        self.remove_socket_file(self.address)
+
+    def remove_socket_file(self, address):
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+    def get_peers(self):
+        return [
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.endswith('.sock') and os.path.join(self.path, name) != self.address
+        ]
+
+    def on_change(self, model, event_type, data, instance=None):
+        self.send({
+            'model': '%s.%s' % (model.__module__, model.__name__),
+            'type': event_type,
+            'data': data,
+        })
+
+    def send(self, message):
+        if self.socket is None:
+            return
+
+        message = utils.dumps(message).encode('utf-8')
+
+        for address in self.get_peers():
+            try:
+                self.socket.sendto(message, address)
+                self.sent += 1
+            except socket.error as err:
+                if err.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # the process is gone
+                    self.remove_socket_file(address)
+                elif err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # the process is not keeping up; its caches expire eventually
+                    self.dropped += 1
+                    logging.warning('Dropped change event for %s (%s)' % (address, err))
+                else:
+                    raise
+
+    def on_readable(self, fd, events):
+        while self.socket is not None:
+            try:
+                message = self.socket.recv(self.max_message_size)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            self.receive(message)
+
+    def receive(self, message):
+        self.received += 1
+
+        try:
+            message = utils.loads(message.decode('utf-8'))
+            model = utils.get_class(message['model'])
+            event_type, data = message['type'], message['data']
+        except (ValueError, KeyError, TypeError, ImportError, AttributeError):
+            logging.warning('Ignoring invalid change event %r' % message)
+            return
+
+        future = signals.remote_instance_changed.send(model, event_type=event_type, data=data)
+        IOLoop.current().add_future(future, self.on_sent)
+
+    def on_sent(self, future):
+        if future.exception() is not None:
+            logging.error('Receiver of a change event failed', exc_info=future.exc_info())
+
+    def get_stats(self):
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'dropped': self.dropped,
+        }
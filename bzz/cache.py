@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import math
+import time
+import uuid
+import hashlib
+from collections import OrderedDict
+
+from six.moves import cPickle as pickle
+import tornado.gen as gen
+from tornado.ioloop import IOLoop
+
+import bzz.signals as signals
+
+
+class TTLCache(object):
+    '''In-process LRU cache whose entries expire `ttl` seconds after being set.
+
+    Usage:
+    >>> cache = TTLCache(ttl=60, max_size=2)
+    >>> cache.set('a', 1)
+    >>> cache.get('a')
+    1
+    >>> cache.get('b', 'default')
+    'default'
+    '''
+
+    def __init__(self, ttl=60, max_size=1000, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.items.pop(key, None)
+
+        if item is None or item[0] <= self.clock():
+            self.misses += 1
+            return default
+
+        self.items[key] = item
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self.items.pop(key, None)
+        self.items[key] = (self.clock() + ttl, value)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        item = self.items.get(key, None)
+        return item is not None and item[0] > self.clock()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class RedisCache(object):
+    '''Cache backend sharing entries among processes through redis (or any
+    server speaking its protocol), with the same interface as `TTLCache`.
+
+    :param client: A redis-py compatible client (`get`, `set` with `ex` and
+                   `delete` methods)
+    :param prefix: Prefix for the cache keys
+    '''
+
+    def __init__(self, client, ttl=60, prefix='bzz:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_key(self, key):
+        return '%s%s' % (self.prefix, key)
+
+    def get(self, key, default=None):
+        value = self.client.get(self.get_key(key))
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.client.set(self.get_key(key), value, ex=int(math.ceil(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.get_key(key))
+
+
+class InstanceCache(object):
+    '''Read-through cache for the instances ModelHive routes get by id.
+
+    Instances are stored serialized (as given by the provider
+    `serialize_instance`), so changing a returned instance never changes the
+    cached one. Providers invalidate instances when saving, updating,
+    deleting or associating them.
+
+    Models with a `get_instance_queryset` method are never cached, as it may
+    filter instances per request.
+
+    :param models: Models to cache. All models are cached if None
+    :param ttl: Time in seconds instances are cached for
+    :param max_size: Maximum number of instances kept by the default backend
+    :param backend: Where to keep the instances. An in-process `TTLCache` by
+                    default; a `RedisCache` shares them among processes
+    '''
+
+    def __init__(self, models=None, ttl=60, max_size=10000, backend=None):
+        self.models = None
+        if models is not None:
+            self.models = set(models)
+        self.ttl = ttl
+        if backend is None:
+            backend = TTLCache(ttl=ttl, max_size=max_size)
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        signals.remote_instance_changed.connect(self.on_remote_change)
+
+    def is_enabled(self, model):
+        if self.models is not None and model not in self.models:
+            return False
+
+        return not hasattr(model, 'get_instance_queryset')
+
+    def get_key(self, model, pk):
+        return '%s.%s:%s' % (model.__module__, model.__name__, pk)
+
+    def get(self, model, pk):
+        data = self.backend.get(self.get_key(model, pk))
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, model, pk, payload):
+        self.backend.set(
+            self.get_key(model, pk),
+            pickle.dumps(payload, pickle.HIGHEST_PROTOCOL),
+            ttl=self.ttl
+        )
+
+    def invalidate(self, model, pk):
+        self.invalidations += 1
+        self.backend.delete(self.get_key(model, pk))
+
+    def on_remote_change(self, sender, event_type=None, data=None, **kwargs):
+        instance_id = (data or {}).get('id', None)
+        if event_type != 'create' and instance_id is not None and self.is_enabled(sender):
+            self.invalidate(sender, instance_id)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+class SingleFlight(object):
+    '''Runs a coroutine only once for concurrent calls with the same key.
+    Calls made while it is running get the same future (and so the same
+    result or error).
+
+    Usage:
+    >>> flights = SingleFlight()
+    >>> first = flights.run('user:1', load_user)
+    >>> second = flights.run('user:1', load_user)  # load_user is not called
+    >>> first is second
+    True
+    '''
+
+    def __init__(self):
+        self.pending = {}
+        self.coalesced = 0
+
+    def is_running(self, key):
+        return key in self.pending
+
+    def run(self, key, create):
+        future = self.pending.get(key, None)
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        future = self.pending[key] = create()
+        IOLoop.current().add_future(future, lambda future: self.done(key, future))
+        return future
+
+    def done(self, key, future):
+        if self.pending.get(key, None) is future:
+            del self.pending[key]
+
+
+def get_auth_scope(handler):
+    '''Scope of the cached responses: the subject of the authentication token
+    if the AuthHive is configured and the user is authenticated, so users
+    never get each other's responses.'''
+    if getattr(handler.application, 'authentication_options', None) is None:
+        return ''
+
+    from bzz.auth import AuthHandler
+
+    authenticated, payload = AuthHandler.authenticate_request(handler)
+    if authenticated:
+        return 'sub:%s' % payload.get('sub')
+
+    return ''
+
+
+class ListCache(object):
+    '''Caches the serialized responses of list routes, keyed by the model,
+    the compiled filters and sort order, the page and the auth scope.
+
+    Concurrent requests for a response that is not cached yet wait for the
+    first one instead of querying the database themselves.
+
+    All the responses for a model are invalidated when instances of it are
+    created, updated or deleted (as told by the `post_*_instance` signals),
+    by changing the generation of the model that is part of the keys.
+
+    Models with a `get_list_queryset` method are only cached with an explicit
+    `get_scope`, as it may filter the lists per request by more than the
+    authenticated user.
+
+    :param models: Models to cache. All models are cached if None
+    :param ttl: Time in seconds responses are cached for
+    :param max_size: Maximum number of responses kept by the default backend
+    :param backend: Where to keep the responses. An in-process `TTLCache` by
+                    default; a `RedisCache` shares them among processes
+    :param get_scope: Function returning the scope for the request handler.
+                      The authenticated user by default
+    '''
+
+    def __init__(self, models=None, ttl=5, max_size=1000, backend=None, get_scope=None):
+        self.models = None
+        if models is not None:
+            self.models = set(models)
+        self.ttl = ttl
+        if backend is None:
+            backend = TTLCache(ttl=ttl, max_size=max_size)
+        self.backend = backend
+        self.scoped = get_scope is not None
+        if get_scope is None:
+            get_scope = get_auth_scope
+        self.get_scope = get_scope
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        for signal in (signals.post_create_instance, signals.post_update_instance, signals.post_delete_instance):
+            signal.connect(self.on_instance_changed)
+        signals.remote_instance_changed.connect(self.on_remote_change)
+
+    def is_enabled(self, model):
+        if self.models is not None and model not in self.models:
+            return False
+
+        return self.scoped or not hasattr(model, 'get_list_queryset')
+
+    def get_model_name(self, model):
+        return '%s.%s' % (model.__module__, model.__name__)
+
+    def get_generation(self, model):
+        generation_key = 'generation:%s' % self.get_model_name(model)
+        generation = self.backend.get(generation_key)
+
+        if generation is None:
+            generation = uuid.uuid4().hex
+            # outlives the responses cached with it
+            self.backend.set(generation_key, generation, ttl=self.ttl * 10)
+
+        if isinstance(generation, bytes):
+            generation = generation.decode('utf-8')
+
+        return generation
+
+    def get_key(self, model, handler, page, per_page, filters, sort):
+        query = repr((self.get_scope(handler), page, per_page, filters, sort))
+
+        return 'list:%s:%s:%s' % (
+            self.get_model_name(model),
+            self.get_generation(model),
+            hashlib.sha1(query.encode('utf-8')).hexdigest()
+        )
+
+    @gen.coroutine
+    def get_or_create(self, key, create):
+        '''Returns the response cached with `key` or the result of the
+        `create` coroutine, caching it.'''
+        response = self.backend.get(key)
+        if response is not None:
+            self.hits += 1
+            raise gen.Return(response)
+
+        if not self.flights.is_running(key):
+            self.misses += 1
+
+        response = yield self.flights.run(key, lambda: self.create(key, create))
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def create(self, key, create):
+        response = yield create()
+        self.backend.set(key, response, ttl=self.ttl)
+        raise gen.Return(response)
+
+    def invalidate(self, model):
+        self.invalidations += 1
+        self.backend.set('generation:%s' % self.get_model_name(model), uuid.uuid4().hex, ttl=self.ttl * 10)
+
+    def on_instance_changed(self, sender, handler=None, **kwargs):
+        models = set([sender])
+
+        # changing a related instance changes the lists of the route's model
+        if getattr(handler, 'model', None) is not None:
+            models.add(handler.model)
+
+        for model in models:
+            if isinstance(model, type) and self.is_enabled(model):
+                self.invalidate(model)
+
+    def on_remote_change(self, sender, **kwargs):
+        if isinstance(sender, type) and self.is_enabled(sender):
+            self.invalidate(sender)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.flights.coalesced,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Serves the routes of an application in as many processes as there are cores::
+
+    $ bzz myapp.api:routes --port 8888
+
+`myapp.api:routes` may be a list of routes (created by hives or not), a
+`tornado.web.Application` or a function returning either. It is loaded
+before forking, so the model trees are built once and shared by all the
+processes.
+
+Sending SIGHUP to the main process replaces the processes, letting the old
+ones finish the requests they are processing. SIGTERM and SIGINT stop them
+the same way.
+'''
+
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import argparse
+import importlib
+
+import tornado.web
+import tornado.netutil
+import tornado.process
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPServerConnectionDelegate, HTTPMessageDelegate
+from tornado.ioloop import IOLoop
+
+from bzz.model import ModelHive
+import bzz.signals as signals
+import bzz.utils as utils
+
+
+def load_application(target):
+    '''Imports `module:name` and returns the application for it'''
+    module_name, _, name = target.partition(':')
+    application = getattr(importlib.import_module(module_name), name or 'routes')
+
+    if callable(application) and not isinstance(application, (list, tornado.web.Application)):
+        application = application()
+
+    if not isinstance(application, tornado.web.Application):
+        application = tornado.web.Application(utils.flatten(application))
+
+    return application
+
+
+class DrainingDelegate(HTTPServerConnectionDelegate):
+    '''Serves `application` keeping track of the requests being processed,
+    so the process can wait for them before exiting. Requests stop being
+    processed when they finish or when their connection is closed (or
+    detached, as websockets are).'''
+
+    def __init__(self, application):
+        self.application = application
+        self.connections = set()
+        self.log_request = application.log_request
+        # the application calls it when each request finishes
+        application.log_request = self.request_finished
+
+    @property
+    def active(self):
+        for connection in list(self.connections):
+            if connection.stream is None or connection.stream.closed():
+                self.connections.discard(connection)
+
+        return len(self.connections)
+
+    def start_request(self, server_conn, request_conn):
+        return CountingMessageDelegate(
+            self, request_conn, self.application.start_request(server_conn, request_conn)
+        )
+
+    def on_close(self, server_conn):
+        self.application.on_close(server_conn)
+
+    def request_finished(self, handler):
+        self.connections.discard(handler.request.connection)
+        self.log_request(handler)
+
+
+class CountingMessageDelegate(HTTPMessageDelegate):
+    '''Counts the request as active once its headers arrive (connections
+    kept alive wait for the next request with a delegate already).'''
+
+    def __init__(self, counter, connection, delegate):
+        self.counter = counter
+        self.connection = connection
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.counter.connections.add(self.connection)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        self.counter.connections.discard(self.connection)
+        return self.delegate.on_connection_close()
+
+
+class Worker(object):
+    '''Serves the application in a process, stopping gracefully on SIGTERM
+    and SIGINT: new connections are refused, the `stopping` signal is sent
+    (ending the streams of change feeds) and the process exits once the
+    requests being processed finish (or `grace_period` seconds pass). The
+    `bus` of the process (if any) is stopped then, removing its socket.'''
+
+    def __init__(
+            self, application, sockets=None, port=8888, address='', grace_period=30, xheaders=False, bus=None):
+        self.application = application
+        self.sockets = sockets
+        self.port = port
+        self.address = address
+        self.grace_period = grace_period
+        self.xheaders = xheaders
+        self.bus = bus
+        self.delegate = DrainingDelegate(application)
+        self.server = None
+        self.deadline = None
+
+    def start(self):
+        sockets = self.sockets
+        if sockets is None:
+            # each process binds its own sockets and the kernel balances the connections
+            sockets = tornado.netutil.bind_sockets(self.port, self.address, reuse_port=True)
+
+        self.server = HTTPServer(self.delegate, xheaders=self.xheaders)
+        self.server.add_sockets(sockets)
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_stop_signal)
+
+    def run(self):
+        try:
+            self.start()
+            IOLoop.current().start()
+        finally:
+            self.stop_bus()
+
+    def on_stop_signal(self, signum, frame):
+        IOLoop.current().add_callback_from_signal(self.stop)
+
+    def stop(self):
+        if self.deadline is not None:
+            return
+
+        self.server.stop()
+        self.deadline = time.time() + self.grace_period
+        signals.stopping.send(self.application)
+        self.exit_when_drained()
+
+    def exit_when_drained(self):
+        if self.delegate.active > 0 and time.time() < self.deadline:
+            IOLoop.current().call_later(0.1, self.exit_when_drained)
+            return
+
+        self.stop_bus()
+        IOLoop.current().stop()
+
+    def stop_bus(self):
+        if self.bus is not None:
+            self.bus.stop()
+
+
+class Supervisor(object):
+    '''Forks `processes` workers, running `run_worker(number)` in each, and
+    forks them again if they crash. SIGHUP replaces all of them and SIGTERM
+    or SIGINT stop them.
+
+    Workers that keep crashing are forked again after `backoff` seconds,
+    doubled after each crash up to `max_backoff`. Workers that ran for longer
+    than `max_backoff` seconds before crashing are forked again after
+    `backoff` seconds.'''
+
+    def __init__(self, processes, run_worker, backoff=1, max_backoff=60):
+        self.processes = processes
+        self.run_worker = run_worker
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.workers = {}
+        self.started = {}
+        self.failures = {}
+        self.restarts = {}
+        self.retired = set()
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload_signal)
+        signal.signal(signal.SIGTERM, self.on_stop_signal)
+        signal.signal(signal.SIGINT, self.on_stop_signal)
+
+        for number in range(self.processes):
+            self.spawn(number)
+
+        while self.workers or self.restarts:
+            self.spawn_restarts()
+
+            try:
+                pid, status = self.wait()
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+
+            number = self.workers.pop(pid, None)
+            started = self.started.pop(pid, None)
+            if number is None:
+                continue
+
+            if pid in self.retired:
+                self.retired.discard(pid)
+            elif not self.stopping and not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                delay = self.schedule_restart(number, started)
+                logging.warning('Worker %d (pid %d) exited with status %d, restarting in %.1f seconds.' % (
+                    number, pid, status, delay
+                ))
+
+    def wait(self):
+        '''Waits for a worker to exit. While restarts are scheduled, returns
+        a pid of 0 if none did in a moment, so they are not delayed.'''
+        if not self.restarts:
+            return os.wait()
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as err:
+            if err.errno != errno.ECHILD:
+                raise
+            # no workers left, only restarts
+            pid, status = 0, 0
+
+        if pid == 0:
+            time.sleep(min(0.1, max(0, min(self.restarts.values()) - time.time())))
+
+        return pid, status
+
+    def schedule_restart(self, number, started=None):
+        '''Schedules forking worker `number` again. Returns the delay'''
+        if started is not None and time.time() - started > self.max_backoff:
+            self.failures[number] = 0
+
+        failures = self.failures[number] = self.failures.get(number, 0) + 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        self.restarts[number] = time.time() + delay
+        return delay
+
+    def spawn_restarts(self):
+        now = time.time()
+        for number, due in sorted(self.restarts.items()):
+            if due <= now:
+                del self.restarts[number]
+                self.spawn(number)
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+
+            # loops created while loading the application would share their
+            # epoll fd (and clients) with the parent and the other workers
+            IOLoop.clear_instance()
+            io_loop = IOLoop()
+            io_loop.install()
+            io_loop.make_current()
+
+            try:
+                self.run_worker(number)
+            except Exception:
+                logging.exception('Worker %d failed.' % number)
+                os._exit(1)
+            os._exit(0)
+
+        self.workers[pid] = number
+        self.started[pid] = time.time()
+
+    def on_reload_signal(self, signum, frame):
+        old_workers = dict(self.workers)
+        for number in sorted(old_workers.values()):
+            self.spawn(number)
+
+        self.retired.update(old_workers.keys())
+        self.kill(old_workers)
+
+    def on_stop_signal(self, signum, frame):
+        self.stopping = True
+        self.restarts.clear()
+        self.kill(self.workers)
+
+    def kill(self, workers):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def serve(
+        application, port=8888, address='', processes=0, reuse_port=False,
+        grace_period=30, xheaders=False, on_fork=None, bus_path=None):
+    '''
+    Serves `application` in `processes` processes (one per core if 0).
+
+    :param reuse_port: if True, each process binds its own socket with
+                       SO_REUSEPORT instead of sharing the socket bound
+                       before forking
+    :param grace_period: seconds the processes wait for the requests being
+                         processed when stopping
+    :param on_fork: function called with the application in each process
+    :param bus_path: directory for a `bzz.bus.EventBus` relaying changes
+                     among the processes
+    '''
+    if processes is None or processes <= 0:
+        processes = tornado.process.cpu_count()
+
+    sockets = None
+    if not reuse_port:
+        sockets = tornado.netutil.bind_sockets(port, address)
+
+    def run_worker(number):
+        if on_fork is not None:
+            on_fork(application)
+
+        bus = None
+        if bus_path is not None:
+            from bzz.bus import EventBus
+            bus = EventBus(bus_path)
+            bus.start()
+
+        Worker(
+            application, sockets=sockets, port=port, address=address,
+            grace_period=grace_period, xheaders=xheaders, bus=bus
+        ).run()
+
+    if processes == 1:
+        run_worker(0)
+        return
+
+    ModelHive.before_fork(application)
+    Supervisor(processes, run_worker).run()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Serves the routes of a bzz application.')
+    parser.add_argument('application', help='module:name of the routes, application or function returning either')
+    parser.add_argument('-p', '--port', type=int, default=8888)
+    parser.add_argument('-a', '--address', default='')
+    parser.add_argument('-n', '--processes', type=int, default=0, help='number of processes (one per core if 0)')
+    parser.add_argument('--reuse-port', action='store_true', help='bind a socket per process with SO_REUSEPORT')
+    parser.add_argument(
+        '--grace-period', type=float, default=30,
+        help='seconds to wait for the requests being processed when stopping'
+    )
+    parser.add_argument('--xheaders', action='store_true', help='trust X-Real-Ip and X-Scheme headers')
+    parser.add_argument('--on-fork', help='module:name of a function called with the application in each process')
+    parser.add_argument('--bus', help='directory for the sockets relaying changes among processes')
+    parser.add_argument('--trees', help='file to load the model trees from (and save them to)')
+    return parser
+
+
+def main(args=None):
+    options = get_parser().parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+
+    # finds the modules of the application in the current directory, as `python -m` would
+    sys.path.insert(0, os.getcwd())
+
+    if options.trees and os.path.exists(options.trees):
+        ModelHive.load_trees(options.trees)
+
+    application = load_application(options.application)
+
+    if options.trees:
+        ModelHive.save_trees(options.trees)
+
+    on_fork = None
+    if options.on_fork:
+        on_fork = utils.get_class(options.on_fork.replace(':', '.'))
+
+    serve(
+        application, port=options.port, address=options.address, processes=options.processes,
+        reuse_port=options.reuse_port, grace_period=options.grace_period, xheaders=options.xheaders,
+        on_fork=on_fork, bus_path=options.bus
+    )
+
+
+if __name__ == '__main__':
+    main()
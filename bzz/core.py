@@ -15,15 +15,43 @@ class RouteList(list):
     pass
 
 
+class CoercionError(ValueError):
+    def __init__(self, path, value):
+        self.path = path
+        self.value = value
+        super(CoercionError, self).__init__(
+            "Invalid value for field '%s': %r" % (path, value)
+        )
+
+
 class Node(object):
+    '''A node in the tree of fields of a model.
+
+    Root nodes keep an index of their descendants by dotted path and by model
+    class, so looking them up does not walk the tree.
+    '''
+
+    __slots__ = (
+        'is_root', 'paths', 'classes', 'name', 'slug', 'target_name',
+        'model_type', 'is_multiple', 'allows_create_on_associate',
+        'lazy_loaded', 'is_lazy_loaded', 'children', 'required_children',
+        'coerce', 'indexes',
+    )
+
+    # paths resolved by walking the tree (i.e.: through recursive models)
+    # are indexed until the index reaches this size
+    MAX_INDEXED_PATHS = 10000
+
     def __init__(self, name, is_root=False):
         if not name:
             raise ValueError("Can't create unnamed node.")
 
         self.is_root = is_root
-        self.cache = None
+        self.paths = None
+        self.classes = None
         if self.is_root:
-            self.cache = {}
+            self.paths = {}
+            self.classes = {}
         self.name = name
         self.slug = slugify.slugify(self.name.lower())
         self.target_name = name
@@ -31,12 +59,31 @@ class Node(object):
         self.is_multiple = False
         self.allows_create_on_associate = False
         self.lazy_loaded = False
+        self.is_lazy_loaded = False
         self.children = {}
         self.required_children = []
+        # converts request values to the type of the field (None keeps them)
+        self.coerce = None
+        # dotted paths of the indexed fields (root nodes only)
+        self.indexes = None
 
     def find_by_path(self, path):
         if not path:
             return self
+
+        if self.paths is not None:
+            node = self.paths.get(path, None)
+            if node is not None:
+                return node
+
+        node = self.walk(path)
+
+        if node is not None and self.paths is not None and len(self.paths) < self.MAX_INDEXED_PATHS:
+            self.paths[path] = node
+
+        return node
+
+    def walk(self, path):
         if '.' not in path:
             return self.children.get(path, None)
 
@@ -49,17 +96,28 @@ class Node(object):
 
         return obj
 
-    def get_cache_name(self, model):
-        return model.__name__
+    def add_to_index(self, path, node):
+        if self.paths is None:
+            return
+
+        self.paths[path] = node
 
     def add_to_cache(self, model, node):
-        if self.cache is None:
+        if self.classes is None:
+            return
+
+        self.classes[model] = node
+
+    def merge_classes(self, tree):
+        if self.classes is None or tree.classes is None:
             return
 
-        self.cache[self.get_cache_name(model)] = node
+        for cls, node in tree.classes.items():
+            if cls not in self.classes:
+                self.classes[cls] = node
 
     def find_by_class(self, cls):
-        if self.cache is None:
+        if self.classes is None:
             return None
 
-        return self.cache.get(cls.__name__)
+        return self.classes.get(cls, None)
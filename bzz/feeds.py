@@ -0,0 +1,572 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Change feeds for ModelHive routes.
+
+A `ChangeFeed` listens to the `post_create_instance`, `post_update_instance`
+and `post_delete_instance` signals and streams the changes to the clients of
+the `/<model>/_changes` route as server-sent events::
+
+    id: 4242.9f0c1a2b-12
+    event: update
+    data: {"id": "5464d2a1c3b9c5174b3b0a76", "fields": ["name"]}
+
+Clients of the `/_subscriptions` websocket route subscribe to instances or
+to filtered lists of the models instead, getting the changes to them every
+`coalesce_delay` seconds, with the successive changes to an instance merged::
+
+    > {"action": "subscribe", "id": "me", "resource": "user/5464d2a1c3b9c5174b3b0a76"}
+    > {"action": "subscribe", "id": "adults", "resource": "user", "filters": {"age__gte": 18}}
+    < {"subscribed": "me"}
+    < {"subscribed": "adults"}
+    < {"changes": {"me": [{"type": "update", "id": "5464d2a1c3b9c5174b3b0a76", "fields": ["age", "name"]}]}}
+
+Updates to fields a filtered list depends on that leave an instance out of it
+are sent as `leave` changes.
+'''
+
+import os
+import sys
+import uuid
+from collections import deque, OrderedDict
+
+import six
+import tornado.gen as gen
+import tornado.web
+import tornado.websocket
+from tornado.concurrent import Future
+from tornado.httputil import responses
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+
+from bzz.filters import compile_filters, FilterError
+from bzz.limits import ConcurrencyLimiter, LimitedHandler
+import bzz.signals as signals
+import bzz.utils as utils
+
+
+def format_event(event_id, event_type, data):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, event_type, utils.dumps(data))
+
+
+def merge_changes(previous, change):
+    '''Merges successive changes to the same instance into one'''
+    if previous is None or previous['type'] == 'delete' or change['type'] != 'update':
+        return change
+
+    if previous['type'] == 'create':
+        return previous
+
+    merged = dict(change)
+    if 'fields' in previous and 'fields' in change:
+        merged['fields'] = sorted(set(previous['fields']) | set(change['fields']))
+    else:
+        # some of the updates don't tell which fields changed
+        merged.pop('fields', None)
+
+    return merged
+
+
+class Subscription(object):
+    '''A websocket client subscription to an instance (if `instance_id` is
+    given) or to the instances of `model` that pass `filters`.'''
+
+    __slots__ = ('connection', 'subscription_id', 'model', 'instance_id', 'filters')
+
+    def __init__(self, connection, subscription_id, model, instance_id=None, filters=None):
+        self.connection = connection
+        self.subscription_id = subscription_id
+        self.model = model
+        self.instance_id = instance_id
+        self.filters = filters or []
+
+    def matches(self, instance):
+        # instances are not sent with all the changes (like partial updates)
+        if instance is None:
+            return True
+
+        return all(list_filter.matches(instance) for list_filter in self.filters)
+
+    def depends_on(self, fields):
+        '''Returns whether changes to `fields` (None if not known) may move
+        instances in or out of the filtered list'''
+        if not self.filters:
+            return False
+
+        if fields is None:
+            return True
+
+        return any(
+            field == list_filter.path or list_filter.path.startswith(field + '.') or
+            field.startswith(list_filter.path + '.')
+            for field in fields for list_filter in self.filters
+        )
+
+
+class ChangeListener(object):
+    '''
+    Base class for the objects told about the instances created, updated and
+    deleted through ModelHive routes (by the `post_*_instance` signals).
+    Subclasses implement `on_change`.
+    '''
+
+    def connect(self):
+        signals.post_create_instance.connect(self.on_instance_created)
+        signals.post_update_instance.connect(self.on_instance_updated)
+        signals.post_delete_instance.connect(self.on_instance_deleted)
+
+    def disconnect(self):
+        signals.post_create_instance.disconnect(self.on_instance_created)
+        signals.post_update_instance.disconnect(self.on_instance_updated)
+        signals.post_delete_instance.disconnect(self.on_instance_deleted)
+
+    def on_instance_created(self, sender, instance=None, handler=None, **kwargs):
+        return self.on_instance_changed('create', sender, instance, handler)
+
+    def on_instance_updated(self, sender, instance=None, handler=None, updated_fields=None, **kwargs):
+        return self.on_instance_changed('update', sender, instance, handler, updated_fields)
+
+    def on_instance_deleted(self, sender, instance=None, handler=None, **kwargs):
+        return self.on_instance_changed('delete', sender, instance, handler)
+
+    @gen.coroutine
+    def on_instance_changed(self, event_type, sender, instance, handler, updated_fields=None):
+        root = getattr(handler, 'model', None)
+        root_id = self.get_root_id(handler)
+
+        if instance is None and sender is root:
+            instance_id = root_id
+        else:
+            instance_id = yield self.get_instance_id(instance, handler)
+
+        data = {'id': instance_id}
+        if updated_fields is not None:
+            data['fields'] = sorted(updated_fields.keys())
+
+        self.on_change(sender, event_type, data, instance)
+
+        # changes to related instances change the instance in the url
+        if root is not None and root is not sender and root_id is not None:
+            self.on_change(root, 'update', {'id': root_id})
+
+    @gen.coroutine
+    def get_instance_id(self, instance, handler):
+        if instance is None or handler is None:
+            raise gen.Return(None)
+
+        try:
+            instance_id = yield handler.get_instance_id(instance)
+        except AttributeError:
+            # embedded instances have no ids
+            instance_id = None
+
+        raise gen.Return(instance_id)
+
+    def get_root_id(self, handler):
+        path_args = getattr(handler, 'path_args', None)
+        if not path_args or '/' not in path_args[0]:
+            return None
+
+        return path_args[0].split('/')[1]
+
+    def on_change(self, model, event_type, data, instance=None):
+        '''
+        Called for each change with the model, the type of change (`create`,
+        `update` or `delete`) and its data: the id of the instance and, for
+        updates, the `fields` that changed (if known).
+        '''
+
+
+class ChangeFeed(ChangeListener):
+    '''
+    Fans out the changes to instances to the clients subscribed to their
+    models. Each event is serialized once, no matter how many clients get
+    it, and idle clients cost a buffer and a future each.
+
+    Event ids are `<process>-<sequence>`, so clients reconnecting to another
+    process (or to a restarted one) are reset instead of getting the wrong
+    events replayed.
+
+    :param buffer_size: Events kept for each client that is not reading them
+                        as fast as they happen. When the buffer is full the
+                        client is disconnected and resumes from the last
+                        event it got when reconnecting
+    :param history_size: Recent events kept to be replayed to reconnecting
+                         clients (that send the `Last-Event-ID` header)
+    :param heartbeat: Seconds between the comments sent to keep idle
+                      connections open (through proxies) and detect
+                      closed ones. Set to None to disable
+    :param max_streams: Maximum number of streams open at the same time (of
+                        all the models). Streams over it are refused with a
+                        429 status code. None for no limit
+    '''
+
+    def __init__(self, buffer_size=100, history_size=1000, heartbeat=15, max_streams=None):
+        self.buffer_size = buffer_size
+        self.stream_limiter = None
+        if max_streams is not None:
+            self.stream_limiter = ConcurrencyLimiter(max_streams)
+        self.history = deque(maxlen=history_size)
+        self.heartbeat = heartbeat
+        self.heartbeat_callback = None
+        self.pid = None
+        self.id_prefix = None
+        self.last_event_id = 0
+        self.subscribers = {}
+        self.models = {}
+        self.instance_subscriptions = {}
+        self.model_subscriptions = {}
+
+        self.connect()
+        signals.remote_instance_changed.connect(self.on_remote_change)
+        signals.stopping.connect(self.on_stopping)
+
+    def on_change(self, model, event_type, data, instance=None):
+        self.publish(model, event_type, data, instance)
+
+    def on_remote_change(self, sender, event_type=None, data=None, **kwargs):
+        self.publish(sender, event_type, data)
+
+    def on_stopping(self, sender, **kwargs):
+        # streams would otherwise keep stopping processes up until the grace period ends
+        self.close()
+
+    def get_id_prefix(self):
+        '''Returns the prefix of the ids of the events of this process. Feeds
+        created before forking start over in each process.'''
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.id_prefix = '%d.%s' % (pid, uuid.uuid4().hex[:8])
+            self.last_event_id = 0
+            self.history.clear()
+
+        return self.id_prefix
+
+    def get_event_id(self, sequence):
+        return '%s-%d' % (self.get_id_prefix(), sequence)
+
+    def publish(self, model, event_type, data, instance=None):
+        prefix = self.get_id_prefix()
+        self.last_event_id += 1
+        event = format_event('%s-%d' % (prefix, self.last_event_id), event_type, data)
+        self.history.append((self.last_event_id, model, event))
+
+        for subscriber in list(self.subscribers.get(model, ())):
+            subscriber.push(event)
+
+        change = dict(data, type=event_type)
+
+        if data.get('id', None) is not None:
+            key = (model, six.text_type(data['id']))
+            for subscription in list(self.instance_subscriptions.get(key, ())):
+                subscription.connection.notify(subscription, change)
+
+        for subscription in list(self.model_subscriptions.get(model, ())):
+            if subscription.matches(instance):
+                subscription.connection.notify(subscription, change)
+            elif event_type == 'update' and subscription.depends_on(data.get('fields', None)):
+                # the instance may have been in the list before the update
+                subscription.connection.notify(subscription, dict(change, type='leave'))
+
+    def register(self, name, model, tree):
+        '''Makes `model` available to websocket subscriptions as `name`'''
+        self.models[name] = (model, tree)
+
+    def add_subscription(self, subscription):
+        if subscription.instance_id is not None:
+            key = (subscription.model, subscription.instance_id)
+            self.instance_subscriptions.setdefault(key, set()).add(subscription)
+        else:
+            self.model_subscriptions.setdefault(subscription.model, set()).add(subscription)
+
+    def remove_subscription(self, subscription):
+        if subscription.instance_id is not None:
+            index, key = self.instance_subscriptions, (subscription.model, subscription.instance_id)
+        else:
+            index, key = self.model_subscriptions, subscription.model
+
+        subscriptions = index.get(key, None)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+    def subscribe(self, model, subscriber, last_event_id=None):
+        '''Subscribes to the changes to instances of `model`. Returns the
+        events since `last_event_id` that should be sent first.'''
+        self.subscribers.setdefault(model, set()).add(subscriber)
+        self.start_heartbeat()
+
+        if last_event_id is None:
+            return []
+
+        prefix, _, sequence = last_event_id.rpartition('-')
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            sequence = -1
+
+        oldest_event_id = self.history[0][0] if self.history else self.last_event_id + 1
+        if prefix != self.get_id_prefix() or sequence > self.last_event_id or sequence < oldest_event_id - 1:
+            # the client missed events that are not kept anymore (or got them from another process)
+            return [format_event(self.get_event_id(self.last_event_id), 'reset', {})]
+
+        return [event for event_id, event_model, event in self.history if event_id > sequence and event_model is model]
+
+    def unsubscribe(self, model, subscriber):
+        subscribers = self.subscribers.get(model, None)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[model]
+
+    def start_heartbeat(self):
+        if self.heartbeat is None or self.heartbeat_callback is not None:
+            return
+
+        self.heartbeat_callback = PeriodicCallback(self.ping, self.heartbeat * 1000)
+        self.heartbeat_callback.start()
+
+    def ping(self):
+        for subscribers in list(self.subscribers.values()):
+            for subscriber in list(subscribers):
+                subscriber.push(':\n\n')
+
+    def close(self):
+        '''Ends the streams of all clients (before shutting down, for instance)'''
+        if self.heartbeat_callback is not None:
+            self.heartbeat_callback.stop()
+            self.heartbeat_callback = None
+
+        for subscribers in list(self.subscribers.values()):
+            for subscriber in list(subscribers):
+                subscriber.close()
+
+
+class ChangeFeedHandler(LimitedHandler, tornado.web.RequestHandler):
+    '''Streams the events of a `ChangeFeed` for a model as server-sent
+    events. Streams are reads of the model list: the `pre_get_list` signal is
+    sent before subscribing (so the AuthHive protects them) and the rate
+    limiter of the route applies. Open streams hold a slot of the stream
+    limiter of the feed (not of the route, as idle streams would keep other
+    requests out).'''
+
+    def initialize(self, feed=None, model=None, name=None, rate_limiter=None, concurrency_limiter=None):
+        self.feed = feed
+        self.model = model
+        self.name = name
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.buffer = deque()
+        self.waiter = None
+        self.closed = False
+
+    def prepare(self):
+        self.acquire_limits()
+
+    @gen.coroutine
+    def get(self):
+        yield signals.pre_get_list.send(self.model, arguments=[self.name], handler=self)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # tells nginx not to buffer the stream
+        self.set_header('X-Accel-Buffering', 'no')
+
+        self.buffer.extend(
+            self.feed.subscribe(self.model, self, self.request.headers.get('Last-Event-ID', None))
+        )
+
+        try:
+            # sends the headers right away, so clients know they are connected
+            yield self.flush()
+
+            while not self.closed:
+                if not self.buffer:
+                    self.waiter = Future()
+                    yield self.waiter
+                    continue
+
+                while self.buffer:
+                    self.write(self.buffer.popleft())
+                yield self.flush()
+        except StreamClosedError:
+            self.closed = True
+        finally:
+            self.feed.unsubscribe(self.model, self)
+
+    def push(self, event):
+        if self.closed:
+            return
+
+        if len(self.buffer) >= self.feed.buffer_size:
+            # slow client: it reconnects and resumes from its last event
+            self.buffer.clear()
+            self.close()
+            return
+
+        self.buffer.append(event)
+        self.wake()
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def on_finish(self):
+        self.release_concurrency_slot()
+
+    def on_connection_close(self):
+        self.release_concurrency_slot()
+        self.close()
+
+
+class SubscriptionHandler(tornado.websocket.WebSocketHandler):
+    '''Websocket for subscriptions to the changes in a `ChangeFeed`.
+    Subscriptions are reads: the `pre_get_list` signal of each model is sent
+    before the connection is upgraded (when receivers can still reply), so
+    the AuthHive protects them.'''
+
+    def initialize(self, feed=None, coalesce_delay=0.05, max_subscriptions=100):
+        self.feed = feed
+        self.coalesce_delay = coalesce_delay
+        self.max_subscriptions = max_subscriptions
+        self.subscriptions = {}
+        self.pending = OrderedDict()
+        self.flush_timeout = None
+        self.refused = {}
+
+    @gen.coroutine
+    def prepare(self):
+        for name, (model, tree) in sorted(self.feed.models.items()):
+            error = yield self.check_read(model, name)
+            if error is not None:
+                self.refused[name] = error
+
+        # receivers that refused a model set the status of the response
+        self.set_status(200)
+
+    @gen.coroutine
+    def check_read(self, model, name):
+        '''Sends the signal a GET to the list of `model` would send. Returns
+        the error message if a receiver refuses it (i.e.: `Unauthorized`).'''
+        try:
+            yield signals.pre_get_list.send(model, arguments=[name], handler=self)
+        except tornado.web.Finish:
+            raise gen.Return(responses.get(self.get_status(), 'Forbidden'))
+        except tornado.web.HTTPError:
+            raise gen.Return(responses.get(sys.exc_info()[1].status_code, 'Forbidden'))
+
+    def on_message(self, message):
+        try:
+            message = utils.loads(message)
+        except ValueError:
+            self.send_message({'error': 'Invalid message'})
+            return
+
+        if not isinstance(message, dict):
+            self.send_message({'error': 'Invalid message'})
+            return
+
+        subscription_id = message.get('id', None)
+        action = message.get('action', None)
+
+        if action == 'subscribe':
+            error = self.subscribe(subscription_id, message.get('resource', None), message.get('filters', None))
+            if error is not None:
+                self.send_message({'error': error, 'id': subscription_id})
+            else:
+                self.send_message({'subscribed': subscription_id})
+        elif action == 'unsubscribe':
+            self.unsubscribe(subscription_id)
+            self.send_message({'unsubscribed': subscription_id})
+        else:
+            self.send_message({'error': "Invalid action '%s'" % action, 'id': subscription_id})
+
+    def subscribe(self, subscription_id, resource, filters=None):
+        '''Subscribes to `resource` (`<name>` or `<name>/<pk>`). Returns the
+        error message if the subscription is not valid or not allowed.'''
+        if subscription_id is None or not isinstance(resource, six.string_types):
+            return 'Subscriptions need an id and a resource'
+
+        if subscription_id not in self.subscriptions and len(self.subscriptions) >= self.max_subscriptions:
+            return 'Too many subscriptions'
+
+        name, instance_id = (resource.strip('/').split('/', 1) + [None])[:2]
+        if name not in self.feed.models:
+            return "Invalid resource '%s'" % resource
+
+        if name in self.refused:
+            return self.refused[name]
+
+        model, tree = self.feed.models[name]
+
+        compiled = []
+        if filters:
+            if instance_id is not None or not isinstance(filters, dict):
+                return 'Filters are only valid for lists'
+
+            try:
+                compiled = compile_filters(tree, filters)[0]
+            except FilterError:
+                return str(sys.exc_info()[1])
+
+        self.unsubscribe(subscription_id)
+
+        subscription = Subscription(self, subscription_id, model, instance_id, compiled)
+        self.subscriptions[subscription_id] = subscription
+        self.feed.add_subscription(subscription)
+
+    def unsubscribe(self, subscription_id):
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is not None:
+            self.feed.remove_subscription(subscription)
+            self.pending.pop(subscription_id, None)
+
+    def notify(self, subscription, change):
+        '''Queues the change to be sent with the ones that happen in the next
+        `coalesce_delay` seconds'''
+        changes = self.pending.setdefault(subscription.subscription_id, OrderedDict())
+        key = change.get('id', None)
+        changes[key] = merge_changes(changes.get(key, None), change)
+
+        if self.flush_timeout is None:
+            self.flush_timeout = IOLoop.current().call_later(self.coalesce_delay, self.send_changes)
+
+    def send_changes(self):
+        self.flush_timeout = None
+        if not self.pending:
+            return
+
+        changes = dict(
+            (subscription_id, list(pending.values()))
+            for subscription_id, pending in self.pending.items()
+        )
+        self.pending = OrderedDict()
+        self.send_message({'changes': changes})
+
+    def send_message(self, message):
+        try:
+            self.write_message(utils.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            self.on_close()
+
+    def on_close(self):
+        for subscription_id in list(self.subscriptions.keys()):
+            self.unsubscribe(subscription_id)
+
+        if self.flush_timeout is not None:
+            IOLoop.current().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
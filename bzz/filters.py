@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Filters for ModelHive list routes.
+
+Query string arguments are compiled against the tree of fields of the model
+into `Filter` objects (with values converted to the types of the fields) that
+providers translate into native queries::
+
+    /user/?age__gte=18&name__in=bernardo,rafael&team.name=bzz&sort=-created,name
+'''
+
+import six
+
+import bzz.utils as utils
+
+
+OPERATORS = (
+    'eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in', 'nin',
+    'contains', 'startswith', 'exists',
+)
+
+# operators that take a list of values (comma separated in query strings)
+LIST_OPERATORS = ('in', 'nin')
+
+SORT_ARGUMENT = 'sort'
+
+# arguments starting with it are never filters
+RESERVED_PREFIX = '_'
+
+# how each operator matches the value of a field in an instance
+MATCHERS = {
+    'eq': lambda value, expected: value == expected,
+    'ne': lambda value, expected: value != expected,
+    'lt': lambda value, expected: value is not None and value < expected,
+    'lte': lambda value, expected: value is not None and value <= expected,
+    'gt': lambda value, expected: value is not None and value > expected,
+    'gte': lambda value, expected: value is not None and value >= expected,
+    'in': lambda value, expected: value in expected,
+    'nin': lambda value, expected: value not in expected,
+    'contains': lambda value, expected: value is not None and expected in value,
+    'startswith': lambda value, expected: (
+        isinstance(value, six.string_types) and value.startswith(expected)
+    ),
+    'exists': lambda value, expected: (value is not None) == expected,
+}
+
+
+class FilterError(ValueError):
+    pass
+
+
+class Filter(object):
+    '''A filter compiled against the model tree.
+
+    :param path: Dotted path of the field being filtered
+    :param operator: One of `OPERATORS`
+    :param value: Value (or list of values) already converted to the field type
+    :param node: The `core.Node` of the field
+    '''
+
+    __slots__ = ('path', 'operator', 'value', 'node')
+
+    def __init__(self, path, operator, value, node=None):
+        self.path = path
+        self.operator = operator
+        self.value = value
+        self.node = node
+
+    def __eq__(self, other):
+        return (self.path, self.operator, self.value) == (other.path, other.operator, other.value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Filter(%r, %r, %r)' % (self.path, self.operator, self.value)
+
+    def matches(self, instance):
+        '''Returns whether the instance passes the filter. Filters on fields
+        referencing other models can't be checked without loading them, so
+        every instance passes them.'''
+        if self.node is not None and self.node.model_type is not None:
+            return True
+
+        value = instance
+        for name in self.path.split('.'):
+            if isinstance(value, dict):
+                value = value.get(name, None)
+            else:
+                value = getattr(value, name, None)
+
+            if value is None:
+                break
+
+        try:
+            return MATCHERS[self.operator](value, self.value)
+        except TypeError:
+            return False
+
+
+def parse_key(key):
+    '''Splits `age__gte` into the field path and operator'''
+    if '__' in key:
+        path, operator = key.rsplit('__', 1)
+        if operator in OPERATORS:
+            return path, operator
+
+    return key, 'eq'
+
+
+def coerce_value(node, path, operator, value):
+    if operator == 'exists':
+        try:
+            return utils.parse_bool(value)
+        except ValueError:
+            raise FilterError("Invalid value for filter '%s__exists': %r" % (path, value))
+
+    if operator in LIST_OPERATORS:
+        if isinstance(value, six.string_types):
+            value = value.split(',')
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        return [coerce_value(node, path, 'eq', item) for item in value]
+
+    if node.coerce is None or value is None:
+        return value
+
+    try:
+        return node.coerce(value)
+    except (ValueError, TypeError):
+        raise FilterError("Invalid value for filter '%s': %r" % (path, value))
+
+
+def compile_filters(tree, arguments, indexed_only=False):
+    '''
+    Compiles the request `arguments` into a list of `Filter` objects and the
+    sort order (a list of `(path, descending)` tuples).
+
+    Raises `FilterError` for unknown fields and invalid values, and if
+    `indexed_only` is set, for fields that are not indexed (as given by the
+    `indexes` of the tree). Arguments starting with `_` are reserved (like
+    `_explain` or the `_` cache busters clients send) and ignored.
+    '''
+    filters = []
+    sort = []
+
+    for key, value in sorted(arguments.items()):
+        if key.startswith(RESERVED_PREFIX):
+            continue
+
+        if key == SORT_ARGUMENT:
+            sort = compile_sort(tree, value, indexed_only)
+            continue
+
+        path, operator = parse_key(key)
+        node = get_node(tree, path)
+        check_index(tree, path, indexed_only)
+
+        filters.append(Filter(path, operator, coerce_value(node, path, operator, value), node))
+
+    return filters, sort
+
+
+def compile_sort(tree, value, indexed_only=False):
+    sort = []
+
+    for path in value.split(','):
+        path = path.strip()
+        descending = path.startswith('-')
+        path = path.lstrip('-+')
+        if not path:
+            continue
+
+        get_node(tree, path)
+        check_index(tree, path, indexed_only)
+        sort.append((path, descending))
+
+    return sort
+
+
+def get_node(tree, path):
+    node = tree.find_by_path(path)
+
+    if node is None or node is tree:
+        raise FilterError("Invalid filter field '%s'" % path)
+
+    return node
+
+
+def check_index(tree, path, indexed_only):
+    if indexed_only and path not in (tree.indexes or ()):
+        raise FilterError("Field '%s' can't be filtered or sorted as it's not indexed" % path)
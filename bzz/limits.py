@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Rate and concurrency limiters that can be attached to ModelHive routes.
+'''
+
+import math
+import time
+from collections import OrderedDict
+
+
+def get_client_key(handler):
+    '''Identifies the client doing the request: the subject of the
+    authentication token if AuthHive is configured and the user is
+    authenticated, or the remote ip otherwise.
+    '''
+    if getattr(handler.application, 'authentication_options', None) is not None:
+        from bzz.auth import AuthHandler
+
+        authenticated, payload = AuthHandler.authenticate_request(handler)
+        if authenticated and payload.get('sub') is not None:
+            return 'sub:%s' % payload['sub']
+
+    return 'ip:%s' % handler.request.remote_ip
+
+
+class RateLimiter(object):
+    '''Token bucket rate limiter. Each client may do `burst` requests at once
+    and then `rate` requests per second.
+
+    Buckets for the `max_keys` most recently seen clients are kept; older
+    ones are dropped, so memory usage is bounded.
+
+    Usage:
+    >>> limiter = RateLimiter(rate=1, burst=2)
+    >>> limiter.acquire('ip:127.0.0.1'), limiter.acquire('ip:127.0.0.1')
+    (0, 0)
+    >>> limiter.acquire('ip:127.0.0.1')  # seconds to wait before retrying
+    0.99...
+    '''
+
+    def __init__(self, rate, burst=None, max_keys=10000, get_key=get_client_key, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, rate)
+        self.max_keys = max_keys
+        self.get_key = get_key
+        self.clock = clock
+        self.buckets = OrderedDict()
+
+    def acquire(self, key):
+        '''Takes a token from the bucket for `key`. Returns 0 if the request
+        is allowed or the number of seconds until it would be.
+        '''
+        now = self.clock()
+        bucket = self.buckets.pop(key, None)
+
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+        return wait
+
+
+class ConcurrencyLimiter(object):
+    '''Limits how many requests may be processed at the same time. Requests
+    over the limit are rejected and told to retry after `retry_after` seconds.
+    '''
+
+    def __init__(self, max_concurrency, retry_after=1):
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.active = 0
+
+    def acquire(self):
+        if self.active >= self.max_concurrency:
+            return False
+
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active = max(0, self.active - 1)
+
+
+class LimitedHandler(object):
+    '''Mixin for request handlers with a `rate_limiter` and a
+    `concurrency_limiter` (either may be None). Handlers call
+    `acquire_limits` when preparing the request and
+    `release_concurrency_slot` when it is done.'''
+
+    holds_concurrency_slot = False
+
+    def acquire_limits(self):
+        '''Returns False (after rejecting the request) if it is over the limits'''
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.acquire(self.rate_limiter.get_key(self))
+            if wait > 0:
+                self.reject_too_many_requests(wait)
+                return False
+
+        if self.concurrency_limiter is not None:
+            if not self.concurrency_limiter.acquire():
+                self.reject_too_many_requests(self.concurrency_limiter.retry_after)
+                return False
+            self.holds_concurrency_slot = True
+
+        return True
+
+    def reject_too_many_requests(self, retry_after):
+        self.set_status(429, reason='Too Many Requests')
+        self.set_header('Retry-After', int(math.ceil(retry_after)))
+        self.finish()
+
+    def release_concurrency_slot(self):
+        if self.holds_concurrency_slot:
+            self.holds_concurrency_slot = False
+            self.concurrency_limiter.release()
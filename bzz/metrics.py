@@ -0,0 +1,371 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Metrics of ModelHive routes, exported in the Prometheus text format::
+
+    metrics = Metrics()
+    metrics.install()
+    routes = bzz.flatten([
+        bzz.ModelHive.routes_for('mongoengine', User, metrics=metrics),
+        bzz.MetricsHive.routes_for(metrics),
+    ])
+    # Prometheus scrapes http://myserver/metrics
+
+Metrics are only changed from the IOLoop thread, so they are plain counters
+with no locks.
+'''
+
+import os
+import glob
+import errno
+import logging
+
+import tornado.web
+from tornado.ioloop import PeriodicCallback
+
+import bzz.core as core
+import bzz.signals as signals
+import bzz.utils as utils
+from bzz.timing import Histogram, HistogramSink
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # processes of other users are alive, but can't be signaled
+        return err.errno == errno.EPERM
+    return True
+
+
+def get_receiver_name(receiver):
+    owner = getattr(receiver, '__self__', None)
+    name = getattr(receiver, '__name__', None) or repr(receiver)
+    if owner is None:
+        return '%s.%s' % (getattr(receiver, '__module__', None), name)
+
+    if not isinstance(owner, type):
+        owner = owner.__class__
+    return '%s.%s.%s' % (owner.__module__, owner.__name__, name)
+
+
+class Counter(object):
+    '''Values of a counter, by the values of its labels'''
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get_state(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, merged, state):
+        for labels, value in state:
+            labels = tuple(labels)
+            merged[labels] = merged.get(labels, 0) + value
+
+    def get_samples(self, merged):
+        for labels, value in sorted(merged.items()):
+            yield '%s%s %s' % (self.name, format_labels(self.labels, labels), format_value(value))
+
+
+class HistogramMetric(object):
+    '''Histograms of a value, by the values of their labels'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=HistogramSink.DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.histograms = {}
+
+    def observe(self, labels, value):
+        histogram = self.histograms.get(labels, None)
+        if histogram is None:
+            histogram = self.histograms[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def get_state(self):
+        return [
+            [list(labels), histogram.counts, histogram.sum]
+            for labels, histogram in self.histograms.items()
+        ]
+
+    def merge(self, merged, state):
+        for labels, counts, total in state:
+            labels = tuple(labels)
+            histogram = merged.get(labels, None)
+            if histogram is None:
+                histogram = merged[labels] = Histogram(self.buckets)
+
+            for index, count in enumerate(counts):
+                histogram.counts[index] += count
+            histogram.count += sum(counts)
+            histogram.sum += total
+
+    def get_samples(self, merged):
+        names = tuple(self.labels) + ('le',)
+        for labels, histogram in sorted(merged.items()):
+            for bound, count in histogram.get_cumulative_counts():
+                bound = '+Inf' if bound is None else format_value(float(bound))
+                yield '%s_bucket%s %d' % (self.name, format_labels(names, labels + (bound,)), count)
+
+            yield '%s_sum%s %s' % (self.name, format_labels(self.labels, labels), format_value(histogram.sum))
+            yield '%s_count%s %d' % (self.name, format_labels(self.labels, labels), histogram.count)
+
+
+class Metrics(object):
+    '''
+    Counts the requests to the ModelHive routes created with `metrics` (by
+    resource, method and status), their durations, the database queries
+    they do, the cache hits and misses, how long each signal receiver takes
+    and how many authentication tokens are decoded. Signal receivers and
+    token decodes are only measured after `install` is called.
+
+    Pre-forked processes can aggregate their metrics by saving them in a
+    shared directory. The metrics route of any process then serves the sum
+    of the metrics of all of them::
+
+        metrics = Metrics(path='/tmp/my-app-metrics')
+        tornado.process.fork_processes(0)
+        metrics.start()  # in each process, after forking
+
+    The metrics saved by previous runs are removed when the `Metrics` is
+    created (so create it once, before forking), and the ones of processes
+    that exited are removed when the others read them.
+
+    :param path: Directory where each process saves its metrics (or None)
+    :param interval: Seconds between saves of the metrics of this process
+    :param buckets: Upper bounds (in seconds) of the buckets of the duration histograms
+    '''
+
+    def __init__(self, path=None, interval=5, buckets=HistogramSink.DEFAULT_BUCKETS):
+        self.path = path
+        self.interval = interval
+        self.filename = None
+        self.saver = None
+        self.caches = {}
+
+        self.requests = Counter(
+            'bzz_requests_total', 'Requests to ModelHive routes.', ('resource', 'method', 'status')
+        )
+        self.request_duration = HistogramMetric(
+            'bzz_request_duration_seconds', 'Duration of requests to ModelHive routes.',
+            ('resource', 'method'), buckets
+        )
+        self.queries = Counter(
+            'bzz_db_queries_total', 'Database queries done by ModelHive routes.', ('resource', 'operation')
+        )
+        self.cache_requests = Counter(
+            'bzz_cache_requests_total', 'Instance and list cache lookups.', ('cache', 'result')
+        )
+        self.signal_duration = HistogramMetric(
+            'bzz_signal_receiver_duration_seconds', 'Duration of signal receivers.', ('signal', 'receiver'), buckets
+        )
+        self.token_decodes = Counter(
+            'bzz_auth_token_decodes_total', 'Authentication tokens decoded.', ('authenticated',)
+        )
+        self.metrics = [
+            self.requests, self.request_duration, self.queries,
+            self.cache_requests, self.signal_duration, self.token_decodes,
+        ]
+
+        if path is not None:
+            self.clear()
+
+    def install(self):
+        '''Starts measuring the signal receivers and counting the decoded
+        tokens (of every route, as signals are process-wide)'''
+        if self.on_signal_received not in signals.Signal.timers:
+            # a new list, so signals being sent keep the timers they started with
+            signals.Signal.timers = signals.Signal.timers + [self.on_signal_received]
+        signals.token_decoded.connect(self.on_token_decoded)
+
+    def uninstall(self):
+        signals.Signal.timers = [
+            timer for timer in signals.Signal.timers if timer != self.on_signal_received
+        ]
+        signals.token_decoded.disconnect(self.on_token_decoded)
+
+    def add_cache(self, name, cache):
+        '''Exports the hits and misses of `cache` (anything with a
+        `get_stats` method returning them) labeled with `name`'''
+        self.caches[id(cache)] = (name, cache)
+
+    def record_request(self, handler):
+        resource, method = handler.name, handler.request.method
+        self.requests.inc((resource, method, str(handler.get_status())))
+        self.request_duration.observe((resource, method), handler.request.request_time())
+
+        for operation, count in handler.query_counts.items():
+            self.queries.inc((resource, operation), count)
+
+    def on_signal_received(self, signal, receiver, duration):
+        self.signal_duration.observe((signal.name, get_receiver_name(receiver)), duration)
+
+    def on_token_decoded(self, sender, authenticated, handler=None):
+        self.token_decodes.inc((str(bool(authenticated)).lower(),))
+
+    def collect_caches(self):
+        self.cache_requests.values.clear()
+        for name, cache in self.caches.values():
+            stats = cache.get_stats()
+            self.cache_requests.inc((name, 'hit'), stats['hits'])
+            self.cache_requests.inc((name, 'miss'), stats['misses'])
+
+    def get_state(self):
+        '''Returns the metrics of this process, as saved for the others'''
+        self.collect_caches()
+        return dict((metric.name, metric.get_state()) for metric in self.metrics)
+
+    def clear(self):
+        '''Removes the metrics saved in `path`'''
+        for filename in glob.glob(os.path.join(self.path, '*.json')):
+            try:
+                os.remove(filename)
+            except OSError:
+                # removed by another process in the meantime
+                pass
+
+    def start(self, name=None):
+        '''Starts saving the metrics of this process (if `path` was given)'''
+        if self.path is None:
+            return
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+        if name is None:
+            name = str(os.getpid())
+
+        self.filename = os.path.join(self.path, '%s.json' % name)
+        self.save()
+        self.saver = PeriodicCallback(self.save, self.interval * 1000)
+        self.saver.start()
+
+    def stop(self):
+        if self.saver is not None:
+            self.saver.stop()
+            self.saver = None
+        self.save()
+
+    def save(self):
+        if self.filename is None:
+            return
+
+        # written aside and renamed, so other processes never read half of it
+        temporary = '%s.tmp' % self.filename
+        with open(temporary, 'w') as state_file:
+            state_file.write(utils.dumps(dict(self.get_state(), pid=os.getpid())))
+        os.rename(temporary, self.filename)
+
+    def get_states(self):
+        if self.filename is None:
+            return [self.get_state()]
+
+        self.save()
+
+        states = []
+        for filename in sorted(glob.glob(os.path.join(self.path, '*.json'))):
+            try:
+                with open(filename) as state_file:
+                    state = utils.loads(state_file.read())
+            except (IOError, ValueError):
+                logging.warning('Ignoring invalid metrics file %s' % filename)
+                continue
+
+            pid = state.get('pid', None)
+            if pid is not None and not is_process_alive(pid):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+
+            states.append(state)
+
+        return states
+
+    def render(self):
+        '''Returns the metrics (of all the processes) in the Prometheus text format'''
+        states = self.get_states()
+
+        lines = []
+        for metric in self.metrics:
+            merged = {}
+            for state in states:
+                metric.merge(merged, state.get(metric.name, []))
+
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.get_samples(merged))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHive(object):
+    @classmethod
+    def routes_for(cls, metrics, prefix='', path='/metrics'):
+        '''
+        Returns the route Prometheus scrapes the metrics from.
+
+        :param metrics: The metrics given to the ModelHive routes
+        :type metrics: bzz.metrics.Metrics
+        :param prefix: Optional argument to include a prefix route (i.e.: '/api');
+        :type prefix: string
+        :param path: Path of the route
+        :type path: string
+        :returns: route list (can be flattened with bzz.flatten)
+        '''
+        return core.RouteList([
+            (utils.add_prefix(prefix, '%s/?' % path.rstrip('/')), MetricsHandler, dict(metrics=metrics)),
+        ])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.metrics.render())
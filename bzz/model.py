@@ -8,11 +8,25 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
+import os
+import sys
+import stat
+import logging
+import hashlib
+import calendar
+import email.utils
+from datetime import datetime
+
+from six.moves import cPickle as pickle
 import tornado.web
 import tornado.gen as gen
-from six.moves.urllib.parse import unquote
 
 import bzz.core as core
+from bzz.cache import SingleFlight, get_auth_scope
+from bzz.feeds import ChangeFeedHandler, SubscriptionHandler
+from bzz.filters import compile_filters, FilterError
+from bzz.limits import LimitedHandler
+from bzz.timing import Timings, NULL_TIMINGS
 import bzz.signals as signals
 import bzz.utils as utils
 
@@ -22,10 +36,22 @@ AVAILABLE_PROVIDERS = {
     'sqlalchemy': 'bzz.providers.sqlalchemy_provider.SQLAlchemyProvider',
 }
 
+# model trees built in this process, by (provider class, model)
+TREE_CACHE = {}
+
+# argument that makes list routes created with `allow_explain` return the
+# query plans instead of the items
+EXPLAIN_ARGUMENT = '_explain'
+
 
 class ModelHive(object):
     @classmethod
-    def routes_for(cls, provider, model, prefix='', resource_name=None):
+    def routes_for(
+            cls, provider, model, prefix='', resource_name=None,
+            rate_limiter=None, concurrency_limiter=None, indexed_filters_only=False,
+            allow_explain=False, instance_cache=None, version_field=None, list_cache=None,
+            coalesce_reads=False, change_feed=None, server_timing=False, timing_sink=None,
+            metrics=None, unique_associations=False):
         '''
         Returns the list of routes for the specified model.
 
@@ -43,6 +69,32 @@ class ModelHive(object):
         :type prefix: string
         :param resource_name: an optional argument that can be specified to change the route name. If no resource_name specified the route name is the __class__.__name__ for the specified model with underscores instead of camel case.
         :type resource_name: string
+        :param rate_limiter: an optional rate limiter for the requests of each client (authenticated user or ip) to this route. Requests over the limit get a 429 status code with a Retry-After header.
+        :type rate_limiter: bzz.limits.RateLimiter
+        :param concurrency_limiter: an optional limiter for the number of requests this route processes at the same time. Requests over the limit get a 429 status code with a Retry-After header.
+        :type concurrency_limiter: bzz.limits.ConcurrencyLimiter
+        :param indexed_filters_only: if True, listing filtered or sorted by fields that are not indexed gets a 400 status code instead of scanning the collection.
+        :type indexed_filters_only: bool
+        :param allow_explain: if True, listing with `?_explain=1` returns the queries (and the database plans for them) that would be done instead of the items. Meant for debugging, as it exposes the queries to clients.
+        :type allow_explain: bool
+        :param instance_cache: an optional cache for the instances this route gets by id (the instance in the url and the ones referenced in request data).
+        :type instance_cache: bzz.cache.InstanceCache
+        :param version_field: an optional field (a version number or the update timestamp) that changes whenever instances change. GET responses get an `ETag` (and a `Last-Modified` header for timestamps) derived from it and clients sending `If-None-Match` or `If-Modified-Since` get a 304 status code without the instances being dumped.
+        :type version_field: string
+        :param list_cache: an optional cache for the responses of list requests, invalidated when instances of the model are created, updated or deleted.
+        :type list_cache: bzz.cache.ListCache
+        :param coalesce_reads: if True, concurrent requests for the same instance (by the same user, if the AuthHive is configured) share a single query and serialized response.
+        :type coalesce_reads: bool
+        :param change_feed: an optional change feed. If given, a `/<resource_name>/_changes` route streams the instances created, updated and deleted as server-sent events.
+        :type change_feed: bzz.feeds.ChangeFeed
+        :param server_timing: if True, responses get a `Server-Timing` header with the time spent parsing the url, sending signals, querying, dumping and serializing.
+        :type server_timing: bool
+        :param timing_sink: an optional sink recording the time spent in each of those phases (and in the whole request).
+        :type timing_sink: bzz.timing.HistogramSink or bzz.timing.StatsdSink
+        :param metrics: optional metrics counting the requests to this route, their durations and database queries (and the hits of its caches), exported by the `bzz.MetricsHive` route.
+        :type metrics: bzz.metrics.Metrics
+        :param unique_associations: if True, adding an item that is already in a list field doesn't add it again (`$addToSet` instead of `$push` in MongoDB).
+        :type unique_associations: bool
         :returns: route list (can be flattened with bzz.flatten)
 
         If you specify a prefix of '/api/' as well as resource_name of 'people' your route would be similar to:
@@ -91,8 +143,7 @@ class ModelHive(object):
            io_loop.add_timeout(1, create_user)
            io_loop.start()
         '''
-        provider_name = AVAILABLE_PROVIDERS.get(provider, provider)
-        provider_class = utils.get_class(provider_name)
+        provider_class = cls.get_provider_class(provider)
         name = resource_name
         if name is None:
             name = utils.convert(model.__name__)
@@ -101,23 +152,321 @@ class ModelHive(object):
 
         details_regex = utils.add_prefix(prefix, details_regex)
 
-        tree = provider_class.get_tree(model)
-
-        options = dict(model=model, name=name, prefix=prefix, tree=tree)
+        options = cls.get_options(
+            provider_class, model, name, prefix, rate_limiter=rate_limiter,
+            concurrency_limiter=concurrency_limiter, indexed_filters_only=indexed_filters_only,
+            allow_explain=allow_explain, instance_cache=instance_cache,
+            version_field=version_field, list_cache=list_cache,
+            read_flights=SingleFlight() if coalesce_reads else None,
+            server_timing=server_timing, timing_sink=timing_sink, metrics=metrics,
+            unique_associations=unique_associations
+        )
         routes = core.RouteList()
 
+        if change_feed is not None:
+            routes.append(cls.get_change_feed_route(change_feed, prefix, options))
+
         routes.append(
             (details_regex % name, provider_class, options)
         )
 
         return routes
 
+    @classmethod
+    def routes_for_many(
+            cls, provider, models, prefix='', resource_names=None,
+            rate_limiter=None, concurrency_limiter=None, indexed_filters_only=False,
+            allow_explain=False, instance_cache=None, version_field=None, list_cache=None,
+            coalesce_reads=False, change_feed=None, server_timing=False, timing_sink=None,
+            metrics=None, unique_associations=False):
+        '''
+        Returns a single route that serves all the specified models, with the same
+        operations `routes_for` supports. The model for each request is found with
+        a dict lookup on the first part of the url, instead of tornado trying the
+        route for each model in turn.
+
+        :param provider: The ORM provider to be used for these models
+        :type provider: Full-name provider or built-in provider
+        :param models: The models to be mapped
+        :type models: list of Class Types
+        :param prefix: Optional argument to include a prefix route (i.e.: '/api');
+        :type prefix: string
+        :param resource_names: an optional dict of model to route name. Models not in it get the same name `routes_for` would give them.
+        :type resource_names: dict
+        :param rate_limiter: an optional rate limiter shared by all the models (see `routes_for`).
+        :type rate_limiter: bzz.limits.RateLimiter
+        :param concurrency_limiter: an optional concurrency limiter shared by all the models (see `routes_for`).
+        :type concurrency_limiter: bzz.limits.ConcurrencyLimiter
+        :param indexed_filters_only: reject filters and sorting on fields that are not indexed (see `routes_for`).
+        :type indexed_filters_only: bool
+        :param allow_explain: allow `?_explain=1` in list requests (see `routes_for`).
+        :type allow_explain: bool
+        :param instance_cache: an optional instance cache shared by all the models (see `routes_for`).
+        :type instance_cache: bzz.cache.InstanceCache
+        :param version_field: the field used for conditional GET requests in all the models that have it (see `routes_for`).
+        :type version_field: string
+        :param list_cache: an optional list response cache shared by all the models (see `routes_for`).
+        :type list_cache: bzz.cache.ListCache
+        :param coalesce_reads: share queries and responses for concurrent requests for the same instance (see `routes_for`).
+        :type coalesce_reads: bool
+        :param change_feed: an optional change feed, streamed in a `_changes` route for each model (see `routes_for`).
+        :type change_feed: bzz.feeds.ChangeFeed
+        :param server_timing: add a `Server-Timing` header to the responses (see `routes_for`).
+        :type server_timing: bool
+        :param timing_sink: an optional sink for the timings of the requests to all the models (see `routes_for`).
+        :type timing_sink: bzz.timing.HistogramSink or bzz.timing.StatsdSink
+        :param metrics: optional metrics for the requests to all the models (see `routes_for`).
+        :type metrics: bzz.metrics.Metrics
+        :param unique_associations: don't add items already in list fields again (see `routes_for`).
+        :type unique_associations: bool
+        :returns: route list (can be flattened with bzz.flatten)
+
+        Usage::
+
+            routes = bzz.ModelHive.routes_for_many('mongoengine', [User, Team], prefix='/api')
+            # serves /api/user/... and /api/team/...
+        '''
+        provider_class = cls.get_provider_class(provider)
+        if resource_names is None:
+            resource_names = {}
+
+        read_flights = SingleFlight() if coalesce_reads else None
+
+        resources = {}
+        for model in models:
+            name = resource_names.get(model, None)
+            if name is None:
+                name = utils.convert(model.__name__)
+
+            resources[name] = cls.get_options(
+                provider_class, model, name, prefix, rate_limiter=rate_limiter,
+                concurrency_limiter=concurrency_limiter, indexed_filters_only=indexed_filters_only,
+                allow_explain=allow_explain, instance_cache=instance_cache,
+                version_field=version_field, list_cache=list_cache, read_flights=read_flights,
+                server_timing=server_timing, timing_sink=timing_sink, metrics=metrics,
+                unique_associations=unique_associations
+            )
+
+        # any first part matches, prepare looks it up and answers 404 to unknown resources
+        details_regex = utils.add_prefix(prefix, r'/([^/]+(?:/[^/]+)?)((?:/[^/]+)*)/?')
+
+        routes = core.RouteList()
+
+        if change_feed is not None:
+            for name, options in sorted(resources.items()):
+                routes.append(cls.get_change_feed_route(change_feed, prefix, options))
+
+        routes.append(
+            (details_regex, provider_class, dict(resources=resources))
+        )
+
+        return routes
+
+    @classmethod
+    def get_change_feed_route(cls, change_feed, prefix, options):
+        name = options['name']
+        change_feed.register(name, options['model'], options['tree'])
+
+        return (
+            utils.add_prefix(prefix, r'/%s/_changes/?' % name),
+            ChangeFeedHandler, dict(
+                feed=change_feed, model=options['model'], name=name,
+                rate_limiter=options['rate_limiter'], concurrency_limiter=change_feed.stream_limiter
+            )
+        )
+
+    @classmethod
+    def routes_for_subscriptions(cls, change_feed, prefix='', coalesce_delay=0.05, max_subscriptions=100):
+        '''
+        Returns the route for a websocket that lets clients subscribe to the
+        changes to instances or to filtered lists of the models whose routes
+        were created with `change_feed`.
+
+        :param change_feed: The change feed given to `routes_for`
+        :type change_feed: bzz.feeds.ChangeFeed
+        :param prefix: Optional argument to include a prefix route (i.e.: '/api');
+        :type prefix: string
+        :param coalesce_delay: Seconds the changes are held for, so the successive changes to an instance are sent as one.
+        :type coalesce_delay: float
+        :param max_subscriptions: Maximum number of subscriptions of each client.
+        :type max_subscriptions: int
+        :returns: route list (can be flattened with bzz.flatten)
+
+        Usage::
+
+            feed = ChangeFeed()
+            routes = bzz.flatten([
+                bzz.ModelHive.routes_for_subscriptions(feed, prefix='/api'),
+                bzz.ModelHive.routes_for('mongoengine', User, prefix='/api', change_feed=feed),
+            ])
+            # clients connect to ws://myserver/api/_subscriptions
+        '''
+        return core.RouteList([
+            (utils.add_prefix(prefix, r'/_subscriptions/?'), SubscriptionHandler, dict(
+                feed=change_feed, coalesce_delay=coalesce_delay, max_subscriptions=max_subscriptions
+            ))
+        ])
+
+    @classmethod
+    def get_provider_class(cls, provider):
+        provider_name = AVAILABLE_PROVIDERS.get(provider, provider)
+        return utils.get_class(provider_name)
+
+    @classmethod
+    def get_options(cls, provider_class, model, name, prefix, **options):
+        metrics = options.get('metrics', None)
+        if metrics is not None:
+            for cache_name in ['instance_cache', 'list_cache']:
+                if options.get(cache_name, None) is not None:
+                    metrics.add_cache(cache_name.replace('_cache', ''), options[cache_name])
+
+        return dict(
+            model=model, name=name, prefix=prefix,
+            tree=provider_class.get_tree(model),
+            **options
+        )
+
+    @classmethod
+    def before_fork(cls, application):
+        '''
+        Prepares the providers of the routes created so far to be forked (see
+        `ModelProvider.before_fork`). `bzz.cli` calls it before forking.
+
+        :param application: The application about to be served
+        :type application: tornado.web.Application
+        '''
+        for provider_class in set(provider_class for provider_class, model in TREE_CACHE):
+            provider_class.before_fork(application)
+
+    @classmethod
+    def save_trees(cls, path):
+        '''
+        Saves the model trees built so far (by `routes_for`) to the file in
+        `path`, so other processes can load them with `load_trees` instead of
+        inspecting the models again. Trees for models that can't be pickled
+        (i.e.: declared inside functions) are skipped.
+
+        The file is pickled, so it is created readable and writable only by
+        the current user. Keep it in a directory other users can't write to.
+
+        :param path: Path of the file to write
+        :type path: string
+        '''
+        trees = {}
+        for (provider_class, model), tree in TREE_CACHE.items():
+            try:
+                trees[(provider_class, model)] = pickle.dumps(
+                    (provider_class.get_tree_signature(tree), tree),
+                    pickle.HIGHEST_PROTOCOL
+                )
+            except (pickle.PicklingError, AttributeError, TypeError):
+                logging.debug('Could not pickle the tree for %s.' % model.__name__)
+
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'wb') as tree_file:
+            pickle.dump(trees, tree_file, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load_trees(cls, path):
+        '''
+        Loads model trees saved with `save_trees`. Call it before `routes_for`.
+        Trees for models that changed since they were saved are ignored (and
+        built again when needed).
+
+        Loading a pickled file runs code, so files owned by other users or
+        writable by them are not loaded.
+
+        :param path: Path of the file to read
+        :type path: string
+        :returns: number of trees loaded
+        '''
+        if not cls.is_private_file(path):
+            logging.warning('Not loading model trees from %s, as other users can write to it.' % path)
+            return 0
+
+        with open(path, 'rb') as tree_file:
+            trees = pickle.load(tree_file)
+
+        loaded = 0
+        for (provider_class, model), data in trees.items():
+            signature, tree = pickle.loads(data)
+            if signature != provider_class.get_tree_signature(tree):
+                continue
+
+            TREE_CACHE[(provider_class, model)] = tree
+            loaded += 1
+
+        return loaded
+
+    @classmethod
+    def is_private_file(cls, path):
+        file_stat = os.stat(path)
+        if file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+
+        return not hasattr(os, 'getuid') or file_stat.st_uid == os.getuid()
+
+
+class ModelProvider(LimitedHandler, tornado.web.RequestHandler):
+    @classmethod
+    def get_type_name(cls, obj):
+        '''Returns the dotted name of a class or function (or None)'''
+        if obj is None:
+            return None
+        return '%s.%s' % (obj.__module__, obj.__name__)
+
+    @classmethod
+    def get_field_signature(cls, field):
+        '''
+        Returns what the node of `field` in the model trees is built from.
+        Providers extend it with the options of their fields that change how
+        they are stored or validated.
+        '''
+        return [
+            cls.get_type_name(field.__class__),
+            cls.get_type_name(cls.get_model(field)),
+            cls.is_list_field(field),
+            cls.get_field_target_name(field),
+            cls.allows_create_on_associate(field),
+            cls.is_lazy_loaded(field),
+            cls.get_type_name(cls.get_field_coercer(field)),
+        ]
+
+    @classmethod
+    def get_model_signature(cls, model):
+        '''Returns the signatures of the fields of `model` and its indexes'''
+        fields = sorted(
+            (name, cls.get_field_signature(field))
+            for name, field in cls.get_model_fields(model).items()
+        )
+        return [fields, sorted(cls.get_indexed_paths(model))]
+
+    @classmethod
+    def get_tree_signature(cls, tree):
+        '''Returns the signatures of all the models in `tree`, which change
+        whenever a field of any of them is added, removed or changed, or
+        their indexes change'''
+        return sorted(
+            (cls.get_type_name(model), cls.get_model_signature(model))
+            for model in tree.classes
+        )
 
-class ModelProvider(tornado.web.RequestHandler):
     @classmethod
     def get_tree(cls, model, node=None):
+        '''
+        Returns the tree of fields for the given model. Trees are built once
+        per process and shared: a model referenced by others has its tree
+        reused instead of being inspected again.
+        '''
         if node is None:
-            node = core.Node(cls.get_model_name(model), is_root=True)
+            tree = TREE_CACHE.get((cls, model), None)
+            if tree is not None:
+                return tree
+
+            node = cls.get_tree(model, core.Node(cls.get_model_name(model), is_root=True))
+            node.indexes = cls.get_indexed_paths(model)
+            TREE_CACHE[(cls, model)] = node
+            return node
 
         node.add_to_cache(model, node)
 
@@ -134,51 +483,191 @@ class ModelProvider(tornado.web.RequestHandler):
         return node
 
     @classmethod
-    def parse_children(cls, model, collection, root_node):
+    def parse_children(cls, model, collection, root_node, path=''):
         for field_name, field in cls.get_model_fields(model).items():
             model = cls.get_model(field)
 
             child_node = core.Node(field_name)
             collection[field_name] = child_node
 
+            child_path = field_name
+            if path:
+                child_path = '%s.%s' % (path, field_name)
+            root_node.add_to_index(child_path, child_node)
+
             child_node.is_multiple = cls.is_list_field(field)
             child_node.target_name = cls.get_field_target_name(field)
             child_node.allows_create_on_associate = \
                 cls.allows_create_on_associate(field)
             child_node.is_lazy_loaded = \
                 cls.is_lazy_loaded(field)
+            child_node.coerce = cls.get_field_coercer(field)
 
             child_node.model_type = model
 
             if child_node.model_type is not None:
                 cached_node = root_node.find_by_class(model)
-                if cached_node is None:
+                shared_tree = TREE_CACHE.get((cls, model), None)
+                if cached_node is not None:
+                    child_node.children = cached_node.children
+                elif shared_tree is not None:
+                    child_node.children = shared_tree.children
                     root_node.add_to_cache(model, child_node)
-                    cls.parse_children(child_node.model_type, child_node.children, root_node)
+                    root_node.merge_classes(shared_tree)
                 else:
-                    child_node.children = cached_node.children
+                    root_node.add_to_cache(model, child_node)
+                    cls.parse_children(child_node.model_type, child_node.children, root_node, child_path)
+
+    @classmethod
+    def get_field_coercer(cls, field):
+        '''
+        Returns a callable that converts request values to the type of
+        `field` (raising `ValueError` or `TypeError` for invalid values) or
+        None to keep values as they come. Coercers are stored in the model
+        tree, so they must be picklable (module level functions or types).
+        '''
+        return None
+
+    @classmethod
+    def get_indexed_paths(cls, model):
+        '''
+        Returns the set of dotted paths of the fields of `model` that can be
+        filtered and sorted by without scanning the whole collection.
+        '''
+        return set()
+
+    @classmethod
+    def before_fork(cls, application):
+        '''
+        Called in the parent process before forking the processes that serve
+        `application`. Providers close the database connections opened so far
+        here, as they can't be shared among processes.
+        '''
+
+    @gen.coroutine
+    def explain_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        '''
+        Returns the queries (and the database plans for them) `get_list`
+        would do, for routes created with `allow_explain`. Providers that
+        can't explain their queries refuse to, with a 400 status code.
+        '''
+        raise FilterError('%s can not explain list queries' % self.__class__.__name__)
 
     def get_node(self, path):
-        if '.' not in path:
-            return self.tree.get(path, None)
+        return self.tree.find_by_path(path)
 
-        node = self.tree
-        for item in path.split('.'):
-            node = node.get(item, None)
-            if node is None:
-                return None
+    def is_instance_cached(self, model, instance_id):
+        if self.instance_cache is None or not instance_id or isinstance(instance_id, (list, tuple)):
+            return False
 
-        return node
+        return self.instance_cache.is_enabled(model)
+
+    def get_cached_instance(self, model, instance_id):
+        '''
+        Returns the instance of `model` with `instance_id` from the instance
+        cache (if this route has one) or None. Providers call it in
+        `get_instance` before querying the database.
+        '''
+        if not self.is_instance_cached(model, instance_id):
+            return None
+
+        payload = self.instance_cache.get(model, instance_id)
+        if payload is None:
+            return None
 
-    def initialize(self, model, name, prefix, tree):
+        return self.deserialize_instance(model, payload)
+
+    def cache_instance(self, model, instance_id, instance):
+        if instance is None or not self.is_instance_cached(model, instance_id):
+            return
+
+        self.instance_cache.set(model, instance_id, self.serialize_instance(instance))
+
+    def invalidate_cached_instance(self, model, instance_id):
+        '''Removes the instance from the instance cache. Providers call it
+        whenever they change an instance.'''
+        if self.instance_cache is None or instance_id is None:
+            return
+
+        self.instance_cache.invalidate(model, instance_id)
+
+    def serialize_instance(self, instance):
+        '''Returns a picklable representation of `instance` for the cache'''
+        return instance
+
+    def deserialize_instance(self, model, payload):
+        return payload
+
+    def initialize(
+            self, model=None, name=None, prefix=None, tree=None,
+            rate_limiter=None, concurrency_limiter=None, resources=None,
+            indexed_filters_only=False, allow_explain=False, instance_cache=None,
+            version_field=None, list_cache=None, read_flights=None,
+            server_timing=False, timing_sink=None, metrics=None, unique_associations=False):
+        self.resources = resources
         self.model = model
         self.name = name
         self.prefix = prefix
         self.tree = tree
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.indexed_filters_only = indexed_filters_only
+        self.allow_explain = allow_explain
+        self.instance_cache = instance_cache
+        self.version_field = version_field
+        self.list_cache = list_cache
+        self.read_flights = read_flights
+        self.server_timing = server_timing
+        self.timing_sink = timing_sink
+        self.metrics = metrics
+        self.unique_associations = unique_associations
+        self.timings = NULL_TIMINGS
+        if server_timing or timing_sink is not None or metrics is not None:
+            self.timings = Timings()
+        self.holds_concurrency_slot = False
+        self.request_data = None
+        self.query_counts = {}
+
+    def count_query(self, operation):
+        '''Called by the providers before each database query they run (see
+        bzz.metrics.Metrics)'''
+        self.query_counts[operation] = self.query_counts.get(operation, 0) + 1
+
+    def prepare(self):
+        if self.resources is not None:
+            options = self.resources.get(self.path_args[0].split('/')[0], None)
+            if options is None:
+                self.send_error(status_code=404)
+                return
+
+            self.initialize(resources=self.resources, **options)
+
+        self.acquire_limits()
+
+    def finish(self, chunk=None):
+        if self.timings.enabled:
+            self.timings.add('total', self.request.request_time())
+            if self.server_timing:
+                self.set_header('Server-Timing', self.timings.get_header())
+
+        return super(ModelProvider, self).finish(chunk)
+
+    def on_finish(self):
+        self.release_concurrency_slot()
+
+        if self.timing_sink is not None:
+            self.timing_sink.record(self.name, self.request.method, self.timings.get_spans())
+
+        if self.metrics is not None:
+            self.metrics.record_request(self)
+
+    def on_connection_close(self):
+        self.release_concurrency_slot()
 
     def write_json(self, obj):
-        self.set_header("Content-Type", "application/json")
-        self.write(utils.dumps(obj))
+        with self.timings.span('write_json'):
+            self.set_header("Content-Type", "application/json")
+            self.write(utils.dumps(obj))
 
     def parse_arguments(self, args):
         args = [arg.lstrip('/') for arg in args if arg]
@@ -206,20 +695,29 @@ class ModelProvider(tornado.web.RequestHandler):
 
     @gen.coroutine
     def get(self, *args, **kwargs):
-        args = self.parse_arguments(args)
+        with self.timings.span('parse_arguments'):
+            args = self.parse_arguments(args)
         path = self.get_path_from_args(args)
         node = self.tree.find_by_path(path)
 
         if (node.is_root or node.is_multiple) and '/' not in args[-1]:
-            yield signals.pre_get_list.send(node.model_type, arguments=args, handler=self)
+            with self.timings.span('signals'):
+                yield signals.pre_get_list.send(node.model_type, arguments=args, handler=self)
             yield self.handle_get_list(args)
         else:
-            yield signals.pre_get_instance.send(node.model_type, arguments=args, handler=self)
+            with self.timings.span('signals'):
+                yield signals.pre_get_instance.send(node.model_type, arguments=args, handler=self)
             yield self.handle_get_one(args)
 
     @gen.coroutine
     def handle_get_one(self, args):
-        success, obj, parent = yield self.get_instance_from_args(args)
+        # instances of models with a get_instance_queryset may be filtered per request
+        if self.read_flights is not None and len(args) == 1 and not hasattr(self.model, 'get_instance_queryset'):
+            yield self.handle_coalesced_get_one(args)
+            return
+
+        with self.timings.span('get_instance'):
+            success, obj, parent = yield self.get_instance_from_args(args)
         if not success:
             return
 
@@ -227,11 +725,53 @@ class ModelProvider(tornado.web.RequestHandler):
             self.send_error(status_code=404)
             return
 
-        yield signals.post_get_instance.send(obj.__class__, instance=obj, handler=self)
+        with self.timings.span('signals'):
+            yield signals.post_get_instance.send(obj.__class__, instance=obj, handler=self)
+
+        if self.is_not_modified([(args[-1], self.get_instance_version(obj))]):
+            self.send_not_modified()
+            return
+
+        with self.timings.span('dump_instance'):
+            data = self.dump_instance(obj)
+        self.write_json(data)
+        self.finish()
+
+    @gen.coroutine
+    def handle_coalesced_get_one(self, args):
+        key = (self.model, args[0], get_auth_scope(self))
+        obj, response = yield self.read_flights.run(key, lambda: self.dump_instance_response(args))
+
+        if obj is None:
+            self.send_error(status_code=404)
+            return
+
+        if self.is_not_modified([(args[-1], self.get_instance_version(obj))]):
+            self.send_not_modified()
+            return
 
-        self.write_json(self.dump_instance(obj))
+        with self.timings.span('write_json'):
+            self.set_header("Content-Type", "application/json")
+            self.write(response)
         self.finish()
 
+    @gen.coroutine
+    def dump_instance_response(self, args):
+        '''Returns the instance in `args` and its serialized response. The
+        `post_get_instance` signal is sent before dumping it (once, as the
+        response is shared by the coalesced requests).'''
+        with self.timings.span('get_instance'):
+            success, obj, parent = yield self.get_instance_from_args(args)
+        if obj is None:
+            raise gen.Return((None, None))
+
+        with self.timings.span('signals'):
+            yield signals.post_get_instance.send(obj.__class__, instance=obj, handler=self)
+
+        with self.timings.span('dump_instance'):
+            response = utils.dumps(self.dump_instance(obj))
+        raise gen.Return((obj, response))
+
     @gen.coroutine
     def handle_get_list(self, args):
         if '/' not in args[0] and len(args) > 1:
@@ -251,21 +791,145 @@ class ModelProvider(tornado.web.RequestHandler):
             except ValueError:
                 per_page = 20
 
-            items = yield self.get_list(page=page, per_page=per_page, filters=request_data)
+            explain = False
+            if self.allow_explain:
+                explain = request_data.pop(EXPLAIN_ARGUMENT, None) not in (None, '0', 'false')
+
+            try:
+                filters, sort = self.get_filters(request_data)
+                if explain:
+                    plan = yield self.explain_list(page=page, per_page=per_page, filters=filters, sort=sort)
+                elif self.is_list_cached():
+                    key = self.list_cache.get_key(self.model, self, page, per_page, filters, sort)
+                    response = yield self.list_cache.get_or_create(
+                        key, lambda: self.dump_list_response(page, per_page, filters, sort)
+                    )
+                else:
+                    with self.timings.span('get_list'):
+                        items = yield self.get_list(page=page, per_page=per_page, filters=filters, sort=sort)
+            except FilterError:
+                self.set_status(400)
+                self.write(str(sys.exc_info()[1]))
+                return
+
+            if explain:
+                self.write_json(plan)
+                self.finish()
+                return
+
+            if self.is_list_cached():
+                with self.timings.span('write_json'):
+                    self.set_header("Content-Type", "application/json")
+                    self.write(response)
+                self.finish()
+                return
+
             model_type = self.model
         else:
-            success, items, parent = yield self.get_instance_from_args(args)
+            with self.timings.span('get_list'):
+                success, items, parent = yield self.get_instance_from_args(args)
             if not success:
                 self.send_error(status_code=400)
                 return
 
             model_type = self.get_property_model(parent, args[-1])
 
-        yield signals.post_get_list.send(model_type, items=items, handler=self)
+        with self.timings.span('signals'):
+            yield signals.post_get_list.send(model_type, items=items, handler=self)
 
-        self.write_json(self.dump_list(items))
+        versions = yield self.get_list_versions(items)
+        if self.is_not_modified(versions):
+            self.send_not_modified()
+            return
+
+        with self.timings.span('dump_list'):
+            data = self.dump_list(items)
+        self.write_json(data)
         self.finish()
 
+    def is_list_cached(self):
+        return self.list_cache is not None and self.list_cache.is_enabled(self.model)
+
+    @gen.coroutine
+    def dump_list_response(self, page, per_page, filters, sort):
+        '''Returns the serialized list response to be cached'''
+        with self.timings.span('get_list'):
+            items = yield self.get_list(page=page, per_page=per_page, filters=filters, sort=sort)
+        with self.timings.span('signals'):
+            yield signals.post_get_list.send(self.model, items=items, handler=self)
+        with self.timings.span('dump_list'):
+            response = utils.dumps(self.dump_list(items))
+        raise gen.Return(response)
+
+    def get_instance_version(self, instance):
+        '''Returns the value of the `version_field` of the instance (or None)'''
+        if self.version_field is None or instance is None:
+            return None
+
+        return getattr(instance, self.version_field, None)
+
+    @gen.coroutine
+    def get_list_versions(self, items):
+        '''Returns the (id, version) of each item or None if any of them has
+        no version'''
+        if self.version_field is None:
+            raise gen.Return(None)
+
+        versions = []
+        for item in items:
+            version = self.get_instance_version(item)
+            if version is None:
+                raise gen.Return(None)
+
+            instance_id = yield self.get_instance_id(item)
+            versions.append((instance_id, version))
+
+        raise gen.Return(versions)
+
+    def is_not_modified(self, versions):
+        '''
+        Sets the `ETag` header (and `Last-Modified` if the versions are
+        timestamps) for the response with the given list of (id, version)
+        and returns True if the client already has the same response.
+
+        Without versions nothing is done here and tornado still compares
+        `If-None-Match` against the hash of the body when finishing.
+        '''
+        if versions is None or any(version is None for instance_id, version in versions):
+            return False
+
+        key = u'|'.join(u'%s:%s' % (instance_id, version) for instance_id, version in versions)
+        self.set_header('Etag', 'W/"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+        last_modified = None
+        if versions and all(isinstance(version, datetime) for instance_id, version in versions):
+            last_modified = max(version for instance_id, version in versions)
+            self.set_header('Last-Modified', last_modified)
+
+        if self.request.headers.get('If-None-Match') is not None:
+            return self.check_etag_header()
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if last_modified is None or if_modified_since is None:
+            return False
+
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed is None:
+            return False
+
+        return calendar.timegm(last_modified.utctimetuple()) <= email.utils.mktime_tz(parsed)
+
+    def send_not_modified(self):
+        self.set_status(304)
+        self.finish()
+
+    def get_filters(self, arguments):
+        '''
+        Compiles the list arguments into `bzz.filters.Filter` objects and the
+        sort order. Raises `bzz.filters.FilterError` for invalid filters.
+        '''
+        return compile_filters(self.tree, arguments, indexed_only=self.indexed_filters_only)
+
     @gen.coroutine
     def get_instance_from_args(self, args):
         model, pk = args[0].split('/')
@@ -308,14 +972,16 @@ class ModelProvider(tornado.web.RequestHandler):
 
     @gen.coroutine
     def post(self, *args, **kwargs):
-        args = self.parse_arguments(args)
+        with self.timings.span('parse_arguments'):
+            args = self.parse_arguments(args)
         model_type = yield self.get_model_from_path(args)
 
-        yield signals.pre_create_instance.send(
-            model_type,
-            arguments=args,
-            handler=self,
-        )
+        with self.timings.span('signals'):
+            yield signals.pre_create_instance.send(
+                model_type,
+                arguments=args,
+                handler=self,
+            )
 
         instance = None
 
@@ -338,11 +1004,12 @@ class ModelProvider(tornado.web.RequestHandler):
             self.write(str(error))
             return
 
-        yield signals.post_create_instance.send(
-            instance.__class__,
-            instance=instance,
-            handler=self
-        )
+        with self.timings.span('signals'):
+            yield signals.post_create_instance.send(
+                instance.__class__,
+                instance=instance,
+                handler=self
+            )
         pk = yield self.get_instance_id(instance)
         self.set_header('X-Created-Id', pk)
         self.set_header('location', '/%s%s/%s/' % (
@@ -350,23 +1017,39 @@ class ModelProvider(tornado.web.RequestHandler):
             self.name,
             pk
         ))
-        self.write_json(self.dump_instance(instance))
+        with self.timings.span('dump_instance'):
+            data = self.dump_instance(instance)
+        self.write_json(data)
 
     @gen.coroutine
     def handle_create_one(self, args):
-        instance, error = yield self.save_new_instance(self.model, self.get_request_data())
+        try:
+            data = self.coerce_data(self.tree, self.get_request_data())
+        except core.CoercionError:
+            raise gen.Return((None, (400, sys.exc_info()[1])))
+
+        with self.timings.span('save_instance'):
+            instance, error = yield self.save_new_instance(self.model, data)
         raise gen.Return((instance, error))
 
     @gen.coroutine
     def handle_create_and_associate(self, args):
         path, pk = args[0].split('/')
-        root = yield self.get_instance(pk)
+        with self.timings.span('get_instance'):
+            root = yield self.get_instance(pk)
         model_type = self.get_model_type(root, args[1:])
-        instance, error = yield self.save_new_instance(model_type, self.get_request_data())
+        try:
+            data = self.coerce_data(self.get_tree(model_type), self.get_request_data())
+        except core.CoercionError:
+            raise gen.Return((None, (400, sys.exc_info()[1])))
+
+        with self.timings.span('save_instance'):
+            instance, error = yield self.save_new_instance(model_type, data)
         if error is not None:
             raise gen.Return((None, error))
 
-        _, error = yield self.associate_instance(root, args[-1], instance)
+        with self.timings.span('update_instance'):
+            _, error = yield self.associate_instance(root, args[-1], instance)
         if error is not None:
             raise gen.Return((None, error))
 
@@ -375,16 +1058,25 @@ class ModelProvider(tornado.web.RequestHandler):
     @gen.coroutine
     def handle_find_and_associate(self, args):
         path, pk = args[0].split('/')
-        root = yield self.get_instance(pk)
+        with self.timings.span('get_instance'):
+            root = yield self.get_instance(pk)
 
-        _, parent = yield self.get_instance_property(root, args[1:])
+        parent = root
+        if len(args) > 2:
+            _, parent = yield self.get_instance_property(root, args[1:])
         request_data = self.get_request_data()
         model_type = self.get_property_model(parent, args[-1])
         key = "%s[]" % args[-1]
-        value = request_data[key]
-        instance = yield self.get_instance(value, model=model_type)
-
-        _, error = yield self.associate_instance(root, args[-1], instance)
+        try:
+            node = self.get_tree(parent.__class__).find_by_path(args[-1])
+            value = self.coerce_value(node, request_data[key], key)
+        except core.CoercionError:
+            raise gen.Return((None, (400, sys.exc_info()[1])))
+        with self.timings.span('get_instance'):
+            instance = yield self.get_instance(value, model=model_type)
+
+        with self.timings.span('update_instance'):
+            _, error = yield self.associate_instance(root, args[-1], instance)
         if error is not None:
             raise gen.Return((None, error))
 
@@ -399,14 +1091,16 @@ class ModelProvider(tornado.web.RequestHandler):
 
     @gen.coroutine
     def put(self, *args, **kwargs):
-        args = self.parse_arguments(args)
+        with self.timings.span('parse_arguments'):
+            args = self.parse_arguments(args)
         model_type = yield self.get_model_from_path(args)
 
-        yield signals.pre_update_instance.send(
-            model_type,
-            arguments=args,
-            handler=self
-        )
+        with self.timings.span('signals'):
+            yield signals.pre_update_instance.send(
+                model_type,
+                arguments=args,
+                handler=self
+            )
 
         instance = None
 
@@ -421,13 +1115,15 @@ class ModelProvider(tornado.web.RequestHandler):
             return
 
         instance, updated, model = yield self.handle_update(args)
-        yield signals.post_update_instance.send(model, instance=instance, updated_fields=updated, handler=self)
+        with self.timings.span('signals'):
+            yield signals.post_update_instance.send(model, instance=instance, updated_fields=updated, handler=self)
         self.write('OK')
 
     @gen.coroutine
     def handle_update(self, args):
         path, pk = args[0].split('/')
-        root = yield self.get_instance(pk)
+        with self.timings.span('get_instance'):
+            root = yield self.get_instance(pk)
         model_type = root.__class__
         instance = parent = None
 
@@ -439,7 +1135,20 @@ class ModelProvider(tornado.web.RequestHandler):
             instance, parent = yield self.get_instance_property(root, args[1:])
             model_type = instance.__class__
             property_name, pk = args[-1].split('/')
-        error, instance, updated = yield self.update_instance(pk, self.get_request_data(), model_type, instance, parent)
+
+        try:
+            data = self.coerce_data(self.get_tree(model_type), self.get_request_data())
+        except core.CoercionError:
+            self.set_status(400)
+            self.write(str(sys.exc_info()[1]))
+            raise tornado.web.Finish()
+
+        with self.timings.span('update_instance'):
+            error, instance, updated = yield self.update_instance(pk, data, model_type, instance, parent)
+
+        if len(args) > 1:
+            # inner properties are saved through their parents
+            self.invalidate_cached_instance(root.__class__, args[0].split('/')[1])
 
         if error is not None:
             status_code, error = error
@@ -449,6 +1158,78 @@ class ModelProvider(tornado.web.RequestHandler):
 
         raise gen.Return([instance, updated, model_type])
 
+    @gen.coroutine
+    def patch(self, *args, **kwargs):
+        '''
+        Partially updates an instance with a single atomic update (`$set` in
+        MongoDB, `UPDATE ... WHERE` in SQL databases) without loading it.
+
+        Receivers of `post_update_instance` get `instance=None` and only the
+        new values (`{'field': {'to': value}}`) in `updated_fields`.
+        Updates to inner properties are done as in PUT.
+        '''
+        with self.timings.span('parse_arguments'):
+            parsed_args = self.parse_arguments(args)
+        if len(parsed_args) > 1:
+            yield self.put(*args, **kwargs)
+            return
+
+        if '/' not in parsed_args[0]:
+            self.send_error(400)
+            return
+
+        model_type = self.model
+        with self.timings.span('signals'):
+            yield signals.pre_update_instance.send(
+                model_type,
+                arguments=parsed_args,
+                handler=self
+            )
+
+        if not self.validate_update_request_data(None, model_type):
+            self.send_error(400, reason="Invalid multiple field")
+            return
+
+        try:
+            data = self.coerce_data(self.tree, self.get_request_data())
+        except core.CoercionError:
+            self.set_status(400)
+            self.write(str(sys.exc_info()[1]))
+            return
+
+        path, pk = parsed_args[0].split('/')
+        with self.timings.span('update_instance'):
+            error, updated = yield self.partial_update_instance(pk, data, model_type)
+
+        if error is not None:
+            status_code, error = error
+            self.set_status(status_code)
+            self.write(str(error))
+            return
+
+        with self.timings.span('signals'):
+            yield signals.post_update_instance.send(model_type, instance=None, updated_fields=updated, handler=self)
+        self.write('OK')
+
+    def get_update_paths(self, data, prefix='', paths=None):
+        '''
+        Flattens nested objects in `data` into dotted paths, so embedded
+        documents are partially updated instead of replaced.
+        '''
+        if paths is None:
+            paths = {}
+
+        for key, value in data.items():
+            if prefix:
+                key = '%s.%s' % (prefix, key)
+
+            if isinstance(value, dict):
+                self.get_update_paths(value, key, paths)
+            else:
+                paths[key] = value
+
+        return paths
+
     def validate_update_request_data(self, root, model_type):
         data = self.get_request_data()
 
@@ -460,25 +1241,38 @@ class ModelProvider(tornado.web.RequestHandler):
 
     @gen.coroutine
     def delete(self, *args, **kwargs):
-        args = self.parse_arguments(args)
+        with self.timings.span('parse_arguments'):
+            args = self.parse_arguments(args)
 
         if len(args) == 1 and '/' not in args[0]:
             self.send_error(400)
             return
 
         model_type = yield self.get_model_from_path(args)
-        yield signals.pre_delete_instance.send(model_type, arguments=args, handler=self)
+        with self.timings.span('signals'):
+            yield signals.pre_delete_instance.send(model_type, arguments=args, handler=self)
 
         path, pk = args[0].split('/')
-        root = yield self.get_instance(pk)
+        with self.timings.span('get_instance'):
+            root = yield self.get_instance(pk)
         instance = None
 
         if len(args) > 1:
-            instance, parent = yield self.get_instance_property(root, args[1:])
             property_name, pk = args[-1], None
             if '/' in property_name:
                 property_name, pk = property_name.split('/')
+
+            node = self.tree.find_by_path(property_name)
+            if len(args) == 2 and pk is not None and node is not None and node.is_multiple and node.is_lazy_loaded:
+                # loads only the referenced instance instead of the whole list
+                parent = root
+                with self.timings.span('get_instance'):
+                    instance = yield self.get_instance(pk, model=node.model_type)
+            else:
+                instance, parent = yield self.get_instance_property(root, args[1:])
+
             instance, error = yield self.handle_delete_association(parent, instance, property_name)
+            self.invalidate_cached_instance(self.model, args[0].split('/')[1])
         else:
             instance = yield self.handle_delete_instance(pk)
             error = None
@@ -490,14 +1284,16 @@ class ModelProvider(tornado.web.RequestHandler):
             return
 
         if instance:
-            yield signals.post_delete_instance.send(model_type, instance=instance, handler=self)
+            with self.timings.span('signals'):
+                yield signals.post_delete_instance.send(model_type, instance=instance, handler=self)
             self.write('OK')
         else:
             self.write('FAIL')
 
     @gen.coroutine
     def handle_delete_instance(self, pk):
-        instance = yield self.delete_instance(pk)
+        with self.timings.span('delete_instance'):
+            instance = yield self.delete_instance(pk)
         raise gen.Return(instance)
 
     @gen.coroutine
@@ -505,17 +1301,18 @@ class ModelProvider(tornado.web.RequestHandler):
         fields = self.get_model_fields(parent.__class__)
         field = fields.get(property_name)
         if self.is_list_field(field):
-            property_list = getattr(parent, property_name, [])
+            if instance is None or isinstance(instance, (list, tuple)):
+                # no item in the list has the given id
+                raise gen.Return((None, (400, 'Not Associated')))
 
-            try:
-                property_list.remove(instance)
-            except ValueError:
-                self.send_error(400)
-                return
-        else:
-            setattr(parent, property_name, None)
+            with self.timings.span('update_instance'):
+                result = yield self.remove_from_list(parent, property_name, instance)
+            raise gen.Return(result)
+
+        setattr(parent, property_name, None)
 
-        _, error = yield self.save_instance(parent)
+        with self.timings.span('update_instance'):
+            _, error = yield self.save_instance(parent)
 
         raise gen.Return((instance, error))
 
@@ -529,34 +1326,87 @@ class ModelProvider(tornado.web.RequestHandler):
         self.write_json(dump)
 
     def get_request_data(self):
-        data = {}
+        '''
+        Returns the request data as a dict. The body (urlencoded, multipart or
+        JSON) or the query string is parsed once per request; each call
+        returns a new dict, so callers are free to change it.
+        '''
+        if self.request_data is None:
+            self.request_data = self.parse_request_data()
 
-        if self.request.body:
-            items = self.request.body.decode('utf-8').split('&')
-            for item in items:
-                if '=' in item:
-                    key, value = item.split('=')
-                else:
-                    key, value = 'item', item
-
-                if key in data:
-                    if not isinstance(data[key], (tuple, list)):
-                        old = data[key]
-                        data[key] = []
-                        data[key].append(old)
-                    data[key].append(unquote(value))
-                else:
-                    if '[]' in key:
-                        data[key] = [unquote(value)]
-                    else:
-                        data[key] = unquote(value)
-        else:
+        return dict(self.request_data)
+
+    def parse_request_data(self):
+        if not self.request.body:
+            data = {}
             for arg in list(self.request.arguments.keys()):
                 data[arg] = self.get_argument(arg)
                 if data[arg] == '':  # Tornado 3.0+ compatibility... Hard to test...
                     data[arg] = None
+            return data
+
+        content_type = self.request.headers.get('Content-Type', '')
+        try:
+            return self.parse_request_body(content_type)
+        except ValueError:
+            # malformed JSON or bodies that aren't utf-8
+            raise tornado.web.HTTPError(400, 'Invalid request body')
+
+    def parse_request_body(self, content_type):
+        if content_type.startswith('application/json'):
+            # nested objects are kept as they are and mapped onto the model
+            # tree by `coerce_data`
+            body = utils.loads(self.request.body.decode('utf-8'))
+            if not isinstance(body, dict):
+                return {'item': body}
+            return body
+
+        if content_type.startswith('multipart/form-data'):
+            data = {}
+            for key, values in self.request.body_arguments.items():
+                for value in values:
+                    utils.add_value(data, key, value.decode('utf-8'))
+            return data
+
+        return utils.parse_form(self.request.body)
+
+    def coerce_data(self, node, data, prefix=''):
+        '''
+        Converts the request data to the types of the fields in the tree of
+        `node`, failing with `core.CoercionError` before any database access.
+        Keys are dotted paths (`team.name`) and nested dicts are coerced
+        against the embedded model tree. Unknown keys are kept as they are.
+        '''
+        coerced = {}
+        for key, value in data.items():
+            path = key
+            if prefix:
+                path = '%s.%s' % (prefix, key)
+
+            child_node = node.find_by_path(key.replace('[]', ''))
+            coerced[key] = self.coerce_value(child_node, value, path)
+
+        return coerced
+
+    def coerce_value(self, node, value, path):
+        if node is None or value is None:
+            return value
+
+        if isinstance(value, dict):
+            if node.model_type is None or node.is_lazy_loaded:
+                raise core.CoercionError(path, value)
+            return self.coerce_data(node, value, path)
+
+        if isinstance(value, (list, tuple)):
+            return [self.coerce_value(node, item, path) for item in value]
+
+        if node.coerce is None:
+            return value
 
-        return data
+        try:
+            return node.coerce(value)
+        except (ValueError, TypeError):
+            raise core.CoercionError(path, value)
 
     def dump_object(self, instance):
         return utils.dumps(instance)
@@ -8,21 +8,54 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
+import hashlib
 import logging
 
 import tornado.gen as gen
 from tornado import httpclient
 
 from bzz.auth import AuthProvider
+from bzz.cache import TTLCache
 import bzz.utils as utils
 
 
 class GoogleProvider(AuthProvider):
     '''
     Provider to perform authentication with Google OAUTH Apis.
+
+    Successful user info lookups are cached (by a hash of the access token)
+    for `cache_ttl` seconds and simultaneous lookups for the same access
+    token share a single request to Google.
+
+    :param io_loop: The IOLoop the provider http client runs on
+    :param http_client: An optional `AsyncHTTPClient` to share among providers
+    :param max_clients: Maximum simultaneous connections to Google (creates a dedicated client)
+    :param cache_ttl: Time in seconds user info is cached for an access token. `0` disables the cache
+    :param cache_size: Maximum number of access tokens to keep in cache
+    :param connect_timeout: Timeout in seconds to connect to Google
+    :param request_timeout: Timeout in seconds for the whole user info request
+    :param api_url: User info url (with a `{}` placeholder for the access token)
     '''
     API_URL = 'https://www.googleapis.com/oauth2/v1/userinfo?access_token={}'
 
+    def __init__(
+            self, io_loop=None, http_client=None, max_clients=None,
+            cache_ttl=300, cache_size=10000, connect_timeout=5.0,
+            request_timeout=10.0, api_url=None
+            ):
+        super(GoogleProvider, self).__init__(
+            io_loop=io_loop, http_client=http_client, max_clients=max_clients
+        )
+        self.cache_ttl = cache_ttl
+        self.cache = TTLCache(ttl=cache_ttl, max_size=cache_size)
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.api_url = api_url or self.API_URL
+        self.pending = {}
+
+    def get_cache_key(self, access_token):
+        return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
     @gen.coroutine
     def authenticate(self, access_token, proxy_info=None, post_data=None):
         '''
@@ -40,26 +73,59 @@ class GoogleProvider(AuthProvider):
                 provider: "google"
             }
         '''
+        if not access_token:
+            raise gen.Return(None)
+
+        key = self.get_cache_key(access_token)
+        user_data = self.cache.get(key)
+
+        if user_data is None:
+            future = self.pending.get(key, None)
+            if future is None:
+                future = self._authenticate(key, access_token, proxy_info)
+                self.pending[key] = future
+                future.add_done_callback(lambda f: self.pending.pop(key, None))
 
+            user_data = yield future
+
+        if user_data is None:
+            raise gen.Return(None)
+
+        # callers (and signal receivers) are free to change the returned dict
+        raise gen.Return(dict(user_data))
+
+    @gen.coroutine
+    def _authenticate(self, key, access_token, proxy_info):
         response = yield self._fetch_userinfo(access_token, proxy_info)
 
-        if response.code == 200:
+        if response is not None and response.code == 200:
             body = utils.loads(response.body)
             if not body.get('error'):
-                raise gen.Return({
+                user_data = {
                     'email': body.get("email"),
                     'name': body.get("name"),
                     'id': body.get("id"),
                     'provider': self.get_name()
-                })
+                }
+                if self.cache_ttl:
+                    self.cache.set(key, user_data)
+                raise gen.Return(user_data)
 
         raise gen.Return(None)
 
     @gen.coroutine
     def _fetch_userinfo(self, access_token, proxy_info):
-        url = self.API_URL.format(access_token)
-        logging.info('Requesting %s with proxy %s...' % (url, proxy_info))
-        req = httpclient.HTTPRequest(url, **proxy_info) if proxy_info else url
+        url = self.api_url.format(access_token)
+        logging.info('Requesting google user info with proxy %s...' % proxy_info)
+
+        options = dict(
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout,
+        )
+        if proxy_info:
+            options.update(proxy_info)
+
+        req = httpclient.HTTPRequest(url, **options)
         try:
             response = yield self.http_client.fetch(req)
         except httpclient.HTTPError as e:
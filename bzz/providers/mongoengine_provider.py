@@ -10,14 +10,40 @@
 
 import sys
 import math
+from datetime import datetime
 
 import tornado.gen as gen
 import mongoengine
+from mongoengine import connection
+from mongoengine.base import BaseDocument
+from mongoengine.base.common import _document_registry
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 
 import bzz.model as bzz
 import bzz.utils as utils
 
 
+def parse_object_id(value):
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise ValueError('Invalid ObjectId: %s' % value)
+
+
+# field types and the functions that convert request values to them
+COERCERS = (
+    (mongoengine.BooleanField, utils.parse_bool),
+    (mongoengine.IntField, int),
+    (mongoengine.LongField, int),
+    (mongoengine.FloatField, float),
+    (mongoengine.DecimalField, utils.parse_decimal),
+    (mongoengine.DateTimeField, utils.parse_datetime),
+    (mongoengine.ObjectIdField, parse_object_id),
+)
+
+
 class MongoEngineProvider(bzz.ModelProvider):
     @classmethod
     def get_model_name(cls, model):
@@ -39,12 +65,93 @@ class MongoEngineProvider(bzz.ModelProvider):
     def get_field_target_name(cls, field):
         return field.db_field
 
+    @classmethod
+    def get_field_signature(cls, field):
+        signature = super(MongoEngineProvider, cls).get_field_signature(field)
+        signature.extend([field.required, field.unique, field.primary_key])
+        if cls.is_list_field(field) and field.field is not None:
+            signature.append(cls.get_field_signature(field.field))
+        return signature
+
+    @classmethod
+    def get_field_coercer(cls, field):
+        if cls.is_list_field(field):
+            field = field.field
+
+        if cls.is_reference_field(field):
+            # references are given by the id of the referenced document
+            model = field.document_type
+            id_field = getattr(model, 'get_id_field_name', None)
+            if id_field:
+                field = id_field()
+            else:
+                field = model._fields.get('id', None)
+
+        for field_type, coercer in COERCERS:
+            if isinstance(field, field_type):
+                return coercer
+
+        return None
+
+    @classmethod
+    def before_fork(cls, application):
+        '''
+        Closes the pymongo clients and forgets them, so each process connects
+        again (with the same settings) when first using the database.
+        '''
+        for client in list(connection._connections.values()):
+            client.close()
+
+        connection._connections.clear()
+        connection._dbs.clear()
+
+        for document in _document_registry.values():
+            if issubclass(document, mongoengine.Document):
+                document._collection = None
+
+    @classmethod
+    def get_indexed_paths(cls, model):
+        names = dict([(field.db_field, name) for name, field in model._fields.items()])
+        paths = set()
+
+        id_field = model._meta.get('id_field', None)
+        if id_field:
+            paths.add(id_field)
+
+        for name, field in model._fields.items():
+            if field.primary_key or field.unique:
+                paths.add(name)
+
+        # compound indexes only help queries on their first field
+        for spec in model._meta.get('index_specs', None) or []:
+            parts = spec['fields'][0][0].split('.')
+            parts[0] = names.get(parts[0], parts[0])
+            paths.add('.'.join(parts))
+
+        return paths
+
     @classmethod
     def get_document_type(cls, field):
         if cls.is_list_field(field):
             field = field.field
         return getattr(field, 'document_type', None)
 
+    @classmethod
+    def get_field_by_path(cls, model, path):
+        field = None
+        for name in path.split('.'):
+            if field is not None:
+                model = cls.get_document_type(field)
+            field = model._fields.get(name, None) if model is not None else None
+            if field is None:
+                return None
+        return field
+
+    @classmethod
+    def has_custom_clean(cls, model):
+        clean = getattr(model.clean, '__func__', model.clean)
+        return clean is not getattr(BaseDocument.clean, '__func__', BaseDocument.clean)
+
     @classmethod
     def allows_create_on_associate(cls, field):
         if cls.is_list_field(field):
@@ -78,6 +185,8 @@ class MongoEngineProvider(bzz.ModelProvider):
         for key, value in data.items():
             if '.' in key or '[]' in key:
                 yield self.fill_property(model, instance, key, value)
+            elif isinstance(value, dict):
+                yield self.fill_embedded(model, instance, key, value)
             else:
                 field = instance._fields.get(key)
                 if self.is_reference_field(field):
@@ -89,6 +198,7 @@ class MongoEngineProvider(bzz.ModelProvider):
 
         if isinstance(instance, mongoengine.Document):
             try:
+                self.count_query('save_instance')
                 instance.save()
             except mongoengine.NotUniqueError:
                 err = sys.exc_info()[1]
@@ -150,6 +260,33 @@ class MongoEngineProvider(bzz.ModelProvider):
                 property_name, value
             )
 
+    @gen.coroutine
+    def fill_embedded(self, model, instance, field_name, values, updated_fields=None):
+        '''Fills the embedded document in `field_name` with the (already
+        coerced) `values` of a nested JSON object.'''
+        embedded_document = getattr(instance, field_name, None)
+
+        if updated_fields is not None:
+            updated_fields[field_name] = {
+                'from': embedded_document,
+                'to': values
+            }
+
+        if embedded_document is None:
+            embedded_document = model._fields[field_name].document_type()
+            setattr(instance, field_name, embedded_document)
+
+        embedded_model = embedded_document.__class__
+        for key, value in values.items():
+            if isinstance(value, dict):
+                yield self.fill_embedded(embedded_model, embedded_document, key, value)
+                continue
+
+            field = embedded_document._fields.get(key)
+            if self.is_reference_field(field):
+                value = yield self.get_instance(value, self.get_model(field))
+            setattr(embedded_document, key, value)
+
     @gen.coroutine
     def update_instance(
             self, pk, data, model=None, instance=None, parent=None):
@@ -160,11 +297,15 @@ class MongoEngineProvider(bzz.ModelProvider):
             instance = yield self.get_instance(pk, model)
 
         updated_fields = {}
-        for field_name, value in self.get_request_data().items():
+        for field_name, value in data.items():
             if '.' in field_name:
                 yield self.fill_property(
                     model, instance, field_name, value, updated_fields
                 )
+            elif isinstance(value, dict):
+                yield self.fill_embedded(
+                    model, instance, field_name, value, updated_fields
+                )
             else:
                 field = instance._fields.get(field_name)
                 if self.is_reference_field(field):
@@ -184,10 +325,111 @@ class MongoEngineProvider(bzz.ModelProvider):
 
         raise gen.Return((error, instance, updated_fields))
 
+    @gen.coroutine
+    def partial_update_instance(self, pk, data, model=None):
+        if model is None:
+            model = self.model
+
+        tree = self.get_tree(model)
+        updates = {}
+        updated_fields = {}
+        for path, value in self.get_update_paths(data).items():
+            node = tree.find_by_path(path)
+            if node is None or path.endswith('[]'):
+                raise gen.Return(((400, "Invalid field '%s'" % path), None))
+
+            if node.is_lazy_loaded and value is not None:
+                reference = yield self.get_instance(value, node.model_type)
+                if reference is None:
+                    raise gen.Return(((400, "Invalid reference for field '%s'" % path), None))
+                value = reference
+
+            updates['set__%s' % path.replace('.', '__')] = value
+            updated_fields[path] = {'to': value}
+
+        if not updates:
+            raise gen.Return(((400, 'Nothing to update'), None))
+
+        if self.version_field not in updated_fields:
+            version_updates = self.get_version_updates(model)
+            if version_updates is None:
+                raise gen.Return(((400, "Can't update '%s' without saving it" % self.version_field), None))
+            updates.update(version_updates)
+
+        queryset = self.get_instance_queryset(model, pk).filter(**{self.get_id_field_name(model): pk})
+        try:
+            self.validate_partial_update(model, queryset, updated_fields)
+            self.count_query('update_instance')
+            count = queryset.update_one(**updates)
+        except mongoengine.NotUniqueError:
+            err = sys.exc_info()[1]
+            raise gen.Return(((409, err), None))
+        except (mongoengine.ValidationError, mongoengine.InvalidQueryError):
+            err = sys.exc_info()[1]
+            raise gen.Return(((400, err), None))
+
+        self.invalidate_cached_instance(model, pk)
+
+        if not count:
+            raise gen.Return(((404, 'Not Found'), None))
+
+        raise gen.Return((None, updated_fields))
+
+    def get_version_updates(self, model):
+        '''
+        Returns the update changing the `version_field` of `model` along with
+        updates that don't save the whole document (so `clean` never sets it):
+        timestamps are set to now (in UTC) and numbers are incremented. Returns
+        None if the version can't be changed that way.
+        '''
+        field = model._fields.get(self.version_field) if self.version_field else None
+        if field is None:
+            return {}
+
+        if isinstance(field, mongoengine.DateTimeField):
+            return {'set__%s' % self.version_field: datetime.utcnow()}
+
+        if isinstance(field, (mongoengine.IntField, mongoengine.LongField)):
+            return {'inc__%s' % self.version_field: 1}
+
+        return None
+
+    def validate_partial_update(self, model, queryset, updated_fields):
+        '''
+        Validates the new values of a partial update, as saving would. Models
+        with a custom `clean` are loaded, so the whole document can be
+        validated (and cleaned) with the new values.
+        '''
+        if self.has_custom_clean(model):
+            self.count_query('get_instance')
+            instance = queryset.first()
+            if instance is None:
+                return
+
+            for path, value in updated_fields.items():
+                target = instance
+                names = path.split('.')
+                for name in names[:-1]:
+                    if getattr(target, name) is None:
+                        setattr(target, name, self.get_document_type(target._fields[name])())
+                    target = getattr(target, name)
+                setattr(target, names[-1], value['to'])
+
+            instance.validate()
+            return
+
+        for path, value in updated_fields.items():
+            field = self.get_field_by_path(model, path)
+            if value['to'] is not None:
+                field._validate(value['to'])
+            elif field.required:
+                field.error('Field is required', field_name=path)
+
     @gen.coroutine
     def save_instance(self, instance):
         error = None
         try:
+            self.count_query('save_instance')
             instance.save()
         except mongoengine.NotUniqueError:
             err = sys.exc_info()[1]
@@ -196,50 +438,90 @@ class MongoEngineProvider(bzz.ModelProvider):
             err = sys.exc_info()[1]
             raise gen.Return((None, (400, err)))
 
+        self.invalidate_document(instance)
         raise gen.Return((instance, error))
 
     @gen.coroutine
     def delete_instance(self, pk):
         instance = yield self.get_instance(pk)
         if instance is not None:
+            self.count_query('delete_instance')
             instance.delete()
+            self.invalidate_document(instance)
         raise gen.Return(instance)
 
+    def invalidate_document(self, instance):
+        if isinstance(instance, mongoengine.Document):
+            model = instance.__class__
+            self.invalidate_cached_instance(model, getattr(instance, self.get_id_field_name(model)))
+
+    def get_instance_queryset(self, model, instance_id):
+        queryset = model.objects
+        if hasattr(model, 'get_instance_queryset'):
+            queryset = model.get_instance_queryset(model, queryset, instance_id, self)
+
+        return queryset
+
     @gen.coroutine
     def get_instance(self, instance_id, model=None):
         if model is None:
             model = self.model
 
-        queryset = model.objects
-        if hasattr(model, 'get_instance_queryset'):
-            queryset = model.get_instance_queryset(model, queryset, instance_id, self)
+        instance = self.get_cached_instance(model, instance_id)
+        if instance is not None:
+            raise gen.Return(instance)
+
+        queryset = self.get_instance_queryset(model, instance_id)
 
-        instance = None
         field = self.get_id_field_name(model)
 
         if instance_id:
             query = {field: instance_id}
             if isinstance(instance_id, list):
                 query = {field + "__in": instance_id}
+            self.count_query('get_instance')
             instance = queryset.filter(**query).first()
+            self.cache_instance(model, instance_id, instance)
 
         raise gen.Return(instance)
 
-    @gen.coroutine
-    def get_list(self, items=None, page=1, per_page=20, filters=None):
-        if filters is None:
-            filters = {}
+    def serialize_instance(self, instance):
+        return instance.to_mongo()
+
+    def deserialize_instance(self, model, payload):
+        return model._from_son(payload)
 
+    def get_list_query(self, filters=None, sort=None):
+        '''Returns the queryset for the compiled `filters` and `sort` order'''
         queryset = self.model.objects
         if hasattr(self.model, 'get_list_queryset'):
             queryset = self.model.get_list_queryset(queryset, self)
 
         if filters:
             queryset = queryset.filter(**dict([
-                (key.replace('.', '__'), value)
-                for key, value in filters.items()
+                (self.get_filter_key(list_filter), list_filter.value)
+                for list_filter in filters
             ]))
 
+        if sort:
+            queryset = queryset.order_by(*[
+                '%s%s' % ('-' if descending else '', path)
+                for path, descending in sort
+            ])
+
+        return queryset
+
+    def get_filter_key(self, list_filter):
+        key = list_filter.path.replace('.', '__')
+        if list_filter.operator != 'eq':
+            key = '%s__%s' % (key, list_filter.operator)
+        return key
+
+    @gen.coroutine
+    def get_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        queryset = self.get_list_query(filters, sort)
+
+        self.count_query('count_list')
         pages = int(math.ceil(queryset.count() / float(per_page)))
         if pages == 0:
             raise gen.Return([])
@@ -252,9 +534,28 @@ class MongoEngineProvider(bzz.ModelProvider):
         start = per_page * page
         stop = start + per_page
 
+        # the query runs when the items are dumped
+        self.count_query('get_list')
         items = queryset.all()[start:stop]
         raise gen.Return(items)
 
+    @gen.coroutine
+    def explain_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        queryset = self.get_list_query(filters, sort)
+        start = per_page * (max(page, 1) - 1)
+
+        # the plans hold the parsed queries (and sort orders) as well
+        plan = {
+            'collection': self.get_model_collection(self.model),
+            'skip': start,
+            'limit': per_page,
+            'plan': queryset.clone().skip(start).limit(per_page).explain(),
+            'count_plan': queryset.clone().order_by().explain(),
+        }
+
+        # ObjectIds, timestamps and the like as mongo extended JSON
+        raise gen.Return(utils.loads(json_util.dumps(plan)))
+
     def dump_list(self, items):
         dumped = []
 
@@ -297,12 +598,26 @@ class MongoEngineProvider(bzz.ModelProvider):
             return
 
         field = obj._fields.get(field_name)
+        if self.is_list_field(field) and self.can_update_list(obj, field):
+            # sends only the new item instead of saving the whole list
+            operation = 'push'
+            if self.unique_associations:
+                operation = 'add_to_set'
+
+            _, error = yield self.update_list(obj, operation, field_name, instance)
+            if error is not None:
+                raise gen.Return((None, error))
+            raise gen.Return((obj, None))
+
         if self.is_list_field(field):
-            getattr(obj, field_name).append(instance)
+            items = getattr(obj, field_name)
+            if not self.unique_associations or instance not in items:
+                items.append(instance)
         else:
             setattr(obj, field_name, instance)
 
         try:
+            self.count_query('save_instance')
             obj.save()
         except mongoengine.NotUniqueError:
             err = sys.exc_info()[1]
@@ -311,8 +626,66 @@ class MongoEngineProvider(bzz.ModelProvider):
             err = sys.exc_info()[1]
             raise gen.Return((None, (400, err)))
 
+        self.invalidate_document(obj)
         raise gen.Return((obj, None))
 
+    @gen.coroutine
+    def remove_from_list(self, obj, field_name, instance):
+        if self.can_update_list(obj, obj._fields.get(field_name)):
+            # only matches if the item is in the list
+            result = yield self.update_list(obj, 'pull', field_name, instance, {field_name: instance})
+            raise gen.Return(result)
+
+        try:
+            getattr(obj, field_name).remove(instance)
+        except ValueError:
+            raise gen.Return((None, (400, 'Not Associated')))
+
+        _, error = yield self.save_instance(obj)
+        raise gen.Return((instance, error))
+
+    def can_update_list(self, obj, field):
+        '''
+        Lists of documents can be changed without saving (and validating) the
+        whole document, unless the list is required (and can't be left empty)
+        or the document has a custom `clean`, as the change could make it
+        invalid. Adding and removing items doesn't change the other fields,
+        except for the `version_field` (if it can be changed along).
+        '''
+        if not isinstance(obj, mongoengine.Document):
+            return False
+
+        if self.get_version_updates(obj.__class__) is None:
+            return False
+
+        return not field.required and not self.has_custom_clean(obj.__class__)
+
+    @gen.coroutine
+    def update_list(self, obj, operation, field_name, instance, query=None):
+        '''Atomically changes the list in `field_name` of `obj` with
+        `operation` (`push`, `add_to_set` or `pull`) without loading it.'''
+        if query is None:
+            query = {}
+
+        try:
+            if isinstance(instance, mongoengine.EmbeddedDocument):
+                instance.validate()
+
+            updates = self.get_version_updates(obj.__class__)
+            updates['%s__%s' % (operation, field_name)] = instance
+            self.count_query('update_instance')
+            count = obj.__class__.objects(pk=obj.pk, **query).update_one(**updates)
+        except mongoengine.ValidationError:
+            err = sys.exc_info()[1]
+            raise gen.Return((None, (400, err)))
+
+        self.invalidate_document(obj)
+
+        if not count:
+            raise gen.Return((None, (400, 'Not Associated')))
+
+        raise gen.Return((instance, None))
+
     def get_property_model(self, obj, field_name):
         property_name = field_name
         pk = None
@@ -8,15 +8,24 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
+import sys
 import math
+import decimal
+import datetime
 
 import tornado.gen as gen
+import sqlalchemy as sa
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.session import make_transient_to_detached
 from sqlalchemy.inspection import inspect
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
 
 import bzz.model as bzz
+import bzz.utils as utils
+from bzz.filters import FilterError
 
 
 Base = declarative_base()
@@ -26,6 +35,46 @@ class MaxDepthError(RuntimeError):
     pass
 
 
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'nin': lambda column, value: ~column.in_(value),
+    'contains': lambda column, value: column.contains(value),
+    'startswith': lambda column, value: column.startswith(value),
+    'exists': lambda column, value: column.isnot(None) if value else column.is_(None),
+}
+
+class Explain(Executable, ClauseElement):
+    '''EXPLAIN statement for the given query'''
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    prefix = 'EXPLAIN'
+    if compiler.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+
+    return '%s %s' % (prefix, compiler.process(element.statement, **kw))
+
+
+# python types of columns and the functions that convert request values to them
+COERCERS = {
+    bool: utils.parse_bool,
+    int: int,
+    float: float,
+    decimal.Decimal: utils.parse_decimal,
+    datetime.datetime: utils.parse_datetime,
+}
+
+
 class SQLAlchemyProvider(bzz.ModelProvider):
     @property
     def db(self):
@@ -64,6 +113,64 @@ class SQLAlchemyProvider(bzz.ModelProvider):
             return field.key
         return field.name
 
+    @classmethod
+    def get_field_signature(cls, field):
+        signature = super(SQLAlchemyProvider, cls).get_field_signature(field)
+        if isinstance(field, RelationshipProperty):
+            signature.append(field.secondary is not None and field.secondary.fullname)
+        else:
+            signature.extend([repr(field.type), field.nullable, field.unique, field.primary_key])
+        return signature
+
+    @classmethod
+    def get_field_coercer(cls, field):
+        if isinstance(field, RelationshipProperty):
+            # related rows are given by their primary key
+            field = field.mapper.primary_key[0]
+
+        try:
+            python_type = field.type.python_type
+        except (AttributeError, NotImplementedError):
+            return None
+
+        return COERCERS.get(python_type, None)
+
+    @classmethod
+    def before_fork(cls, application):
+        '''
+        Disposes the connection pool of the application session, so each
+        process opens its own connections.
+        '''
+        db = getattr(application, 'db', None)
+        if db is None:
+            return
+
+        db.close()
+        try:
+            db.get_bind().dispose()
+        except sa.exc.UnboundExecutionError:
+            pass
+
+    @classmethod
+    def get_indexed_paths(cls, model):
+        mapper = inspect(model)
+        indexed_columns = set()
+        for index in mapper.local_table.indexes:
+            # composite indexes only help queries on their first column
+            indexed_columns.add(list(index.columns)[0])
+
+        paths = set()
+        for prop in mapper.column_attrs:
+            column = prop.columns[0]
+            if column.primary_key or column.unique or column in indexed_columns:
+                paths.add(prop.key)
+
+        for prop in mapper.relationships:
+            if not prop.uselist and list(prop.local_columns)[0] in indexed_columns:
+                paths.add(prop.key)
+
+        return paths
+
     @classmethod
     def get_document_type(cls, field):
         if cls.is_list_field(field):
@@ -114,6 +221,7 @@ class SQLAlchemyProvider(bzz.ModelProvider):
                 setattr(instance, key, value)
 
         self.db.add(instance)
+        self.count_query('save_instance')
         self.db.flush()
         self.db.commit()
 
@@ -174,7 +282,7 @@ class SQLAlchemyProvider(bzz.ModelProvider):
             instance = yield self.get_instance(pk, model)
 
         updated_fields = {}
-        for field_name, value in self.get_request_data().items():
+        for field_name, value in data.items():
             if '.' in field_name:
                 yield self.fill_property(
                     model, instance, field_name, value, updated_fields
@@ -196,10 +304,129 @@ class SQLAlchemyProvider(bzz.ModelProvider):
         raise gen.Return((None, instance, updated_fields))
 
     @gen.coroutine
-    def save_instance(self, instance):
-        self.db.flush()
+    def partial_update_instance(self, pk, data, model=None):
+        if model is None:
+            model = self.model
+
+        fields = self.get_model_fields(model)
+        values = {}
+        updated_fields = {}
+        for path, value in self.get_update_paths(data).items():
+            field = fields.get(path, None)
+            if field is None or self.is_list_field(field):
+                raise gen.Return(((400, "Invalid field '%s'" % path), None))
+
+            if self.is_reference_field(field):
+                # sets the foreign keys instead of loading the related row
+                for local, remote in field.local_remote_pairs:
+                    values[local] = value
+            else:
+                values[field] = value
+
+            updated_fields[path] = {'to': value}
+
+        if not values:
+            raise gen.Return(((400, 'Nothing to update'), None))
+
+        version_values = {}
+        if self.version_field not in updated_fields:
+            version_values = self.get_version_values(model)
+            if version_values is None:
+                raise gen.Return(((400, "Can't update '%s' without saving it" % self.version_field), None))
+            values.update(version_values)
+
+        if self.has_update_hooks(model, updated_fields):
+            result = yield self.save_partial_update(pk, data, model, version_values)
+            raise gen.Return(result)
+
+        queryset = self.get_instance_queryset(model, pk)
+        try:
+            self.count_query('update_instance')
+            count = queryset.filter(self.get_id_field_name(model) == pk).update(
+                values, synchronize_session=False
+            )
+        except (sa.exc.IntegrityError, sa.exc.DataError):
+            # values the database refuses (i.e.: null in not nullable columns or too long strings)
+            self.db.rollback()
+            raise gen.Return(((400, sys.exc_info()[1].orig), None))
         self.db.commit()
+        self.invalidate_cached_instance(model, pk)
+
+        if not count:
+            raise gen.Return(((404, 'Not Found'), None))
+
+        raise gen.Return((None, updated_fields))
+
+    @classmethod
+    def has_update_hooks(cls, model, paths):
+        '''Returns True if updating `paths` of `model` runs `@validates` validators
+        or mapper update events, which a bulk UPDATE would skip'''
+        mapper = inspect(model)
+        if mapper.dispatch.before_update or mapper.dispatch.after_update:
+            return True
+
+        return any(path in mapper.validators for path in paths)
+
+    @gen.coroutine
+    def save_partial_update(self, pk, data, model, version_values):
+        '''Partially updates the instance by loading and saving it, like `update_instance` does'''
+        instance = yield self.get_instance(pk, model)
+        if instance is None:
+            raise gen.Return(((404, 'Not Found'), None))
+
+        for value in version_values.values():
+            setattr(instance, self.version_field, value)
+
+        try:
+            error, instance, updated_fields = yield self.update_instance(
+                pk, self.get_update_paths(data), model, instance=instance
+            )
+        except (sa.exc.IntegrityError, sa.exc.DataError):
+            self.db.rollback()
+            raise gen.Return(((400, sys.exc_info()[1].orig), None))
+
+        raise gen.Return((None, updated_fields))
+
+    def get_version_values(self, model):
+        '''
+        Returns the values changing the `version_field` of `model` along with
+        updates that don't go through the session (so the instance is never
+        dirty): timestamps are set to now (in UTC) and numbers are incremented.
+        Returns None if the version can't be changed that way.
+        '''
+        prop = inspect(model).column_attrs.get(self.version_field) if self.version_field else None
+        if prop is None:
+            return {}
+
+        column = prop.columns[0]
+        if isinstance(column.type, sa.DateTime):
+            return {column: datetime.datetime.utcnow()}
+
+        if isinstance(column.type, sa.Integer):
+            return {column: column + 1}
+
+        return None
+
+    def update_version(self, obj):
+        '''Changes the `version_field` of `obj` in the database, returning
+        False if it can't be changed'''
+        values = self.get_version_values(obj.__class__)
+        if values is None:
+            return False
 
+        if values:
+            mapper = inspect(obj.__class__)
+            self.count_query('update_instance')
+            self.db.query(obj.__class__).filter(*[
+                column == self.get_column_value(obj, column) for column in mapper.primary_key
+            ]).update(values, synchronize_session=False)
+            self.db.expire(obj, [self.version_field])
+
+        return True
+
+    @gen.coroutine
+    def save_instance(self, instance):
+        self.commit_instance(instance, 'save_instance')
         raise gen.Return((instance, None))
 
     @gen.coroutine
@@ -207,40 +434,97 @@ class SQLAlchemyProvider(bzz.ModelProvider):
         instance = yield self.get_instance(pk)
         if instance is not None:
             self.db.delete(instance)
-            yield self.save_instance(instance)
+            self.commit_instance(instance, 'delete_instance')
         raise gen.Return(instance)
 
+    def commit_instance(self, instance, operation):
+        '''Flushes the changes to `instance` (counted as an `operation`
+        query) and commits them'''
+        pk = None
+        if self.instance_cache is not None:
+            # read before committing, as committing expires (or deletes) it
+            pk = self.get_column_value(instance, self.get_id_field_name(instance.__class__))
+
+        self.count_query(operation)
+        self.db.flush()
+        self.db.commit()
+        self.invalidate_cached_instance(instance.__class__, pk)
+
+    def get_instance_queryset(self, model, instance_id):
+        queryset = self.db.query(model)
+        if hasattr(model, 'get_instance_queryset'):
+            queryset = model.get_instance_queryset(model, queryset, instance_id, self)
+
+        return queryset
+
     @gen.coroutine
     def get_instance(self, instance_id, model=None):
         if model is None:
             model = self.model
 
-        queryset = self.db.query(model)
-        if hasattr(model, 'get_instance_queryset'):
-            queryset = model.get_instance_queryset(model, queryset, instance_id, self)
+        instance = self.get_cached_instance(model, instance_id)
+        if instance is not None:
+            raise gen.Return(instance)
+
+        queryset = self.get_instance_queryset(model, instance_id)
 
-        instance = None
         field = self.get_id_field_name(model)
 
+        self.count_query('get_instance')
         instance = queryset.filter(field == instance_id).first()
+        self.cache_instance(model, instance_id, instance)
 
         raise gen.Return(instance)
 
-    @gen.coroutine
-    def get_list(self, items=None, page=1, per_page=20, filters=None):
-        if filters is None:
-            filters = {}
+    def serialize_instance(self, instance):
+        return dict([
+            (prop.key, getattr(instance, prop.key))
+            for prop in inspect(instance.__class__).column_attrs
+        ])
+
+    def deserialize_instance(self, model, payload):
+        instance = inspect(model).class_manager.new_instance()
+        for key, value in payload.items():
+            setattr(instance, key, value)
 
+        # as if it had just been loaded, reusing the one in the session if any
+        make_transient_to_detached(instance)
+        return self.db.merge(instance, load=False)
+
+    def get_list_query(self, filters=None, sort=None):
+        '''Returns the query for the compiled `filters` and `sort` order'''
         queryset = self.db.query(self.model)
         if hasattr(self.model, 'get_list_queryset'):
             queryset = self.model.get_list_queryset(queryset, self)
 
-        if filters:
-            for filter_, value in filters.items():
-                queryset = queryset.filter(
-                    self.get_field(self.model, filter_) == value
-                )
+        for list_filter in filters or []:
+            column = self.get_filter_column(list_filter.path)
+            queryset = queryset.filter(FILTER_OPERATORS[list_filter.operator](column, list_filter.value))
+
+        for path, descending in sort or []:
+            column = self.get_filter_column(path)
+            queryset = queryset.order_by(column.desc() if descending else column.asc())
+
+        return queryset
+
+    def get_filter_column(self, path):
+        field = self.get_model_fields(self.model).get(path, None)
+        if field is None:
+            raise FilterError("Filtering by '%s' requires a join, which is not supported" % path)
+
+        if self.is_reference_field(field):
+            if self.is_list_field(field):
+                raise FilterError("Can't filter by the list field '%s'" % path)
+            # filters by the foreign key instead of joining the related table
+            return list(field.local_columns)[0]
+
+        return field
 
+    @gen.coroutine
+    def get_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        queryset = self.get_list_query(filters, sort)
+
+        self.count_query('count_list')
         count = queryset.count()
 
         pages = int(math.ceil(count / float(per_page)))
@@ -255,9 +539,41 @@ class SQLAlchemyProvider(bzz.ModelProvider):
         start = per_page * page
         stop = start + per_page
 
+        self.count_query('get_list')
         items = queryset[start:stop]
         raise gen.Return(items)
 
+    @gen.coroutine
+    def explain_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        queryset = self.get_list_query(filters, sort)
+        start = per_page * (max(page, 1) - 1)
+
+        statement = queryset.offset(start).limit(per_page).statement
+        count_statement = sa.select([sa.func.count()]).select_from(
+            queryset.order_by(None).subquery()
+        )
+
+        raise gen.Return({
+            'query': self.explain_statement(statement),
+            'count_query': self.explain_statement(count_statement),
+        })
+
+    def explain_statement(self, statement):
+        compiled = statement.compile(dialect=self.db.bind.dialect)
+
+        # read straight from the cursor, as the result would take the plan
+        # rows for rows of the explained query (and convert their values)
+        result = self.db.execute(Explain(statement))
+        names = [column[0] for column in result.cursor.description]
+        plan = [dict(zip(names, row)) for row in result.cursor.fetchall()]
+        result.close()
+
+        return {
+            'sql': str(compiled),
+            'params': compiled.params,
+            'plan': plan,
+        }
+
     def dump_list(self, items):
         dumped = []
 
@@ -327,7 +643,10 @@ class SQLAlchemyProvider(bzz.ModelProvider):
             field = field.parent.relationships[field.key]
 
         if self.is_list_field(field):
-            getattr(obj, field_name).append(instance)
+            # inserts the association row instead of loading the collection
+            if not self.update_version(obj):
+                raise gen.Return((None, (400, "Can't update '%s' without saving it" % self.version_field)))
+            self.update_association(obj, field, instance, associate=True)
         else:
             setattr(obj, field_name, instance)
 
@@ -335,6 +654,79 @@ class SQLAlchemyProvider(bzz.ModelProvider):
 
         raise gen.Return((obj, None))
 
+    @gen.coroutine
+    def remove_from_list(self, obj, field_name, instance):
+        field = getattr(obj.__class__, field_name)
+        if isinstance(field, InstrumentedAttribute):
+            field = field.parent.relationships[field.key]
+
+        if not self.update_version(obj):
+            raise gen.Return((None, (400, "Can't update '%s' without saving it" % self.version_field)))
+
+        count = self.update_association(obj, field, instance, associate=False)
+        if not count:
+            self.db.rollback()
+            raise gen.Return((None, (400, 'Not Associated')))
+
+        yield self.save_instance(obj)
+
+        raise gen.Return((instance, None))
+
+    def get_column_value(self, obj, column):
+        prop = inspect(obj.__class__).get_property_by_column(column)
+        return getattr(obj, prop.key)
+
+    def update_association(self, obj, field, instance, associate):
+        '''
+        Associates (or dissociates) `instance` to the `field` collection of
+        `obj` with a single statement: the row in the association table for
+        many-to-many relationships or the foreign key of `instance` for
+        one-to-many ones. Returns the number of changed rows.
+        '''
+        if field.secondary is not None:
+            row = {}
+            for column, secondary_column in field.synchronize_pairs:
+                row[secondary_column] = self.get_column_value(obj, column)
+            for column, secondary_column in field.secondary_synchronize_pairs:
+                row[secondary_column] = self.get_column_value(instance, column)
+
+            criteria = sa.and_(*[column == value for column, value in row.items()])
+            if associate and self.unique_associations:
+                exists = sa.select([sa.func.count()]).select_from(field.secondary).where(criteria)
+                self.count_query('get_instance')
+                if self.db.execute(exists).scalar():
+                    return 0
+
+            if associate:
+                statement = field.secondary.insert().values(dict(
+                    (column.name, value) for column, value in row.items()
+                ))
+            else:
+                statement = field.secondary.delete().where(criteria)
+            self.count_query('update_instance')
+            count = self.db.execute(statement).rowcount
+        else:
+            values = {}
+            criteria = []
+            for column, remote_column in field.synchronize_pairs:
+                value = self.get_column_value(obj, column)
+                values[remote_column] = value if associate else None
+                if not associate:
+                    criteria.append(remote_column == value)
+
+            mapper = inspect(instance.__class__)
+            for column in mapper.primary_key:
+                criteria.append(column == self.get_column_value(instance, column))
+
+            self.count_query('update_instance')
+            count = self.db.query(instance.__class__).filter(*criteria).update(
+                values, synchronize_session=False
+            )
+
+        # the collection is loaded again only if used
+        self.db.expire(obj, [field.key])
+        return count
+
     def get_property_model(self, obj, field_name):
         property_name = field_name
         pk = None
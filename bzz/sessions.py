@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Server-side session stores for the AuthHive.
+
+When `AuthHive.configure` receives a `session_store`, the user data and the
+provider access token are kept in the store and the authentication cookie
+only carries a signed session id.
+'''
+
+import os
+import time
+import uuid
+import sqlite3
+
+from bzz.cache import TTLCache
+import bzz.utils as utils
+
+
+class SessionStore(object):
+    '''Base class for session stores. Sessions are dicts serialized to JSON.
+    '''
+
+    def generate_id(self):
+        return uuid.uuid4().hex
+
+    def create(self, session, expiration):
+        '''Stores the session for `expiration` seconds and returns its id'''
+        session_id = self.generate_id()
+        self.set(session_id, session, expiration)
+        return session_id
+
+    def get(self, session_id):
+        '''Returns the session or None if not found (or expired)'''
+        if not session_id:
+            return None
+
+        data = self.get_data(session_id)
+        if data is None:
+            return None
+
+        return utils.loads(data)
+
+    def set(self, session_id, session, expiration):
+        self.set_data(session_id, utils.dumps(session), expiration)
+
+    def get_data(self, session_id):
+        raise NotImplementedError()
+
+    def set_data(self, session_id, data, expiration):
+        raise NotImplementedError()
+
+    def touch(self, session_id, expiration):
+        '''Extends the session for another `expiration` seconds'''
+        raise NotImplementedError()
+
+    def delete(self, session_id):
+        raise NotImplementedError()
+
+
+class MemorySessionStore(SessionStore):
+    '''Keeps sessions in process memory, evicting the least recently used ones
+    when more than `max_size` sessions are stored.
+
+    Sessions are not shared among processes.
+    '''
+
+    def __init__(self, max_size=100000):
+        self.cache = TTLCache(max_size=max_size)
+
+    def get_data(self, session_id):
+        return self.cache.get(session_id)
+
+    def set_data(self, session_id, data, expiration):
+        self.cache.set(session_id, data, ttl=expiration)
+
+    def touch(self, session_id, expiration):
+        data = self.cache.get(session_id)
+        if data is not None:
+            self.cache.set(session_id, data, ttl=expiration)
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+
+
+class SQLiteSessionStore(SessionStore):
+    '''Keeps sessions in a SQLite database file, so all the processes in the
+    same machine share them. Expired sessions are purged every
+    `purge_every` new sessions.
+
+    Each process opens its own connection when it first needs one, as SQLite
+    connections can't be shared among forked processes.
+    '''
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self.created = 0
+        self.pid = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        pid = os.getpid()
+        if pid != self.pid:
+            # the connection of the parent process (if any) is left alone
+            self.pid = pid
+            self._connection = sqlite3.connect(self.path, isolation_level=None)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS bzz_sessions '
+                '(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+
+        return self._connection
+
+    def create(self, session, expiration):
+        self.created += 1
+        if self.created % self.purge_every == 0:
+            self.purge()
+
+        return super(SQLiteSessionStore, self).create(session, expiration)
+
+    def get_data(self, session_id):
+        row = self.connection.execute(
+            'SELECT data FROM bzz_sessions WHERE id = ? AND expires > ?',
+            (session_id, time.time())
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def set_data(self, session_id, data, expiration):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO bzz_sessions (id, data, expires) VALUES (?, ?, ?)',
+            (session_id, data, time.time() + expiration)
+        )
+
+    def touch(self, session_id, expiration):
+        self.connection.execute(
+            'UPDATE bzz_sessions SET expires = ? WHERE id = ?',
+            (time.time() + expiration, session_id)
+        )
+
+    def delete(self, session_id):
+        self.connection.execute('DELETE FROM bzz_sessions WHERE id = ?', (session_id,))
+
+    def purge(self):
+        self.connection.execute('DELETE FROM bzz_sessions WHERE expires <= ?', (time.time(),))
+
+
+class RedisSessionStore(SessionStore):
+    '''Keeps sessions in redis (or any server speaking its protocol).
+
+    :param client: A redis-py compatible client (`get`, `set` with `ex`,
+                   `expire` and `delete` methods)
+    :param prefix: Prefix for the session keys
+    '''
+
+    def __init__(self, client, prefix='bzz:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get_key(self, session_id):
+        return '%s%s' % (self.prefix, session_id)
+
+    def get_data(self, session_id):
+        data = self.client.get(self.get_key(session_id))
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return data
+
+    def set_data(self, session_id, data, expiration):
+        self.client.set(self.get_key(session_id), data, ex=int(expiration))
+
+    def touch(self, session_id, expiration):
+        self.client.expire(self.get_key(session_id), int(expiration))
+
+    def delete(self, session_id):
+        self.client.delete(self.get_key(session_id))
@@ -8,6 +8,7 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
+import time
 
 from tornado.concurrent import is_future
 import tornado.gen as gen
@@ -15,6 +16,10 @@ import blinker
 
 
 class Signal(blinker.NamedSignal):
+    # called with the signal, each receiver and the seconds it took
+    # (see bzz.metrics.Metrics.install)
+    timers = []
+
     @gen.coroutine
     def send(self, *sender, **kwargs):
         if len(sender) == 0:
@@ -28,14 +33,23 @@ class Signal(blinker.NamedSignal):
         if not self.receivers:
             raise gen.Return([])
 
+        timers = self.timers
         results = []
         for receiver in self.receivers_for(sender):
+            if timers:
+                started = time.time()
+
             result = receiver(sender, **kwargs)
 
             if is_future(result):
                 result = yield result
             results.append((receiver, result))
 
+            if timers:
+                duration = time.time() - started
+                for timer in timers:
+                    timer(self, receiver, duration)
+
         raise gen.Return(results)
 
 
@@ -71,6 +85,15 @@ post_update_instance = signal('bzz.post-update-instance')
 pre_delete_instance = signal('bzz.pre-delete-instance')
 post_delete_instance = signal('bzz.post-delete-instance')
 
+# instances changed by other processes (see bzz.bus.EventBus)
+remote_instance_changed = signal('bzz.remote-instance-changed')
+
+# sent with the application when the process starts stopping (see bzz.cli.Worker)
+stopping = signal('bzz.stopping')
+
+# sent with `authenticated` whenever the authentication token of a request is decoded
+token_decoded = signal('bzz.token-decoded')
+
 authorized_user = signal('bzz.authorized-user')
 unauthorized_user = signal('bzz.unauthorized-user')
 
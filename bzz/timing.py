@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+'''
+Timing of the phases of the requests to ModelHive routes (parsing the url,
+sending signals, querying, dumping and serializing), sent to clients in a
+`Server-Timing` header and recorded by metrics sinks::
+
+    routes = bzz.ModelHive.routes_for(
+        'mongoengine', User, server_timing=True, timing_sink=StatsdSink('localhost', 8125)
+    )
+'''
+
+import time
+import bisect
+import socket
+import logging
+
+
+class Span(object):
+    __slots__ = ('timings', 'name', 'started')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.name, time.time() - self.started)
+
+
+class Timings(object):
+    '''Durations of the phases of a request, in seconds. Phases done more
+    than once (like sending signals) add up, and how many times each was
+    done is counted.'''
+
+    enabled = True
+
+    def __init__(self):
+        self.names = []
+        self.durations = {}
+        self.counts = {}
+
+    def span(self, name):
+        '''Returns a context manager timing the phase `name`'''
+        return Span(self, name)
+
+    def add(self, name, duration):
+        if name not in self.durations:
+            self.names.append(name)
+            self.durations[name] = 0
+            self.counts[name] = 0
+
+        self.durations[name] += duration
+        self.counts[name] += 1
+
+    def get_spans(self):
+        return [(name, self.durations[name]) for name in self.names]
+
+    def get_counts(self):
+        return [(name, self.counts[name]) for name in self.names]
+
+    def get_header(self):
+        '''Returns the value of the `Server-Timing` header (durations in ms)'''
+        return ', '.join('%s;dur=%.2f' % (name, duration * 1000) for name, duration in self.get_spans())
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTimings(object):
+    '''Used by routes without timing, so timing phases costs nothing but a
+    method call'''
+
+    enabled = False
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def add(self, name, duration):
+        pass
+
+    def get_spans(self):
+        return []
+
+    def get_counts(self):
+        return []
+
+
+NULL_TIMINGS = NullTimings()
+
+
+class Histogram(object):
+    '''Counts the values observed in each bucket (values up to each of the
+    `buckets` bounds, and the ones over the last bound).'''
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_cumulative_counts(self):
+        '''Returns `(bound, count of values up to bound)` for each bucket,
+        with `None` as the bound of the last one'''
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [None], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': self.get_cumulative_counts(),
+        }
+
+
+class HistogramSink(object):
+    '''
+    Keeps histograms of the durations of each phase of the requests, by
+    resource and method, in memory.
+
+    :param buckets: Upper bounds (in seconds) of the buckets of the histograms
+    '''
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.histograms = {}
+
+    def record(self, resource, method, spans):
+        for name, duration in spans:
+            key = (resource, method, name)
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    def get_stats(self):
+        return dict(
+            (key, histogram.get_stats()) for key, histogram in self.histograms.items()
+        )
+
+
+class StatsdSink(object):
+    '''
+    Sends the durations of each phase of the requests to a StatsD server as
+    timers named `<prefix>.<resource>.<method>.<phase>`, in a single UDP
+    datagram per request. Datagrams that can't be sent are dropped.
+
+    :param host: StatsD host (resolved once)
+    :param port: StatsD port
+    :param prefix: Prefix of the metric names
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='bzz'):
+        self.address = (socket.gethostbyname(host), port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.sent = 0
+        self.dropped = 0
+
+    def record(self, resource, method, spans):
+        prefix = '%s.%s.%s' % (self.prefix, resource, method.lower())
+        message = '\n'.join(
+            '%s.%s:%.3f|ms' % (prefix, name, duration * 1000) for name, duration in spans
+        )
+
+        try:
+            self.socket.sendto(message.encode('utf-8'), self.address)
+            self.sent += 1
+        except socket.error as err:
+            self.dropped += 1
+            logging.debug('Dropped request timings (%s)' % err)
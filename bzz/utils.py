@@ -10,11 +10,13 @@
 
 import inspect
 import re
+import decimal
 import calendar
 import datetime
-from six.moves import reduce
+import importlib
 
-import jwt
+import six
+from tornado.escape import url_unescape
 
 import bzz.core as core
 
@@ -59,15 +61,16 @@ def convert(name):
     return all_cap_re.sub(r'\1_\2', s1).lower()
 
 
-def get_class(klass):
-    module_name, class_name = klass.rsplit('.', 1)
+CLASSES = {}
 
-    module = __import__(module_name)
 
-    if '.' in module_name:
-        module = reduce(getattr, module_name.split('.')[1:], module)
+def get_class(klass):
+    cls = CLASSES.get(klass, None)
+    if cls is None:
+        module_name, class_name = klass.rsplit('.', 1)
+        cls = CLASSES[klass] = getattr(importlib.import_module(module_name), class_name)
 
-    return getattr(module, class_name)
+    return cls
 
 
 def default(obj):
@@ -93,6 +96,91 @@ def dumps(instance):
 
     return json.dumps(instance, default=default)
 
+def add_value(data, key, value):
+    '''Adds value to data. Keys with `[]` or repeated keys hold lists.'''
+    existing = data.get(key, None)
+    if existing is None:
+        data[key] = [value] if '[]' in key else value
+    elif isinstance(existing, list):
+        existing.append(value)
+    else:
+        data[key] = [existing, value]
+
+
+def unescape(value):
+    if b'%' in value or b'+' in value:
+        return url_unescape(value, plus=True)
+    return value.decode('utf-8')
+
+
+def parse_form(body):
+    '''Parses an urlencoded body in a single pass. Items without a value are
+    stored in the `item` key.
+
+    >>> parse_form(b'name=Bernardo+Heynemann&team[]=a&team[]=b&module.name=x%3Dy')
+    {'name': 'Bernardo Heynemann', 'team[]': ['a', 'b'], 'module.name': 'x=y'}
+    '''
+    data = {}
+    for item in body.split(b'&'):
+        if not item:
+            continue
+
+        key, separator, value = item.partition(b'=')
+        if separator:
+            key = unescape(key)
+        else:
+            key, value = 'item', key
+
+        add_value(data, key, unescape(value))
+
+    return data
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    value = six.text_type(value).lower()
+    if value in ('true', '1', 'on', 'yes'):
+        return True
+    if value in ('false', '0', 'off', 'no', ''):
+        return False
+
+    raise ValueError('Invalid boolean: %s' % value)
+
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_datetime(value):
+    '''Parses milliseconds since epoch (as `dumps` serializes datetimes) or
+    ISO 8601 strings into an UTC datetime.
+    '''
+    if isinstance(value, datetime.datetime):
+        return value
+
+    if isinstance(value, six.integer_types + (float,)) or value.isdigit():
+        return datetime.datetime.utcfromtimestamp(float(value) / 1000)
+
+    value = value.rstrip('Z')
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid datetime: %s' % value)
+
+
+def parse_decimal(value):
+    '''Parses decimals, failing with ValueError (instead of
+    decimal.InvalidOperation) for invalid values.'''
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        raise ValueError('Invalid decimal: %s' % value)
+
+
 def get_prefix(prefix):
     if not prefix:
         return ''
@@ -112,6 +200,8 @@ def ensure_instance(provider):
     return provider() if inspect.isclass(provider) else provider
 
 
+# jwt (and cryptography, when installed) is slow to import,
+# so it is only imported when tokens are first encoded or decoded.
 class Jwt(object):
     '''Json Web Tokens encoding/decoding utility class.
     Usage:
@@ -126,6 +216,8 @@ class Jwt(object):
     (False, None)
     '''
 
+    can_sign = True
+
     def __init__(self, secret, algo='HS512'):
         self.secret = secret
         self.algo = algo
@@ -133,18 +225,128 @@ class Jwt(object):
     def encode(self, payload):
         '''Encodes the payload returning a Json Web Token
         '''
+        import jwt
         return jwt.encode(payload, self.secret, self.algo)
 
     def decode(self, encrypted_payload):
         '''Decodes the Json Web Token returning the payload
         '''
-        return jwt.decode(encrypted_payload, self.secret)
+        import jwt
+        return jwt.decode(encrypted_payload, self.secret, algorithms=[self.algo])
 
     def try_to_decode(self, encrypted_payload):
         '''Tries to decrypt the given encrypted and returns a tuple with
         a decrypted boolean flag and the decrypted object if success is True
         '''
+        import jwt
         try:
             return True, self.decode(encrypted_payload)
-        except (jwt.ExpiredSignature, jwt.DecodeError, AttributeError):
+        except (jwt.InvalidTokenError, AttributeError):
             return False, None
+
+
+class JwtKey(object):
+    '''An asymmetric key (RS256, ES256, EdDSA...) identified by `key_id`.
+
+    Keys are parsed once, when the `JwtKey` is created, so verifying tokens
+    does not parse PEM data again. Keys without a `private_key` can only be
+    used to verify tokens. If only the `private_key` is given, the public
+    key is derived from it.
+    '''
+
+    def __init__(self, key_id, algo, public_key=None, private_key=None):
+        import jwt.algorithms
+        algorithms = jwt.algorithms.get_default_algorithms()
+        if algo not in algorithms:
+            raise ValueError(
+                "Algorithm '%s' is not supported by the installed pyjwt "
+                "(is the cryptography package installed?)." % algo
+            )
+
+        if public_key is None and private_key is None:
+            raise ValueError("Key '%s' needs a public or private key." % key_id)
+
+        algorithm = algorithms[algo]
+        self.key_id = key_id
+        self.algo = algo
+        self.signing_key = None
+        if private_key is not None:
+            self.signing_key = algorithm.prepare_key(private_key)
+
+        if public_key is not None:
+            self.verifying_key = algorithm.prepare_key(public_key)
+        else:
+            self.verifying_key = self.signing_key.public_key()
+
+
+class KeySetJwt(Jwt):
+    '''Json Web Tokens signed with asymmetric keys, supporting key rotation.
+
+    Tokens are signed with the key identified by `signing_key_id` and carry
+    its id in the `kid` header. Any key in the set can verify tokens, so
+    nodes that only verify tokens need only the public keys.
+
+    Usage:
+    >>> keys = [
+    ...     JwtKey('2014-11', 'RS256', private_key=NEW_PRIVATE_PEM),
+    ...     JwtKey('2014-10', 'RS256', public_key=OLD_PUBLIC_PEM),
+    ... ]
+    >>> tokenizer = KeySetJwt(keys, signing_key_id='2014-11')
+    >>> tokenizer.decode(tokenizer.encode(dict(sub='user@email.com')))
+    {'sub': 'user@email.com'}
+    '''
+
+    def __init__(self, keys, signing_key_id=None):
+        self.keys = {}
+        for key in keys:
+            self.add_key(key)
+
+        if signing_key_id is None:
+            signing_key_id = next((
+                key.key_id for key in keys if key.signing_key is not None
+            ), None)
+
+        self.signing_key_id = None
+        if signing_key_id is not None:
+            self.set_signing_key(signing_key_id)
+
+    @property
+    def can_sign(self):
+        return self.signing_key_id is not None
+
+    def add_key(self, key):
+        self.keys[key.key_id] = key
+
+    def remove_key(self, key_id):
+        if key_id == self.signing_key_id:
+            raise ValueError("Can't remove the key currently used for signing.")
+        self.keys.pop(key_id, None)
+
+    def set_signing_key(self, key_id):
+        key = self.keys.get(key_id, None)
+        if key is None or key.signing_key is None:
+            raise ValueError("Key '%s' is not a known private key." % key_id)
+        self.signing_key_id = key_id
+
+    def encode(self, payload):
+        '''Encodes the payload with the current signing key
+        '''
+        if not self.can_sign:
+            raise ValueError('This key set has no private key to sign tokens with.')
+
+        import jwt
+        key = self.keys[self.signing_key_id]
+        return jwt.encode(
+            payload, key.signing_key, key.algo, headers={'kid': key.key_id}
+        )
+
+    def decode(self, encrypted_payload):
+        '''Decodes the Json Web Token with the key named in its `kid` header
+        '''
+        import jwt
+        header = jwt.get_unverified_header(encrypted_payload)
+        key = self.keys.get(header.get('kid'), None)
+        if key is None:
+            raise jwt.DecodeError('Unknown key id.')
+
+        return jwt.decode(encrypted_payload, key.verifying_key, algorithms=[key.algo])
@@ -29,6 +29,7 @@ tests_require = [
     'mysql-python',
     'nose-focus',
     'sphinx_rtd_theme',
+    'cryptography',
 ]
 
 setup(
@@ -60,16 +61,16 @@ bzz is a Rest API framework for working bees.
         'awesome-slugify',
         'cow-framework>=1.0.0',
         'blinker',
-        'pyjwt',
+        'pyjwt>=1.0.0',
         'six',
     ],
     extras_require={
         'tests': tests_require,
+        'crypto': ['cryptography'],
     },
     entry_points={
         'console_scripts': [
-            # add cli scripts here in this form:
-            # 'bzz=bzz.cli:main',
+            'bzz=bzz.cli:main',
         ],
     },
 )
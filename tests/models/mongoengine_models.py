@@ -111,3 +111,21 @@ class ValidationUser(mongoengine.Document):
     def clean(self):
         if len(self.items) > 1:
             raise mongoengine.ValidationError(field_name='items', message='something went wrong')
+
+
+class Pet(mongoengine.Document):
+    name = mongoengine.StringField(required=True)
+    price = mongoengine.DecimalField()
+    owner = mongoengine.ReferenceField(User)
+    meta = {'collection': 'pet', 'indexes': ['owner']}
+
+    def clean(self):
+        if self.price is not None and self.price < 0:
+            raise mongoengine.ValidationError(field_name='price', message='price cannot be negative')
+
+
+class Club(mongoengine.Document):
+    name = mongoengine.StringField(required=True)
+    members = mongoengine.ListField(mongoengine.ReferenceField(User))
+    version = mongoengine.IntField(default=1)
+    meta = {'collection': 'club'}
@@ -32,3 +32,87 @@ class CustomQuerySet(Base):
         db.add(self)
         db.flush()
         db.commit()
+
+
+class Owner(Base):
+    __tablename__ = 'OwnerTable'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(2000), nullable=False)
+    age = sa.Column(sa.Integer)
+
+    def save(self, db):
+        db.add(self)
+        db.flush()
+        db.commit()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'age': self.age,
+        }
+
+
+class Pet(Base):
+    __tablename__ = 'PetTable'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(2000), nullable=False)
+    price = sa.Column(sa.Numeric(10, 2))
+    owner_id = sa.Column(sa.Integer, sa.ForeignKey('OwnerTable.id'), index=True)
+    owner = orm.relationship(Owner, backref='pets')
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'price': float(self.price) if self.price is not None else None,
+        }
+
+    def save(self, db):
+        db.add(self)
+        db.flush()
+        db.commit()
+
+
+club_members_table = sa.Table(
+    'ClubMembersTable', Base.metadata,
+    sa.Column('club_id', sa.Integer, sa.ForeignKey('ClubTable.id')),
+    sa.Column('owner_id', sa.Integer, sa.ForeignKey('OwnerTable.id')),
+)
+
+
+class Club(Base):
+    __tablename__ = 'ClubTable'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(2000))
+    members = orm.relationship(Owner, secondary=club_members_table)
+    updated_at = sa.Column(sa.DateTime)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'members': [member.name for member in self.members],
+        }
+
+    def save(self, db):
+        db.add(self)
+        db.flush()
+        db.commit()
+
+
+class Tag(Base):
+    __tablename__ = 'TagTable'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(200), nullable=False)
+
+    @orm.validates('name')
+    def validate_name(self, key, value):
+        return value.strip().lower()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+        }
+
+    def save(self, db):
+        db.add(self)
+        db.flush()
+        db.commit()
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import tornado.web
+import tornado.gen as gen
+import tornado.testing as testing
+from preggy import expect
+
+from bzz.cache import TTLCache
+from bzz.providers.google import GoogleProvider
+import tests.base as base
+
+
+class UserInfoHandler(tornado.web.RequestHandler):
+    def initialize(self, calls):
+        self.calls = calls
+
+    @gen.coroutine
+    def get(self):
+        access_token = self.get_argument('access_token')
+        self.calls.append(access_token)
+
+        # gives concurrent requests a chance to pile up
+        yield gen.sleep(0.05)
+
+        if access_token != 'VALID-TOKEN':
+            self.set_status(401)
+            self.write({'error': 'invalid token'})
+            return
+
+        self.write({'id': '56789', 'email': 'test@gmail.com', 'name': 'Teste'})
+
+
+class GoogleProviderTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.calls = []
+        return tornado.web.Application([
+            ('/userinfo', UserInfoHandler, dict(calls=self.calls)),
+        ])
+
+    def get_provider(self, **kw):
+        return GoogleProvider(
+            self.io_loop,
+            api_url=self.get_url('/userinfo?access_token={}'),
+            **kw
+        )
+
+    @testing.gen_test
+    def test_can_authenticate_with_valid_token(self):
+        provider = self.get_provider()
+        user_data = yield provider.authenticate('VALID-TOKEN')
+
+        expect(user_data).to_equal({
+            'id': '56789', 'email': 'test@gmail.com',
+            'name': 'Teste', 'provider': 'google'
+        })
+        expect(self.calls).to_length(1)
+
+    @testing.gen_test
+    def test_cant_authenticate_with_invalid_token(self):
+        provider = self.get_provider()
+        user_data = yield provider.authenticate('INVALID-TOKEN')
+        expect(user_data).to_be_null()
+
+        user_data = yield provider.authenticate('INVALID-TOKEN')
+        expect(user_data).to_be_null()
+        expect(self.calls).to_length(2)
+
+    @testing.gen_test
+    def test_user_info_is_cached_by_hashed_token(self):
+        provider = self.get_provider()
+        first = yield provider.authenticate('VALID-TOKEN')
+        first['authenticated'] = True
+        second = yield provider.authenticate('VALID-TOKEN')
+
+        expect(self.calls).to_length(1)
+        expect(second).not_to_include('authenticated')
+        expect('VALID-TOKEN' in provider.cache).to_be_false()
+        expect(provider.get_cache_key('VALID-TOKEN') in provider.cache).to_be_true()
+
+    @testing.gen_test
+    def test_cache_can_be_disabled(self):
+        provider = self.get_provider(cache_ttl=0)
+        yield provider.authenticate('VALID-TOKEN')
+        yield provider.authenticate('VALID-TOKEN')
+
+        expect(self.calls).to_length(2)
+
+    @testing.gen_test
+    def test_concurrent_lookups_for_same_token_are_coalesced(self):
+        provider = self.get_provider()
+        results = yield [
+            provider.authenticate('VALID-TOKEN') for i in range(5)
+        ]
+
+        expect(self.calls).to_length(1)
+        for user_data in results:
+            expect(user_data['id']).to_equal('56789')
+        expect(provider.pending).to_be_empty()
+
+
+class TTLCacheTestCase(base.TestCase):
+    def test_entries_expire_after_ttl(self):
+        now = [100]
+        cache = TTLCache(ttl=10, clock=lambda: now[0])
+        cache.set('key', 'value')
+        expect(cache.get('key')).to_equal('value')
+
+        now[0] = 111
+        expect(cache.get('key')).to_be_null()
+        expect(cache.hits).to_equal(1)
+        expect(cache.misses).to_equal(1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = TTLCache(ttl=10, max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        expect('a' in cache).to_be_true()
+        expect('b' in cache).to_be_false()
+        expect('c' in cache).to_be_true()
+        expect(len(cache)).to_equal(2)
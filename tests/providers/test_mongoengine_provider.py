@@ -10,16 +10,22 @@
 
 import locale
 
+from six.moves import cPickle as pickle
 import mongoengine
 import cow.server as server
 import cow.plugins.mongoengine_plugin as mongoengine_plugin
 import tornado.testing as testing
 from tornado.httpclient import HTTPError
+from tornado.httputil import HTTPServerRequest
+from mock import Mock
 from preggy import expect
 import derpconf.config as config
 import bson.objectid as oid
 
 import bzz
+import bzz.limits as limits
+from bzz.cache import InstanceCache
+from bzz.metrics import Metrics
 import bzz.providers.mongoengine_provider as me
 import bzz.signals as signals
 import bzz.utils as utils
@@ -42,9 +48,19 @@ class TestServer(server.Server):
         ]
 
     def get_handlers(self):
+        self.instance_cache = InstanceCache()
+        self.metrics = Metrics()
         routes = [
             bzz.ModelHive.routes_for('mongoengine', models.User),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.User, resource_name='cached_user', instance_cache=self.instance_cache,
+                metrics=self.metrics
+            ),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.Team, resource_name='cached_team', instance_cache=self.instance_cache
+            ),
             bzz.ModelHive.routes_for('mongoengine', models.OtherUser),
+            bzz.ModelHive.routes_for('mongoengine', models.Club, version_field='version'),
             bzz.ModelHive.routes_for('mongoengine', models.Parent),
             bzz.ModelHive.routes_for('mongoengine', models.Parent2),
             bzz.ModelHive.routes_for('mongoengine', models.Team),
@@ -52,6 +68,22 @@ class TestServer(server.Server):
             bzz.ModelHive.routes_for('mongoengine', models.CustomQuerySet),
             bzz.ModelHive.routes_for('mongoengine', models.UniqueUser),
             bzz.ModelHive.routes_for('mongoengine', models.ValidationUser),
+            bzz.ModelHive.routes_for('mongoengine', models.Pet),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.Pet, resource_name='indexed_pet', indexed_filters_only=True
+            ),
+            bzz.ModelHive.routes_for('mongoengine', models.Pet, resource_name='explained_pet', allow_explain=True),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.Team, resource_name='unique_team', unique_associations=True
+            ),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.Person, resource_name='limited_person',
+                rate_limiter=limits.RateLimiter(rate=0.01, burst=1)
+            ),
+            bzz.ModelHive.routes_for(
+                'mongoengine', models.Person, resource_name='busy_person',
+                concurrency_limiter=limits.ConcurrencyLimiter(0, retry_after=3)
+            ),
         ]
         return bzz.flatten(routes)
 
@@ -76,6 +108,8 @@ class MongoEngineProviderTestCase(base.ApiTestCase):
         models.Parent2.objects.delete()
         models.Team.objects.delete()
         models.Student.objects.delete()
+        models.Pet.objects.delete()
+        models.Club.objects.delete()
 
     def get_config(self):
         return dict(
@@ -742,6 +776,70 @@ class MongoEngineProviderTestCase(base.ApiTestCase):
         expect(team.users).to_length(1)
         expect(team.users[0].id).to_equal(user.id)
 
+    @testing.gen_test
+    def test_can_save_user_team_twice(self):
+        team = models.Team.objects.create(name="test-team")
+        user = models.User(name="Bernardo Heynemann", email="foo@bar.com")
+        user.save()
+
+        for i in range(2):
+            response = yield self.http_client.fetch(
+                self.get_url('/team/%s/users/' % str(team.id)),
+                method='POST',
+                body='users[]=%s' % str(user.id)
+            )
+            expect(response.code).to_equal(200)
+
+        team.reload()
+        expect(team.users).to_length(2)
+
+    @testing.gen_test
+    def test_saving_user_team_twice_with_unique_associations_keeps_one(self):
+        team = models.Team.objects.create(name="test-team")
+        user = models.User(name="Bernardo Heynemann", email="foo@bar.com")
+        user.save()
+
+        for i in range(2):
+            response = yield self.http_client.fetch(
+                self.get_url('/unique_team/%s/users/' % str(team.id)),
+                method='POST',
+                body='users[]=%s' % str(user.id)
+            )
+            expect(response.code).to_equal(200)
+
+        team.reload()
+        expect(team.users).to_length(1)
+        expect(team.users[0].id).to_equal(user.id)
+
+    @testing.gen_test
+    def test_partial_and_list_updates_change_the_version(self):
+        user = fix.UserFactory.create()
+        club = models.Club.objects.create(name='bzz')
+
+        yield self.http_client.fetch(
+            self.get_url('/club/%s' % club.id),
+            method='PATCH',
+            body='name=tornado'
+        )
+        club.reload()
+        expect(club.version).to_equal(2)
+
+        yield self.http_client.fetch(
+            self.get_url('/club/%s/members/' % club.id),
+            method='POST',
+            body='members[]=%s' % user.id
+        )
+        club.reload()
+        expect(club.version).to_equal(3)
+
+        yield self.http_client.fetch(
+            self.get_url('/club/%s/members/%s' % (club.id, user.id)),
+            method='DELETE'
+        )
+        club.reload()
+        expect(club.version).to_equal(4)
+        expect(club.members).to_be_empty()
+
     @testing.gen_test
     def test_can_get_user_in_team(self):
         user = fix.UserFactory.create()
@@ -1277,3 +1375,283 @@ class MongoEngineProviderTestCase(base.ApiTestCase):
 
         expect(err.error.code).to_equal(400)
         expect(err.error.response.body).to_equal("ValidationError (ValidationUser:%s) (something went wrong: ['__all__'])" % (validation.id))
+
+    @testing.gen_test
+    def test_can_create_pet_with_coerced_values(self):
+        owner = models.User(name='Bernardo', email='heynemann@gmail.com')
+        owner.save()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/pet/'),
+            method='POST',
+            body='name=Rex&price=10.50&owner=%s' % owner.id
+        )
+
+        expect(response.code).to_equal(200)
+        pet = models.Pet.objects.get(name='Rex')
+        expect(str(pet.price)).to_equal('10.50')
+        expect(pet.owner.id).to_equal(owner.id)
+
+    @testing.gen_test
+    def test_cant_create_pet_with_invalid_reference(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/pet/'),
+                method='POST',
+                body='name=Rex&owner=not-an-id'
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(models.Pet.objects.count()).to_equal(0)
+
+    @testing.gen_test
+    def test_cant_create_pet_with_invalid_decimal(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/pet/'),
+                method='POST',
+                body='name=Rex&price=abc'
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(models.Pet.objects.count()).to_equal(0)
+
+    def create_pets(self):
+        owner = models.User(name='Bernardo', email='heynemann@gmail.com')
+        owner.save()
+        models.Pet(name='Rex', price='10.50', owner=owner).save()
+        models.Pet(name='Fido', price='2').save()
+        return owner
+
+    @testing.gen_test
+    def test_can_filter_pets_by_reference_and_decimal(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(self.get_url('/pet/?owner=%s' % owner.id))
+        expect([pet['name'] for pet in load_json(response.body)]).to_equal(['Rex'])
+
+        response = yield self.http_client.fetch(self.get_url('/pet/?price__lt=5'))
+        expect([pet['name'] for pet in load_json(response.body)]).to_equal(['Fido'])
+
+    @testing.gen_test
+    def test_filtering_pets_by_invalid_reference_fails_with_400(self):
+        self.create_pets()
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/pet/?owner=not-an-id'))
+
+        expect(err.error.code).to_equal(400)
+
+    @testing.gen_test
+    def test_filtering_pets_by_invalid_decimal_fails_with_400(self):
+        self.create_pets()
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/pet/?price__gte=abc'))
+
+        expect(err.error.code).to_equal(400)
+
+    def test_indexed_paths_include_ids_and_indexes(self):
+        expect(me.MongoEngineProvider.get_indexed_paths(models.Pet)).to_equal(set(['id', 'owner']))
+        expect(me.MongoEngineProvider.get_indexed_paths(models.UniqueUser)).to_equal(set(['id', 'name']))
+
+    @testing.gen_test
+    def test_indexed_filters_only_refuses_filters_by_fields_not_indexed(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(self.get_url('/indexed_pet/?owner=%s' % owner.id))
+        expect(load_json(response.body)).to_length(1)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/indexed_pet/?name=Rex'))
+
+        expect(err.error.code).to_equal(400)
+
+    @testing.gen_test
+    def test_can_explain_list_queries(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/explained_pet/?owner=%s&sort=-name&page=2&per_page=5&_explain=1' % owner.id)
+        )
+
+        plan = load_json(response.body)
+        expect(plan['collection']).to_equal('pet')
+        expect(plan['skip']).to_equal(5)
+        expect(plan['limit']).to_equal(5)
+        expect(plan['plan']).not_to_be_empty()
+        expect(plan['count_plan']).not_to_be_empty()
+
+    @testing.gen_test
+    def test_can_patch_user(self):
+        user = models.User(name='Bernardo', email='heynemann@gmail.com')
+        user.save()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/user/%s' % user.id),
+            method='PATCH',
+            body='email=bernardo@gmail.com'
+        )
+
+        expect(response.code).to_equal(200)
+        user.reload()
+        expect(user.email).to_equal('bernardo@gmail.com')
+        expect(user.name).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_cant_patch_required_field_to_null(self):
+        user = models.User(name='Bernardo', email='heynemann@gmail.com')
+        user.save()
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/user/%s' % user.id),
+                method='PATCH',
+                body=utils.dumps({'name': None}),
+                headers={'Content-Type': 'application/json'}
+            )
+
+        expect(err.error.code).to_equal(400)
+        user.reload()
+        expect(user.name).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_cant_patch_document_into_failing_clean(self):
+        pet = models.Pet(name='Rex', price='10.50')
+        pet.save()
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/pet/%s' % pet.id),
+                method='PATCH',
+                body='price=-1'
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(err.error.response.body).to_equal(
+            "ValidationError (Pet:%s) (price cannot be negative: ['__all__'])" % pet.id
+        )
+        pet.reload()
+        expect(str(pet.price)).to_equal('10.50')
+
+    def test_cached_instances_are_loaded_back(self):
+        user = fix.UserFactory.create()
+        team = models.Team.objects.create(name='test-team', users=[user])
+
+        handler = me.MongoEngineProvider(
+            self.server.application, HTTPServerRequest(method='GET', uri='/team/', connection=Mock()),
+            model=models.Team, name='team', prefix='', tree=me.MongoEngineProvider.get_tree(models.Team)
+        )
+        payload = pickle.loads(pickle.dumps(handler.serialize_instance(team), pickle.HIGHEST_PROTOCOL))
+        loaded = handler.deserialize_instance(models.Team, payload)
+
+        expect(loaded.id).to_equal(team.id)
+        expect(loaded.name).to_equal('test-team')
+        expect([member.id for member in loaded.users]).to_equal([user.id])
+
+    @testing.gen_test
+    def test_cached_instances_are_read_once(self):
+        user = fix.UserFactory.create()
+
+        for i in range(2):
+            response = yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+            expect(load_json(response.body)['name']).to_equal(user.name)
+
+        expect(self.server.instance_cache.get_stats()['hits']).to_equal(1)
+
+    @testing.gen_test
+    def test_counts_the_queries_run(self):
+        user = fix.UserFactory.create()
+
+        for i in range(2):
+            yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+        yield self.http_client.fetch(self.get_url('/cached_user/'))
+
+        expect(self.server.metrics.queries.values).to_equal({
+            ('cached_user', 'get_instance'): 1,
+            ('cached_user', 'count_list'): 1,
+            ('cached_user', 'get_list'): 1,
+        })
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_update(self):
+        user = fix.UserFactory.create()
+        yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_user/%s' % user.id),
+            method='PUT',
+            body='name=Rafael%20Floriano&email=rflorianobr@gmail.com'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+        expect(load_json(response.body)['name']).to_equal('Rafael Floriano')
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_user/%s' % user.id),
+            method='PATCH',
+            body='name=Bernardo'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+        expect(load_json(response.body)['name']).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_delete(self):
+        user = fix.UserFactory.create()
+        yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+
+        yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id), method='DELETE')
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/cached_user/%s' % user.id))
+
+        expect(err.error.code).to_equal(404)
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_association(self):
+        user = fix.UserFactory.create()
+        team = models.Team.objects.create(name='test-team')
+        yield self.http_client.fetch(self.get_url('/cached_team/%s' % team.id))
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_team/%s/users/' % team.id),
+            method='POST',
+            body='users[]=%s' % user.id
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_team/%s/users' % team.id))
+        expect(load_json(response.body)).to_length(1)
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_team/%s/users/%s' % (team.id, user.id)),
+            method='DELETE'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_team/%s/users' % team.id))
+        expect(load_json(response.body)).to_be_empty()
+
+    @testing.gen_test
+    def test_rate_limited_route_returns_429(self):
+        response = yield self.http_client.fetch(self.get_url('/limited_person/'))
+        expect(response.code).to_equal(200)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/limited_person/'))
+
+        expect(err.error.code).to_equal(429)
+        expect(int(err.error.response.headers['Retry-After'])).to_be_greater_than(0)
+
+    @testing.gen_test
+    def test_concurrency_limited_route_returns_429(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/busy_person/'))
+
+        expect(err.error.code).to_equal(429)
+        expect(err.error.response.headers['Retry-After']).to_equal('3')
@@ -10,15 +10,23 @@
 
 import locale
 
+from six.moves import cPickle as pickle
 import cow.server as server
 import cow.plugins.sqlalchemy_plugin as sqlalchemy_plugin
 import tornado.testing as testing
 from tornado.httpclient import HTTPError
+from tornado.httputil import HTTPServerRequest
+from mock import Mock
 from preggy import expect
 import derpconf.config as config
+import sqlalchemy as sa
 import bson.objectid as oid
 
 import bzz
+from bzz.cache import InstanceCache
+from bzz.filters import FilterError
+from bzz.metrics import Metrics
+from bzz.providers.sqlalchemy_provider import SQLAlchemyProvider
 import bzz.signals as signals
 import bzz.utils as utils
 import tests.base as base
@@ -40,8 +48,27 @@ class TestServer(server.Server):
         ]
 
     def get_handlers(self):
+        self.instance_cache = InstanceCache()
+        self.metrics = Metrics()
         routes = [
             bzz.ModelHive.routes_for('sqlalchemy', models.CustomQuerySet),
+            bzz.ModelHive.routes_for(
+                'sqlalchemy', models.Owner, resource_name='cached_owner', instance_cache=self.instance_cache,
+                metrics=self.metrics
+            ),
+            bzz.ModelHive.routes_for(
+                'sqlalchemy', models.Club, resource_name='cached_club', instance_cache=self.instance_cache
+            ),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Owner),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Club),
+            bzz.ModelHive.routes_for(
+                'sqlalchemy', models.Club, resource_name='versioned_club', version_field='updated_at'
+            ),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Pet),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Pet, resource_name='indexed_pet', indexed_filters_only=True),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Pet, resource_name='explained_pet', allow_explain=True),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Club, resource_name='unique_club', unique_associations=True),
+            bzz.ModelHive.routes_for('sqlalchemy', models.Tag),
         ]
         return bzz.flatten(routes)
 
@@ -52,6 +79,11 @@ class SQLAlchemyTestCase(base.ApiTestCase):
         self.server.application.db = self.server.application.get_sqlalchemy_session()
         models.Base.metadata.create_all(bind=self.server.application.db.connection())
         self.server.application.db.query(models.CustomQuerySet).delete()
+        self.server.application.db.execute(models.club_members_table.delete())
+        self.server.application.db.query(models.Club).delete()
+        self.server.application.db.query(models.Pet).delete()
+        self.server.application.db.query(models.Owner).delete()
+        self.server.application.db.query(models.Tag).delete()
 
     def get_config(self):
         return dict(
@@ -100,3 +132,419 @@ class SQLAlchemyTestCase(base.ApiTestCase):
                 self.get_url('/custom_query_set/%s' % user.id),
             )
         expect(err.error.code).to_equal(404)
+
+    def get_owner(self, pk):
+        self.server.application.db.expire_all()
+        return self.server.application.db.query(models.Owner).get(pk)
+
+    @testing.gen_test
+    def test_can_patch_owner(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/owner/%s' % owner.id),
+            method='PATCH',
+            body='age=33'
+        )
+
+        expect(response.code).to_equal(200)
+        owner = self.get_owner(owner.id)
+        expect(owner.age).to_equal(33)
+        expect(owner.name).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_cant_patch_owner_with_invalid_value(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/owner/%s' % owner.id),
+                method='PATCH',
+                body='age=old'
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(self.get_owner(owner.id).age).to_equal(32)
+
+    @testing.gen_test
+    def test_cant_patch_owner_breaking_constraints(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/owner/%s' % owner.id),
+                method='PATCH',
+                body=utils.dumps({'name': None}),
+                headers={'Content-Type': 'application/json'}
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(self.get_owner(owner.id).name).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_cant_patch_owner_with_too_long_values(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/owner/%s' % owner.id),
+                method='PATCH',
+                body='name=%s' % ('a' * 2001)
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(self.get_owner(owner.id).name).to_equal('Bernardo')
+
+    @testing.gen_test
+    def test_patch_runs_validators(self):
+        tag = models.Tag(name='bzz')
+        tag.save(self.server.application.db)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/tag/%s' % tag.id),
+            method='PATCH',
+            body='name=+Tornado+'
+        )
+
+        expect(response.code).to_equal(200)
+        self.server.application.db.expire_all()
+        expect(self.server.application.db.query(models.Tag).get(tag.id).name).to_equal('tornado')
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/tag/%s' % tag.id),
+                method='PATCH',
+                body='name=%s' % ('a' * 201)
+            )
+
+        expect(err.error.code).to_equal(400)
+
+    def count_members(self, club):
+        query = sa.select([sa.func.count()]).select_from(models.club_members_table).where(
+            models.club_members_table.c.club_id == club.id
+        )
+        return self.server.application.db.execute(query).scalar()
+
+    @testing.gen_test
+    def test_can_associate_member_to_club(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz')
+        club.save(self.server.application.db)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/club/%s/members/' % club.id),
+            method='POST',
+            body='members[]=%s' % owner.id
+        )
+
+        expect(response.code).to_equal(200)
+        expect(self.count_members(club)).to_equal(1)
+
+    @testing.gen_test
+    def test_associating_member_twice_adds_it_twice(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz')
+        club.save(self.server.application.db)
+
+        for i in range(2):
+            yield self.http_client.fetch(
+                self.get_url('/club/%s/members/' % club.id),
+                method='POST',
+                body='members[]=%s' % owner.id
+            )
+
+        expect(self.count_members(club)).to_equal(2)
+
+    @testing.gen_test
+    def test_associating_member_twice_with_unique_associations_adds_it_once(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz')
+        club.save(self.server.application.db)
+
+        for i in range(2):
+            yield self.http_client.fetch(
+                self.get_url('/unique_club/%s/members/' % club.id),
+                method='POST',
+                body='members[]=%s' % owner.id
+            )
+
+        expect(self.count_members(club)).to_equal(1)
+
+    def get_club_version(self, club):
+        self.server.application.db.expire_all()
+        return self.server.application.db.query(models.Club).get(club.id).updated_at
+
+    def clear_club_version(self, club):
+        table = models.Club.__table__
+        self.server.application.db.execute(table.update().values(updated_at=None).where(table.c.id == club.id))
+        self.server.application.db.commit()
+
+    @testing.gen_test
+    def test_partial_and_association_updates_change_the_version(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz')
+        club.save(self.server.application.db)
+
+        yield self.http_client.fetch(
+            self.get_url('/versioned_club/%s' % club.id),
+            method='PATCH',
+            body='name=tornado'
+        )
+        expect(self.get_club_version(club)).not_to_be_null()
+
+        self.clear_club_version(club)
+        yield self.http_client.fetch(
+            self.get_url('/versioned_club/%s/members/' % club.id),
+            method='POST',
+            body='members[]=%s' % owner.id
+        )
+        expect(self.get_club_version(club)).not_to_be_null()
+        expect(self.count_members(club)).to_equal(1)
+
+        self.clear_club_version(club)
+        yield self.http_client.fetch(
+            self.get_url('/versioned_club/%s/members/%s' % (club.id, owner.id)),
+            method='DELETE'
+        )
+        expect(self.get_club_version(club)).not_to_be_null()
+        expect(self.count_members(club)).to_equal(0)
+
+    @testing.gen_test
+    def test_can_remove_member_from_club(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz', members=[owner])
+        club.save(self.server.application.db)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/club/%s/members/%s' % (club.id, owner.id)),
+            method='DELETE'
+        )
+
+        expect(response.code).to_equal(200)
+        expect(self.count_members(club)).to_equal(0)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/club/%s/members/%s' % (club.id, owner.id)),
+                method='DELETE'
+            )
+
+        expect(err.error.code).to_equal(400)
+
+    @testing.gen_test
+    def test_can_associate_and_remove_pet_of_owner(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        pet = models.Pet(name='Rex')
+        pet.save(self.server.application.db)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/owner/%s/pets/' % owner.id),
+            method='POST',
+            body='pets[]=%s' % pet.id
+        )
+
+        expect(response.code).to_equal(200)
+        self.server.application.db.expire_all()
+        expect(self.server.application.db.query(models.Pet).get(pet.id).owner_id).to_equal(owner.id)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/owner/%s/pets/%s' % (owner.id, pet.id)),
+            method='DELETE'
+        )
+
+        expect(response.code).to_equal(200)
+        self.server.application.db.expire_all()
+        expect(self.server.application.db.query(models.Pet).get(pet.id).owner_id).to_be_null()
+
+    def get_handler(self, model, name):
+        return SQLAlchemyProvider(
+            self.server.application, HTTPServerRequest(method='GET', uri='/%s/' % name, connection=Mock()),
+            model=model, name=name, prefix='', tree=SQLAlchemyProvider.get_tree(model)
+        )
+
+    def test_cached_instances_are_loaded_back(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+        handler = self.get_handler(models.Owner, 'owner')
+
+        payload = pickle.loads(pickle.dumps(handler.serialize_instance(owner), pickle.HIGHEST_PROTOCOL))
+        self.server.application.db.expunge_all()
+        loaded = handler.deserialize_instance(models.Owner, payload)
+
+        expect(loaded.id).to_equal(owner.id)
+        expect(loaded.name).to_equal('Bernardo')
+        expect(loaded.age).to_equal(32)
+        expect(loaded in self.server.application.db).to_be_true()
+
+    @testing.gen_test
+    def test_cached_instances_are_read_once(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        for i in range(2):
+            response = yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+            expect(load_json(response.body)['name']).to_equal('Bernardo')
+
+        expect(self.server.instance_cache.get_stats()['hits']).to_equal(1)
+
+    @testing.gen_test
+    def test_counts_the_queries_run(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+
+        for i in range(2):
+            yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+        yield self.http_client.fetch(self.get_url('/cached_owner/'))
+
+        expect(self.server.metrics.queries.values).to_equal({
+            ('cached_owner', 'get_instance'): 1,
+            ('cached_owner', 'count_list'): 1,
+            ('cached_owner', 'get_list'): 1,
+        })
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_update(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+        yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_owner/%s' % owner.id),
+            method='PUT',
+            body='name=Rafael&age=30'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+        expect(load_json(response.body)['name']).to_equal('Rafael')
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_owner/%s' % owner.id),
+            method='PATCH',
+            body='age=31'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+        expect(load_json(response.body)['age']).to_equal(31)
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_delete(self):
+        owner = models.Owner(name='Bernardo', age=32)
+        owner.save(self.server.application.db)
+        yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+
+        yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id), method='DELETE')
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/cached_owner/%s' % owner.id))
+
+        expect(err.error.code).to_equal(404)
+
+    @testing.gen_test
+    def test_cached_instances_are_invalidated_on_association(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        club = models.Club(name='bzz')
+        club.save(self.server.application.db)
+        yield self.http_client.fetch(self.get_url('/cached_club/%s' % club.id))
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_club/%s/members/' % club.id),
+            method='POST',
+            body='members[]=%s' % owner.id
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_club/%s/members' % club.id))
+        expect(load_json(response.body)).to_length(1)
+
+        yield self.http_client.fetch(
+            self.get_url('/cached_club/%s/members/%s' % (club.id, owner.id)),
+            method='DELETE'
+        )
+        response = yield self.http_client.fetch(self.get_url('/cached_club/%s/members' % club.id))
+        expect(load_json(response.body)).to_be_empty()
+
+    def create_pets(self):
+        owner = models.Owner(name='Bernardo')
+        owner.save(self.server.application.db)
+        models.Pet(name='Rex', price='10.50', owner=owner).save(self.server.application.db)
+        models.Pet(name='Fido', price='2').save(self.server.application.db)
+        return owner
+
+    def test_filters_by_references_use_the_foreign_key(self):
+        handler = self.get_handler(models.Pet, 'pet')
+
+        expect(handler.get_filter_column('owner')).to_equal(models.Pet.__table__.c.owner_id)
+        expect(handler.get_filter_column('price')).to_equal(models.Pet.__table__.c.price)
+
+    def test_filters_by_lists_and_joins_are_refused(self):
+        with expect.error_to_happen(FilterError):
+            self.get_handler(models.Club, 'club').get_filter_column('members')
+
+        with expect.error_to_happen(FilterError):
+            self.get_handler(models.Pet, 'pet').get_filter_column('owner.name')
+
+    def test_indexed_paths_include_keys_and_indexes(self):
+        expect(SQLAlchemyProvider.get_indexed_paths(models.Pet)).to_equal(set(['id', 'owner_id', 'owner']))
+        expect(SQLAlchemyProvider.get_indexed_paths(models.Owner)).to_equal(set(['id']))
+
+    @testing.gen_test
+    def test_can_filter_pets_by_reference_and_decimal(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(self.get_url('/pet/?owner=%s' % owner.id))
+        expect([pet['name'] for pet in load_json(response.body)]).to_equal(['Rex'])
+
+        response = yield self.http_client.fetch(self.get_url('/pet/?price__lt=5'))
+        expect([pet['name'] for pet in load_json(response.body)]).to_equal(['Fido'])
+
+    @testing.gen_test
+    def test_filtering_pets_by_invalid_values_fails_with_400(self):
+        self.create_pets()
+
+        for query in ['owner=not-an-id', 'price__gte=abc']:
+            err = expect.error_to_happen(HTTPError)
+            with err:
+                yield self.http_client.fetch(self.get_url('/pet/?%s' % query))
+
+            expect(err.error.code).to_equal(400)
+
+    @testing.gen_test
+    def test_indexed_filters_only_refuses_filters_by_columns_not_indexed(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(self.get_url('/indexed_pet/?owner=%s' % owner.id))
+        expect(load_json(response.body)).to_length(1)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/indexed_pet/?name=Rex'))
+
+        expect(err.error.code).to_equal(400)
+
+    @testing.gen_test
+    def test_can_explain_list_queries(self):
+        owner = self.create_pets()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/explained_pet/?owner=%s&sort=-name&_explain=1' % owner.id)
+        )
+
+        plan = load_json(response.body)
+        expect(plan['query']['sql']).to_include('PetTable')
+        expect(plan['query']['plan']).not_to_be_empty()
+        expect(plan['count_query']['sql']).to_include('count')
+        expect(plan['count_query']['plan']).not_to_be_empty()
+
@@ -8,6 +8,8 @@
 # http://www.opensource.org/licenses/MIT-license
 # Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
 
+import time
+
 from mock import Mock, patch
 
 import cow.server as server
@@ -24,6 +26,7 @@ import bzz.utils as utils
 import tests.base as base
 from bzz.providers.google import GoogleProvider
 from bzz.providers.mock import MockProvider
+from bzz.sessions import MemorySessionStore
 
 
 def load_json(json_string):
@@ -46,6 +49,16 @@ class TestAuthHandler(RequestHandler):
         self.write('OK')
 
 
+class TestMultipleAuthHandler(RequestHandler):
+
+    @bzz.authenticated
+    @gen.coroutine
+    def get(self):
+        yield signals.pre_get_instance.send(handler=self)
+        yield signals.pre_get_list.send(handler=self)
+        self.write(str(self.current_user['sub']))
+
+
 class TestServer(server.Server):
 
     def __init__(self, *args, **kwargs):
@@ -60,7 +73,8 @@ class TestServer(server.Server):
         ])
 
         handlers_list += [
-            ('/test_authentication/', TestAuthHandler)
+            ('/test_authentication/', TestAuthHandler),
+            ('/test_multiple_authentication/', TestMultipleAuthHandler),
         ]
         return handlers_list
 
@@ -354,6 +368,21 @@ class AuthHiveTestCase(BaseAuthHiveTestCase):
         expect(response.code).to_equal(200)
         expect(response.body).to_equal('OK')
 
+    @testing.gen_test
+    def test_decodes_token_only_once_per_request(self):
+        decode = utils.Jwt.decode
+        with patch.object(utils.Jwt, 'decode', autospec=True, side_effect=decode) as decode_mock:
+            response = yield self.http_client.fetch(
+                self.get_url('/test_multiple_authentication/'),
+                headers={'Cookie': self.mock_auth_cookie(
+                    user_id=10, provider='mock', data={'id': 10}
+                )}
+            )
+
+        expect(response.code).to_equal(200)
+        expect(response.body).to_equal('10')
+        expect(decode_mock.call_count).to_equal(1)
+
     @testing.gen_test
     def test_cant_make_a_request_in_a_decorated_method_as_anonymous(self):
         try:
@@ -388,6 +417,109 @@ class AuthHiveTestCase(BaseAuthHiveTestCase):
         expect(utils.loads(response.body)).to_equal({'loggedOut': True})
 
 
+class SessionAuthHiveTestCase(BaseAuthHiveTestCase):
+
+    def get_app(self):
+        app = super(SessionAuthHiveTestCase, self).get_app()
+        self.session_store = MemorySessionStore()
+        bzz.AuthHive.configure(
+            app,
+            cookie_name='TEST_AUTH_COOKIE',
+            secret_key='TEST_SECRET_KEY',
+            session_store=self.session_store
+        )
+        return app
+
+    def get_server(self):
+        cfg = config.Config(**self.get_config())
+        self.server = TestServer(config=cfg, io_loop=self.io_loop)
+        return self.server
+
+    @gen.coroutine
+    def signin(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/auth/signin/'),
+            method='POST',
+            body=utils.dumps({
+                'access_token': '1234567890', 'provider': 'mock',
+                'name': 'Much Name', 'email': 'Such@email.doge'
+            })
+        )
+        raise gen.Return(response.headers.get('Set-Cookie').split(';')[0])
+
+    @testing.gen_test
+    def test_cookie_only_carries_session_id(self):
+        cookie = yield self.signin()
+        token = cookie.split('=', 1)[1].strip('"')
+
+        payload = self.server.application.authentication_options['jwt'].decode(token)
+        expect(payload).to_include('sid')
+        expect(payload).not_to_include('data')
+        expect(payload).not_to_include('token')
+
+        session = self.session_store.get(payload['sid'])
+        expect(session['token']).to_equal('1234567890')
+        expect(session['data']['name']).to_equal('Much Name')
+
+    @testing.gen_test
+    def test_can_check_authenticated_request(self):
+        cookie = yield self.signin()
+        response = yield self.http_client.fetch(
+            self.get_url('/auth/me/'), headers={'Cookie': cookie}
+        )
+
+        expect(response.code).to_equal(200)
+        expect(load_json(response.body)['userData']).to_be_like(dict(
+            id='123', name='Much Name', email='Such@email.doge'
+        ))
+
+    @testing.gen_test
+    def test_can_make_a_request_in_a_decorated_method_as_authenticated(self):
+        cookie = yield self.signin()
+        response = yield self.http_client.fetch(
+            self.get_url('/test_multiple_authentication/'), headers={'Cookie': cookie}
+        )
+
+        expect(response.code).to_equal(200)
+        expect(response.body).to_equal('123')
+
+    @testing.gen_test
+    def test_sessions_are_renewed_after_half_of_their_lifetime(self):
+        cookie = yield self.signin()
+        self.session_store.touch = Mock()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/test_multiple_authentication/'), headers={'Cookie': cookie}
+        )
+        expect(response.headers.get('Set-Cookie')).to_be_null()
+        expect(self.session_store.touch.called).to_be_false()
+
+        jwt = self.server.application.authentication_options['jwt']
+        name, token = cookie.split('=', 1)
+        payload = jwt.decode(token.strip('"'))
+        payload['iat'] = int(time.time()) - 601
+        cookie = '%s=%s' % (name, jwt.encode(payload).decode('utf-8'))
+
+        response = yield self.http_client.fetch(
+            self.get_url('/test_multiple_authentication/'), headers={'Cookie': cookie}
+        )
+        expect(response.headers.get('Set-Cookie')).to_include(name)
+        expect(self.session_store.touch.called).to_be_true()
+
+    @testing.gen_test
+    def test_signout_removes_session(self):
+        cookie = yield self.signin()
+        yield self.http_client.fetch(
+            self.get_url('/auth/signout/'), method='POST', body='',
+            headers={'Cookie': cookie}
+        )
+
+        response = yield self.http_client.fetch(
+            self.get_url('/auth/me/'), headers={'Cookie': cookie}
+        )
+        expect(load_json(response.body)).to_equal(dict(authenticated=False))
+
+
 class PrefixedAuthHiveTestCase(BaseAuthHiveTestCase):
 
     def get_app(self):
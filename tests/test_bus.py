@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import os
+import socket
+import shutil
+import tempfile
+
+from mock import patch
+from preggy import expect
+import tornado.gen as gen
+import tornado.testing as testing
+
+from bzz.bus import EventBus
+from bzz.cache import InstanceCache, ListCache
+from bzz.feeds import ChangeFeed
+import bzz.signals as signals
+
+
+class User(object):
+    pass
+
+
+class EventBusTestCase(testing.AsyncTestCase):
+    def setUp(self):
+        super(EventBusTestCase, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'bus')
+        self.first = EventBus(self.path)
+        self.second = EventBus(self.path)
+        self.first.start(name='first')
+        self.second.start(name='second')
+
+        self.changes = []
+        signals.remote_instance_changed.connect(self.on_remote_change)
+
+    def tearDown(self):
+        signals.remote_instance_changed.disconnect(self.on_remote_change)
+        self.first.stop()
+        self.second.stop()
+        shutil.rmtree(os.path.dirname(self.path))
+        super(EventBusTestCase, self).tearDown()
+
+    def on_remote_change(self, sender, event_type=None, data=None, **kwargs):
+        self.changes.append((sender, event_type, data))
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+    @testing.gen_test
+    def test_relays_changes_to_the_other_processes(self):
+        self.first.on_change(User, 'update', {'id': '1', 'fields': ['name']})
+        yield self.wait_for(lambda: self.changes)
+
+        expect(self.changes).to_equal([(User, 'update', {'id': '1', 'fields': ['name']})])
+        expect(self.first.get_stats()).to_equal({'sent': 1, 'received': 0, 'dropped': 0})
+        expect(self.second.get_stats()).to_equal({'sent': 0, 'received': 1, 'dropped': 0})
+
+    @testing.gen_test
+    def test_relays_changes_from_signals(self):
+        # as if the signal was sent in the first process only
+        self.second.disconnect()
+
+        yield signals.post_delete_instance.send(User, instance=None, handler=None)
+        yield self.wait_for(lambda: self.second.received)
+
+        expect(self.changes).to_equal([(User, 'delete', {'id': None})])
+
+    @testing.gen_test
+    def test_caches_and_feeds_see_remote_changes(self):
+        instance_cache = InstanceCache()
+        list_cache = ListCache()
+        feed = ChangeFeed(heartbeat=None)
+        instance_cache.set(User, '1', {'name': 'bernardo'})
+
+        self.first.on_change(User, 'update', {'id': '1'})
+        yield self.wait_for(lambda: self.changes)
+
+        expect(instance_cache.get(User, '1')).to_be_null()
+        expect(list_cache.invalidations).to_equal(1)
+        expect(feed.last_event_id).to_equal(1)
+
+    def test_removes_sockets_of_processes_that_are_gone(self):
+        address = os.path.join(self.path, 'gone.sock')
+        gone = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        gone.bind(address)
+        gone.close()
+
+        self.first.on_change(User, 'create', {'id': '1'})
+
+        expect(os.path.exists(address)).to_be_false()
+        expect(self.first.sent).to_equal(1)
+
+    def test_ignores_invalid_messages(self):
+        self.second.receive(b'{"model": "tests.test_bus.Team"}')
+        self.second.receive(b'invalid')
+
+        expect(self.changes).to_be_empty()
+
+    @testing.gen_test
+    def test_logs_errors_of_receivers(self):
+        def fail(sender, **kwargs):
+            raise RuntimeError('failed')
+
+        signals.remote_instance_changed.connect(fail)
+        try:
+            with patch('bzz.bus.logging') as logging:
+                self.second.receive(b'{"model": "tests.test_bus.User", "type": "delete", "data": {"id": "1"}}')
+                yield self.wait_for(lambda: logging.error.called)
+        finally:
+            signals.remote_instance_changed.disconnect(fail)
+
+        expect(logging.error.call_args[1]['exc_info'][0]).to_equal(RuntimeError)
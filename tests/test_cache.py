@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import time
+
+from preggy import expect
+import tornado.gen as gen
+import tornado.testing as testing
+
+from bzz.cache import InstanceCache, ListCache, RedisCache, SingleFlight
+from bzz.filters import Filter
+import bzz.signals as signals
+import tests.base as base
+
+
+class User(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Team(object):
+    @classmethod
+    def get_instance_queryset(cls, model, queryset, instance_id, handler):
+        return queryset
+
+    @classmethod
+    def get_list_queryset(cls, queryset, handler):
+        return queryset
+
+
+class FakeRedis(object):
+    '''Stand-in for a redis client, implementing only what the cache uses.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, 0))
+        if expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value, time.time() + ex)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class InstanceCacheTestCase(base.TestCase):
+    def test_can_cache_instances(self):
+        cache = InstanceCache()
+        cache.set(User, '1', {'name': 'bernardo'})
+
+        expect(cache.get(User, '1')).to_equal({'name': 'bernardo'})
+        expect(cache.get(User, '2')).to_be_null()
+        expect(cache.get_stats()).to_equal({'hits': 1, 'misses': 1, 'invalidations': 0})
+
+    def test_returns_copies_of_the_cached_payload(self):
+        cache = InstanceCache()
+        cache.set(User, '1', {'name': 'bernardo'})
+        cache.get(User, '1')['name'] = 'changed'
+
+        expect(cache.get(User, '1')).to_equal({'name': 'bernardo'})
+
+    def test_can_invalidate_instances(self):
+        cache = InstanceCache()
+        cache.set(User, 1, {'name': 'bernardo'})
+        cache.invalidate(User, '1')
+
+        expect(cache.get(User, 1)).to_be_null()
+        expect(cache.invalidations).to_equal(1)
+
+    def test_models_opt_in(self):
+        cache = InstanceCache(models=[User])
+
+        expect(cache.is_enabled(User)).to_be_true()
+        expect(cache.is_enabled(Team)).to_be_false()
+
+    def test_models_filtering_instances_per_request_are_not_cached(self):
+        expect(InstanceCache().is_enabled(Team)).to_be_false()
+
+    def test_can_share_instances_through_redis(self):
+        client = FakeRedis()
+        first = InstanceCache(backend=RedisCache(client, ttl=10))
+        second = InstanceCache(backend=RedisCache(client, ttl=10))
+
+        first.set(User, '1', {'name': 'bernardo'})
+        expect(second.get(User, '1')).to_equal({'name': 'bernardo'})
+        expect(list(client.data.keys())).to_equal(['bzz:cache:tests.test_cache.User:1'])
+
+        second.invalidate(User, '1')
+        expect(first.get(User, '1')).to_be_null()
+
+
+class SingleFlightTestCase(testing.AsyncTestCase):
+    def setUp(self):
+        super(SingleFlightTestCase, self).setUp()
+        self.flights = SingleFlight()
+        self.calls = 0
+
+    @gen.coroutine
+    def load(self, fail=False):
+        self.calls += 1
+        result = self.calls
+        yield gen.moment
+        if fail:
+            raise ValueError('failed')
+        raise gen.Return(result)
+
+    @testing.gen_test
+    def test_concurrent_calls_share_the_same_future(self):
+        first = self.flights.run('user:1', self.load)
+        second = self.flights.run('user:1', self.load)
+        other = self.flights.run('user:2', self.load)
+
+        expect(first is second).to_be_true()
+        results = yield [first, second, other]
+
+        expect(results).to_equal([1, 1, 2])
+        expect(self.flights.coalesced).to_equal(1)
+
+    @testing.gen_test
+    def test_calls_after_the_flight_ends_run_again(self):
+        yield self.flights.run('user:1', self.load)
+        yield gen.moment
+
+        expect(self.flights.is_running('user:1')).to_be_false()
+        result = yield self.flights.run('user:1', self.load)
+        expect(result).to_equal(2)
+
+    @testing.gen_test
+    def test_errors_are_shared(self):
+        futures = [self.flights.run('user:1', lambda: self.load(fail=True)) for i in range(2)]
+
+        for future in futures:
+            with expect.error_to_happen(ValueError, message='failed'):
+                yield future
+
+        expect(self.calls).to_equal(1)
+
+
+class ListCacheTestCase(testing.AsyncTestCase):
+    def setUp(self):
+        super(ListCacheTestCase, self).setUp()
+        self.cache = ListCache(get_scope=lambda handler: handler)
+        self.created = 0
+
+    @gen.coroutine
+    def create(self):
+        self.created += 1
+        yield gen.moment
+        raise gen.Return('[%d]' % self.created)
+
+    def test_keys_depend_on_the_whole_query(self):
+        key = self.cache.get_key(User, 'anonymous', 1, 20, [Filter('name', 'eq', 'b')], [])
+
+        expect(self.cache.get_key(User, 'anonymous', 1, 20, [Filter('name', 'eq', 'b')], [])).to_equal(key)
+        expect(key).to_match(r'^list:tests.test_cache.User:[0-9a-f]{32}:[0-9a-f]{40}$')
+
+        for other in [
+                self.cache.get_key(User, 'sub:1', 1, 20, [Filter('name', 'eq', 'b')], []),
+                self.cache.get_key(User, 'anonymous', 2, 20, [Filter('name', 'eq', 'b')], []),
+                self.cache.get_key(User, 'anonymous', 1, 20, [Filter('name', 'ne', 'b')], []),
+                self.cache.get_key(User, 'anonymous', 1, 20, [Filter('name', 'eq', 'b')], [('name', True)]),
+                self.cache.get_key(Team, 'anonymous', 1, 20, [Filter('name', 'eq', 'b')], []),
+        ]:
+            expect(other).not_to_equal(key)
+
+    def test_models_filtering_lists_per_request_need_an_explicit_scope(self):
+        expect(ListCache().is_enabled(User)).to_be_true()
+        expect(ListCache().is_enabled(Team)).to_be_false()
+        expect(self.cache.is_enabled(Team)).to_be_true()
+
+    @testing.gen_test
+    def test_caches_responses(self):
+        key = self.cache.get_key(User, 'anonymous', 1, 20, [], [])
+
+        first = yield self.cache.get_or_create(key, self.create)
+        second = yield self.cache.get_or_create(key, self.create)
+
+        expect(first).to_equal('[1]')
+        expect(second).to_equal('[1]')
+        expect(self.cache.get_stats()).to_equal({'hits': 1, 'misses': 1, 'coalesced': 0, 'invalidations': 0})
+
+    @testing.gen_test
+    def test_concurrent_requests_share_the_same_query(self):
+        key = self.cache.get_key(User, 'anonymous', 1, 20, [], [])
+
+        responses = yield [self.cache.get_or_create(key, self.create) for i in range(3)]
+
+        expect(responses).to_equal(['[1]', '[1]', '[1]'])
+        expect(self.created).to_equal(1)
+        expect(self.cache.get_stats()['coalesced']).to_equal(2)
+
+    @testing.gen_test
+    def test_changes_to_instances_invalidate_the_model_lists(self):
+        key = self.cache.get_key(User, 'anonymous', 1, 20, [], [])
+        yield self.cache.get_or_create(key, self.create)
+
+        yield signals.post_update_instance.send(User, instance=None, updated_fields={}, handler=None)
+
+        new_key = self.cache.get_key(User, 'anonymous', 1, 20, [], [])
+        expect(new_key).not_to_equal(key)
+
+        response = yield self.cache.get_or_create(new_key, self.create)
+        expect(response).to_equal('[2]')
+        expect(self.cache.invalidations).to_equal(1)
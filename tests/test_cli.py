@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import os
+import time
+
+from mock import Mock, patch
+from preggy import expect
+import tornado.gen as gen
+import tornado.web
+import tornado.testing as testing
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+
+from bzz.cli import load_application, get_parser, DrainingDelegate, Worker, Supervisor
+from bzz.feeds import ChangeFeed
+import tests.base as base
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        self.application.started = True
+        yield gen.sleep(0.1)
+        self.write('done')
+
+
+class HangingHandler(tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        self.application.started = True
+        # never finishes, like a stream nobody writes to
+        yield Future()
+
+
+routes = [
+    tornado.web.url('/slow', SlowHandler, name='slow'),
+    tornado.web.url('/hanging', HangingHandler),
+]
+
+application = tornado.web.Application(routes)
+
+
+def get_routes():
+    return routes
+
+
+class LoadApplicationTestCase(base.TestCase):
+    def test_loads_routes(self):
+        for target in ['tests.test_cli:routes', 'tests.test_cli', 'tests.test_cli:get_routes']:
+            app = load_application(target)
+            expect(app).to_be_instance_of(tornado.web.Application)
+            expect(app.reverse_url('slow')).to_equal('/slow')
+
+    def test_loads_applications(self):
+        expect(load_application('tests.test_cli:application')).to_equal(application)
+
+    def test_parses_the_options(self):
+        options = get_parser().parse_args(['tests.test_cli:routes', '-p', '9000', '-n', '4', '--grace-period', '2.5'])
+        expect(options.application).to_equal('tests.test_cli:routes')
+        expect(options.port).to_equal(9000)
+        expect(options.processes).to_equal(4)
+        expect(options.grace_period).to_equal(2.5)
+        expect(options.reuse_port).to_be_false()
+
+
+class DrainingDelegateTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.application = tornado.web.Application(routes)
+        self.application.started = False
+        self.delegate = DrainingDelegate(self.application)
+        return self.delegate
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+    @testing.gen_test
+    def test_counts_the_requests_being_processed(self):
+        response = self.http_client.fetch(self.get_url('/slow'))
+        yield self.wait_for(lambda: self.application.started)
+        expect(self.delegate.active).to_equal(1)
+
+        response = yield response
+        expect(response.body).to_equal(b'done')
+
+        # the connection is kept alive, waiting for another request
+        expect(self.delegate.active).to_equal(0)
+
+    @testing.gen_test
+    def test_requests_whose_connection_is_closed_are_not_waited_for(self):
+        stream = yield TCPClient().connect('127.0.0.1', self.get_http_port())
+        yield stream.write(b'GET /hanging HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        yield self.wait_for(lambda: self.application.started)
+        expect(self.delegate.active).to_equal(1)
+
+        stream.close()
+        yield self.wait_for(lambda: self.delegate.active == 0)
+        expect(self.delegate.connections).to_be_empty()
+
+
+class WorkerTestCase(base.TestCase):
+    def test_stops_the_bus_when_drained(self):
+        bus = Mock()
+        worker = Worker(application, sockets=[], bus=bus)
+        worker.server = Mock()
+
+        with patch('bzz.cli.IOLoop') as loop:
+            worker.stop()
+
+        expect(worker.server.stop.called).to_be_true()
+        expect(bus.stop.called).to_be_true()
+        expect(loop.current().stop.called).to_be_true()
+
+    def test_ends_the_streams_of_change_feeds_when_stopping(self):
+        feed = ChangeFeed(heartbeat=None)
+        subscriber = Mock()
+        feed.subscribe(Mock, subscriber)
+        worker = Worker(application, sockets=[])
+        worker.server = Mock()
+
+        with patch('bzz.cli.IOLoop'):
+            worker.stop()
+
+        expect(subscriber.close.called).to_be_true()
+
+
+class SupervisorTestCase(base.TestCase):
+    def get_delays(self, supervisor, started=None):
+        delays = []
+        for i in range(4):
+            delays.append(supervisor.schedule_restart(0, started))
+        return delays
+
+    def test_workers_that_keep_crashing_are_restarted_later_and_later(self):
+        supervisor = Supervisor(1, None, backoff=1, max_backoff=5)
+
+        expect(self.get_delays(supervisor, time.time())).to_equal([1, 2, 4, 5])
+        expect(supervisor.restarts[0]).to_be_greater_than(time.time() + 4)
+
+    def test_workers_that_ran_for_a_while_are_restarted_soon(self):
+        supervisor = Supervisor(1, None, backoff=1, max_backoff=5)
+        self.get_delays(supervisor)
+
+        expect(supervisor.schedule_restart(0, time.time() - 10)).to_equal(1)
+
+    def test_restarts_workers_when_due(self):
+        supervisor = Supervisor(2, None)
+        supervisor.spawn = Mock()
+        supervisor.restarts = {0: time.time() - 1, 1: time.time() + 10}
+
+        supervisor.spawn_restarts()
+
+        supervisor.spawn.assert_called_once_with(0)
+        expect(list(supervisor.restarts.keys())).to_equal([1])
+
+    def test_workers_get_their_own_ioloop(self):
+        parent = IOLoop.instance()
+        read_fd, write_fd = os.pipe()
+
+        def run_worker(number):
+            io_loop = IOLoop.current()
+            own = io_loop is not parent and IOLoop.instance() is io_loop
+            os.write(write_fd, b'1' if own else b'0')
+
+        supervisor = Supervisor(1, run_worker)
+        supervisor.spawn(0)
+        pid, status = os.waitpid(list(supervisor.workers)[0], 0)
+
+        expect(os.read(read_fd, 1)).to_equal(b'1')
+        expect(status).to_equal(0)
+        os.close(read_fd)
+        os.close(write_fd)
@@ -0,0 +1,438 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+from datetime import datetime
+
+from preggy import expect
+import tornado.gen as gen
+import tornado.web
+import tornado.testing as testing
+from tornado.httpclient import HTTPError, HTTPRequest
+from tornado.websocket import websocket_connect
+
+import bzz
+import bzz.model as model
+import bzz.signals as signals
+import bzz.utils as utils
+from bzz.feeds import ChangeFeed, Subscription, merge_changes
+from bzz.filters import Filter
+from bzz.limits import ConcurrencyLimiter
+import tests.base as base
+from tests.test_models import Field
+
+
+def parse_event(event):
+    fields = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+    return fields['id'], fields['event'], utils.loads(fields['data'])
+
+
+class User(object):
+    fields = {'name': Field(), 'age': Field(coerce=int)}
+
+
+class Team(object):
+    fields = {}
+
+
+class FakeHandler(object):
+    def __init__(self, model, path):
+        self.model = model
+        self.path_args = [path, '']
+
+    @gen.coroutine
+    def get_instance_id(self, instance):
+        raise gen.Return(instance.id)
+
+
+class FakeSubscriber(object):
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def push(self, event):
+        self.events.append(event)
+
+    def close(self):
+        self.closed = True
+
+
+class ChangeFeedTestCase(base.TestCase):
+    def setUp(self):
+        self.feed = ChangeFeed(history_size=2, heartbeat=None)
+        self.subscriber = FakeSubscriber()
+
+    def test_publishes_to_the_subscribers_of_the_model(self):
+        self.feed.subscribe(User, self.subscriber)
+        self.feed.publish(User, 'create', {'id': '1'})
+        self.feed.publish(Team, 'create', {'id': '2'})
+
+        expect(self.subscriber.events).to_equal([
+            'id: %s\nevent: create\ndata: {"id": "1"}\n\n' % self.feed.get_event_id(1)
+        ])
+
+    def test_publishes_changes_from_signals(self):
+        self.feed.subscribe(User, self.subscriber)
+        self.feed.subscribe(Team, self.subscriber)
+
+        team = Team()
+        team.id = '2'
+        signals.post_create_instance.send(Team, instance=team, handler=FakeHandler(User, 'user/1'))
+        signals.post_update_instance.send(
+            User, instance=None, updated_fields={'name': {}}, handler=FakeHandler(User, 'user/3')
+        )
+
+        expect([parse_event(event) for event in self.subscriber.events]).to_equal([
+            (self.feed.get_event_id(1), 'create', {'id': '2'}),
+            (self.feed.get_event_id(2), 'update', {'id': '1'}),
+            (self.feed.get_event_id(3), 'update', {'id': '3', 'fields': ['name']}),
+        ])
+
+    def test_replays_events_since_the_last_one_the_client_got(self):
+        for instance_id in ['1', '2', '3']:
+            self.feed.publish(User, 'delete', {'id': instance_id})
+
+        events = self.feed.subscribe(User, self.subscriber, last_event_id=self.feed.get_event_id(2))
+        expect(events).to_equal(['id: %s\nevent: delete\ndata: {"id": "3"}\n\n' % self.feed.get_event_id(3)])
+
+        expect(self.feed.subscribe(User, self.subscriber, last_event_id=self.feed.get_event_id(3))).to_be_empty()
+
+    def test_clients_that_missed_events_no_longer_kept_are_reset(self):
+        for instance_id in ['1', '2', '3']:
+            self.feed.publish(User, 'delete', {'id': instance_id})
+
+        for last_event_id in [self.feed.get_event_id(0), self.feed.get_event_id(10), 'invalid']:
+            events = self.feed.subscribe(User, self.subscriber, last_event_id=last_event_id)
+            expect(events).to_equal(['id: %s\nevent: reset\ndata: {}\n\n' % self.feed.get_event_id(3)])
+
+    def test_clients_that_got_events_from_other_processes_are_reset(self):
+        for instance_id in ['1', '2', '3']:
+            self.feed.publish(User, 'delete', {'id': instance_id})
+        last_event_id = self.feed.get_event_id(2)
+
+        events = self.feed.subscribe(User, self.subscriber, last_event_id='1234.other-2')
+        expect(events).to_equal(['id: %s\nevent: reset\ndata: {}\n\n' % self.feed.get_event_id(3)])
+
+        # as if forked
+        self.feed.pid = None
+        events = self.feed.subscribe(User, self.subscriber, last_event_id=last_event_id)
+        expect(events).to_equal(['id: %s\nevent: reset\ndata: {}\n\n' % self.feed.get_event_id(0)])
+
+    def test_notifies_subscriptions_to_instances(self):
+        subscription = Subscription(self.subscriber, 'me', User, '1')
+        self.subscriber.notify = lambda subscription, change: self.subscriber.events.append(change)
+        self.feed.add_subscription(subscription)
+
+        self.feed.publish(User, 'update', {'id': 1, 'fields': ['name']})
+        self.feed.publish(User, 'update', {'id': '2'})
+        self.feed.remove_subscription(subscription)
+        self.feed.publish(User, 'delete', {'id': '1'})
+
+        expect(self.subscriber.events).to_equal([{'type': 'update', 'id': 1, 'fields': ['name']}])
+        expect(self.feed.instance_subscriptions).to_be_empty()
+
+    def test_notifies_subscriptions_to_filtered_lists(self):
+        subscription = Subscription(self.subscriber, 'adults', User, filters=[Filter('age', 'gte', 18)])
+        self.subscriber.notify = lambda subscription, change: self.subscriber.events.append(change['id'])
+        self.feed.add_subscription(subscription)
+
+        for instance_id, age in [('1', 10), ('2', 20)]:
+            user = User()
+            user.age = age
+            self.feed.publish(User, 'create', {'id': instance_id}, user)
+        self.feed.publish(User, 'update', {'id': '3'})
+
+        expect(self.subscriber.events).to_equal(['2', '3'])
+
+    def test_tells_filtered_lists_about_instances_that_left_them(self):
+        subscription = Subscription(self.subscriber, 'adults', User, filters=[Filter('age', 'gte', 18)])
+        self.subscriber.notify = lambda subscription, change: self.subscriber.events.append(change)
+        self.feed.add_subscription(subscription)
+
+        user = User()
+        user.age = 10
+        self.feed.publish(User, 'update', {'id': '1', 'fields': ['age']}, user)
+        self.feed.publish(User, 'update', {'id': '2', 'fields': ['name']}, user)
+        self.feed.publish(User, 'update', {'id': '3'}, user)
+
+        expect(self.subscriber.events).to_equal([
+            {'type': 'leave', 'id': '1', 'fields': ['age']},
+            {'type': 'leave', 'id': '3'},
+        ])
+
+    def test_can_unsubscribe(self):
+        self.feed.subscribe(User, self.subscriber)
+        self.feed.unsubscribe(User, self.subscriber)
+        self.feed.publish(User, 'create', {'id': '1'})
+
+        expect(self.subscriber.events).to_be_empty()
+        expect(self.feed.subscribers).to_be_empty()
+
+
+class MergeChangesTestCase(base.TestCase):
+    def test_merges_the_fields_of_successive_updates(self):
+        merged = merge_changes(
+            {'type': 'update', 'id': '1', 'fields': ['name']},
+            {'type': 'update', 'id': '1', 'fields': ['age', 'name']}
+        )
+        expect(merged).to_equal({'type': 'update', 'id': '1', 'fields': ['age', 'name']})
+
+        merged = merge_changes({'type': 'update', 'id': '1', 'fields': ['name']}, {'type': 'update', 'id': '1'})
+        expect(merged).to_equal({'type': 'update', 'id': '1'})
+
+    def test_creation_and_deletion_prevail(self):
+        created = {'type': 'create', 'id': '1'}
+        deleted = {'type': 'delete', 'id': '1'}
+
+        expect(merge_changes(created, {'type': 'update', 'id': '1'})).to_equal(created)
+        expect(merge_changes(created, deleted)).to_equal(deleted)
+        expect(merge_changes(deleted, created)).to_equal(created)
+
+
+class ChangeFeedHandlerTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.feed = ChangeFeed(buffer_size=2, heartbeat=None)
+        return tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', User, change_feed=self.feed),
+        ]))
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(ChangeFeedHandlerTestCase, self).tearDown()
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+    @testing.gen_test
+    def test_streams_changes_as_server_sent_events(self):
+        chunks = []
+        response = self.http_client.fetch(self.get_url('/user/_changes'), streaming_callback=chunks.append)
+        yield self.wait_for(lambda: User in self.feed.subscribers)
+
+        self.feed.publish(User, 'delete', {'id': '1'})
+        yield self.wait_for(lambda: chunks)
+        self.feed.close()
+
+        response = yield response
+        expect(response.headers['Content-Type']).to_equal('text/event-stream')
+        expect(b''.join(chunks).decode('utf-8')).to_equal(
+            'id: %s\nevent: delete\ndata: {"id": "1"}\n\n' % self.feed.get_event_id(1)
+        )
+        expect(self.feed.subscribers).to_be_empty()
+
+    @testing.gen_test
+    def test_slow_clients_are_disconnected(self):
+        response = self.http_client.fetch(self.get_url('/user/_changes'), streaming_callback=lambda chunk: None)
+        yield self.wait_for(lambda: User in self.feed.subscribers)
+
+        for i in range(3):
+            for subscriber in self.feed.subscribers.get(User, ()):
+                subscriber.push('event')
+
+        yield response
+        expect(self.feed.subscribers).to_be_empty()
+
+
+class AuthenticatedChangeFeedHandlerTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.feed = ChangeFeed(heartbeat=None, max_streams=1)
+        self.limiter = ConcurrencyLimiter(1)
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for(
+                'tests.test_models.TreeProvider', User, change_feed=self.feed, concurrency_limiter=self.limiter
+            ),
+        ]))
+        bzz.AuthHive.configure(
+            application, secret_key='TEST_SECRET_KEY', cookie_name='TEST_AUTH_COOKIE', authenticated_get=True
+        )
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        signals.pre_get_instance.receivers = {}
+        signals.pre_get_list.receivers = {}
+        signals.pre_create_instance.receivers = {}
+        signals.pre_update_instance.receivers = {}
+        signals.pre_delete_instance.receivers = {}
+        super(AuthenticatedChangeFeedHandlerTestCase, self).tearDown()
+
+    def get_auth_cookie(self):
+        token = self._app.authentication_options['jwt'].encode({
+            'sub': 1, 'data': {}, 'iss': 'mock', 'token': '12345', 'exp': datetime(year=5000, month=11, day=30)
+        })
+        return 'TEST_AUTH_COOKIE=%s' % token.decode('utf-8')
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+    @testing.gen_test
+    def test_streams_need_authentication(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/user/_changes'))
+
+        expect(err.error.code).to_equal(401)
+        expect(self.feed.subscribers).to_be_empty()
+        expect(self.feed.stream_limiter.active).to_equal(0)
+
+    @testing.gen_test
+    def test_open_streams_hold_a_slot_of_the_stream_limiter(self):
+        response = self.http_client.fetch(
+            self.get_url('/user/_changes'), headers={'Cookie': self.get_auth_cookie()},
+            streaming_callback=lambda chunk: None
+        )
+        yield self.wait_for(lambda: User in self.feed.subscribers)
+
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/user/_changes'), headers={'Cookie': self.get_auth_cookie()})
+        expect(err.error.code).to_equal(429)
+        # other requests to the model are not kept out
+        expect(self.limiter.active).to_equal(0)
+
+        self.feed.close()
+        yield response
+        expect(self.feed.stream_limiter.active).to_equal(0)
+
+
+class SubscriptionHandlerTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.feed = ChangeFeed(heartbeat=None)
+        return tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for_subscriptions(self.feed, prefix='/api', coalesce_delay=0.01, max_subscriptions=2),
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', User, prefix='/api', change_feed=self.feed),
+        ]))
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(SubscriptionHandlerTestCase, self).tearDown()
+
+    @gen.coroutine
+    def send(self, connection, message):
+        connection.write_message(utils.dumps(message))
+        response = yield connection.read_message()
+        raise gen.Return(utils.loads(response))
+
+    @testing.gen_test
+    def test_coalesces_the_changes_to_subscriptions(self):
+        connection = yield websocket_connect(self.get_url('/api/_subscriptions').replace('http', 'ws'))
+
+        response = yield self.send(connection, {'action': 'subscribe', 'id': 'me', 'resource': 'user/1'})
+        expect(response).to_equal({'subscribed': 'me'})
+        response = yield self.send(connection, {
+            'action': 'subscribe', 'id': 'adults', 'resource': 'user', 'filters': {'age__gte': '18'},
+        })
+        expect(response).to_equal({'subscribed': 'adults'})
+
+        self.feed.publish(User, 'update', {'id': '1', 'fields': ['name']})
+        self.feed.publish(User, 'update', {'id': '1', 'fields': ['age']})
+
+        response = yield connection.read_message()
+        expect(utils.loads(response)).to_equal({'changes': {
+            'me': [{'type': 'update', 'id': '1', 'fields': ['age', 'name']}],
+            'adults': [{'type': 'update', 'id': '1', 'fields': ['age', 'name']}],
+        }})
+
+        connection.close()
+        yield self.wait_for(lambda: not self.feed.instance_subscriptions)
+        expect(self.feed.model_subscriptions).to_be_empty()
+
+    @testing.gen_test
+    def test_invalid_subscriptions_are_rejected(self):
+        connection = yield websocket_connect(self.get_url('/api/_subscriptions').replace('http', 'ws'))
+
+        for message, error in [
+                ({'action': 'subscribe', 'id': 'a', 'resource': 'team'}, "Invalid resource 'team'"),
+                ({'action': 'subscribe', 'id': 'a'}, 'Subscriptions need an id and a resource'),
+                ({'action': 'subscribe', 'id': 'a', 'resource': 'user', 'filters': {'email': 'a'}},
+                 "Invalid filter field 'email'"),
+                ({'action': 'subscribe', 'id': 'a', 'resource': 'user/1', 'filters': {'age': 1}},
+                 'Filters are only valid for lists'),
+                ({'action': 'publish', 'id': 'a'}, "Invalid action 'publish'"),
+        ]:
+            response = yield self.send(connection, message)
+            expect(response).to_equal({'error': error, 'id': 'a'})
+
+        for subscription_id in ['a', 'b']:
+            yield self.send(connection, {'action': 'subscribe', 'id': subscription_id, 'resource': 'user'})
+
+        response = yield self.send(connection, {'action': 'subscribe', 'id': 'c', 'resource': 'user'})
+        expect(response).to_equal({'error': 'Too many subscriptions', 'id': 'c'})
+
+        connection.close()
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+
+class AuthenticatedSubscriptionHandlerTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.feed = ChangeFeed(heartbeat=None)
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for_subscriptions(self.feed),
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', User, change_feed=self.feed),
+        ]))
+        bzz.AuthHive.configure(
+            application, secret_key='TEST_SECRET_KEY', cookie_name='TEST_AUTH_COOKIE', authenticated_get=True
+        )
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        signals.pre_get_instance.receivers = {}
+        signals.pre_get_list.receivers = {}
+        signals.pre_create_instance.receivers = {}
+        signals.pre_update_instance.receivers = {}
+        signals.pre_delete_instance.receivers = {}
+        super(AuthenticatedSubscriptionHandlerTestCase, self).tearDown()
+
+    @gen.coroutine
+    def connect(self, headers=None):
+        request = HTTPRequest(self.get_url('/_subscriptions').replace('http', 'ws'), headers=headers)
+        connection = yield websocket_connect(request)
+        raise gen.Return(connection)
+
+    @gen.coroutine
+    def send(self, connection, message):
+        connection.write_message(utils.dumps(message))
+        response = yield connection.read_message()
+        raise gen.Return(utils.loads(response))
+
+    @testing.gen_test
+    def test_subscriptions_need_authentication(self):
+        connection = yield self.connect()
+
+        for resource in ['user', 'user/1']:
+            response = yield self.send(connection, {'action': 'subscribe', 'id': 'a', 'resource': resource})
+            expect(response).to_equal({'error': 'Unauthorized', 'id': 'a'})
+
+        expect(self.feed.model_subscriptions).to_be_empty()
+        expect(self.feed.instance_subscriptions).to_be_empty()
+        connection.close()
+
+    @testing.gen_test
+    def test_authenticated_clients_can_subscribe(self):
+        token = self._app.authentication_options['jwt'].encode({
+            'sub': 1, 'data': {}, 'iss': 'mock', 'token': '12345', 'exp': datetime(year=5000, month=11, day=30)
+        })
+        connection = yield self.connect({'Cookie': 'TEST_AUTH_COOKIE=%s' % token.decode('utf-8')})
+
+        response = yield self.send(connection, {'action': 'subscribe', 'id': 'a', 'resource': 'user'})
+        expect(response).to_equal({'subscribed': 'a'})
+        connection.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+from datetime import datetime
+
+from preggy import expect
+
+import bzz.core as core
+import bzz.filters as filters
+import bzz.utils as utils
+from bzz.filters import Filter
+import tests.base as base
+
+
+class CompileFiltersTestCase(base.TestCase):
+    def setUp(self):
+        self.tree = core.Node('user', is_root=True)
+        self.tree.indexes = set(['name', 'age'])
+
+        for name, coerce in [('name', None), ('age', int), ('created', utils.parse_datetime)]:
+            node = core.Node(name)
+            node.coerce = coerce
+            self.tree.children[name] = node
+
+        team = core.Node('team')
+        team.model_type = object
+        team.children['name'] = core.Node('name')
+        self.tree.children['team'] = team
+
+    def test_equality_is_the_default_operator(self):
+        compiled, sort = filters.compile_filters(self.tree, {'name': 'bernardo'})
+
+        expect(compiled).to_equal([Filter('name', 'eq', 'bernardo')])
+        expect(sort).to_be_empty()
+
+    def test_values_are_converted_to_field_types(self):
+        compiled, sort = filters.compile_filters(self.tree, {
+            'age__gte': '18', 'created__lt': '2014-11-30', 'age__in': '1,2',
+        })
+
+        expect(compiled).to_equal([
+            Filter('age', 'gte', 18),
+            Filter('age', 'in', [1, 2]),
+            Filter('created', 'lt', datetime(2014, 11, 30)),
+        ])
+
+    def test_can_filter_by_embedded_fields(self):
+        compiled, sort = filters.compile_filters(self.tree, {'team.name__startswith': 'bz'})
+
+        expect(compiled).to_equal([Filter('team.name', 'startswith', 'bz')])
+
+    def test_can_sort(self):
+        compiled, sort = filters.compile_filters(self.tree, {'sort': '-age,name'})
+
+        expect(compiled).to_be_empty()
+        expect(sort).to_equal([('age', True), ('name', False)])
+
+    def test_unknown_fields_are_rejected(self):
+        with expect.error_to_happen(filters.FilterError, message="Invalid filter field 'email'"):
+            filters.compile_filters(self.tree, {'email__ne': 'x'})
+
+        with expect.error_to_happen(filters.FilterError):
+            filters.compile_filters(self.tree, {'sort': 'email'})
+
+    def test_reserved_arguments_are_ignored(self):
+        compiled, sort = filters.compile_filters(self.tree, {'_': '1700000000', '_explain': '1', 'name': 'bernardo'})
+
+        expect(compiled).to_equal([Filter('name', 'eq', 'bernardo')])
+
+    def test_invalid_values_are_rejected(self):
+        with expect.error_to_happen(filters.FilterError):
+            filters.compile_filters(self.tree, {'age__in': '1,a'})
+
+    def test_can_reject_fields_that_are_not_indexed(self):
+        filters.compile_filters(self.tree, {'age': '1', 'sort': 'name'}, indexed_only=True)
+
+        with expect.error_to_happen(filters.FilterError):
+            filters.compile_filters(self.tree, {'created__exists': 'true'}, indexed_only=True)
+
+        with expect.error_to_happen(filters.FilterError):
+            filters.compile_filters(self.tree, {'sort': '-created'}, indexed_only=True)
+
+
+class FilterMatchesTestCase(base.TestCase):
+    def setUp(self):
+        self.user = type('User', (object,), {})()
+        self.user.name = 'bernardo'
+        self.user.age = 32
+        self.user.address = {'street': 'Rua Augusta'}
+        self.user.email = None
+
+    def test_can_match_instances(self):
+        for path, operator, value in [
+                ('name', 'eq', 'bernardo'), ('name', 'ne', 'rafael'), ('age', 'gt', 18),
+                ('age', 'lte', 32), ('age', 'in', [31, 32]), ('name', 'nin', ['rafael']),
+                ('name', 'startswith', 'ber'), ('name', 'contains', 'nar'),
+                ('address.street', 'eq', 'Rua Augusta'), ('email', 'exists', False),
+        ]:
+            expect(Filter(path, operator, value).matches(self.user)).to_be_true()
+
+    def test_can_reject_instances(self):
+        for path, operator, value in [
+                ('name', 'eq', 'rafael'), ('age', 'lt', 18), ('email', 'gte', 1),
+                ('email', 'startswith', 'a'), ('address.number', 'exists', True), ('age', 'gt', 'a'),
+        ]:
+            expect(Filter(path, operator, value).matches(self.user)).to_be_false()
+
+    def test_filters_on_references_match_all_instances(self):
+        node = core.Node('team')
+        node.model_type = object
+
+        expect(Filter('team', 'eq', '1', node).matches(self.user)).to_be_true()
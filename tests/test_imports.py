@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import sys
+import subprocess
+
+from preggy import expect
+
+import bzz
+import tests.base as base
+
+
+class ImportsTestCase(base.TestCase):
+    def get_loaded_modules(self, code, modules):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            '%s; import sys; print(",".join(m for m in %r if m in sys.modules))' % (code, modules)
+        ])
+        return [module for module in output.decode('utf-8').strip().split(',') if module]
+
+    def test_importing_bzz_does_not_import_hives(self):
+        modules = ('bzz.model', 'bzz.auth', 'bzz.mock', 'jwt', 'blinker', 'tornado.httpclient')
+
+        expect(self.get_loaded_modules('import bzz', modules)).to_be_empty()
+
+    def test_hives_are_imported_when_used(self):
+        loaded = self.get_loaded_modules('import bzz; bzz.ModelHive', ('bzz.model', 'bzz.auth'))
+
+        expect(loaded).to_equal(['bzz.model'])
+
+    def test_can_use_lazy_names(self):
+        from bzz.auth import AuthHive
+
+        expect(bzz.AuthHive).to_equal(AuthHive)
+        expect(dir(bzz)).to_include('ModelHive')
+
+    def test_unknown_names_raise_attribute_error(self):
+        with expect.error_to_happen(AttributeError):
+            bzz.Invalid
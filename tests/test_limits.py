@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+from mock import Mock
+from preggy import expect
+
+import bzz.limits as limits
+import bzz.utils as utils
+import tests.base as base
+
+
+class RateLimiterTestCase(base.TestCase):
+    def setUp(self):
+        self.now = [100.0]
+        self.limiter = limits.RateLimiter(rate=2, burst=2, clock=lambda: self.now[0])
+
+    def test_allows_burst_then_limits(self):
+        expect(self.limiter.acquire('a')).to_equal(0)
+        expect(self.limiter.acquire('a')).to_equal(0)
+        expect(self.limiter.acquire('a')).to_equal(0.5)
+
+    def test_refills_tokens_over_time(self):
+        self.limiter.acquire('a')
+        self.limiter.acquire('a')
+
+        self.now[0] += 0.5
+        expect(self.limiter.acquire('a')).to_equal(0)
+        expect(self.limiter.acquire('a')).to_equal(0.5)
+
+    def test_clients_have_separate_buckets(self):
+        self.limiter.acquire('a')
+        self.limiter.acquire('a')
+
+        expect(self.limiter.acquire('b')).to_equal(0)
+
+    def test_keeps_bounded_number_of_clients(self):
+        limiter = limits.RateLimiter(rate=1, max_keys=2)
+        for key in ('a', 'b', 'c'):
+            limiter.acquire(key)
+
+        expect(list(limiter.buckets.keys())).to_equal(['b', 'c'])
+
+
+class ConcurrencyLimiterTestCase(base.TestCase):
+    def test_limits_concurrent_requests(self):
+        limiter = limits.ConcurrencyLimiter(2)
+        expect(limiter.acquire()).to_be_true()
+        expect(limiter.acquire()).to_be_true()
+        expect(limiter.acquire()).to_be_false()
+
+        limiter.release()
+        expect(limiter.acquire()).to_be_true()
+
+
+class ClientKeyTestCase(base.TestCase):
+    def test_uses_remote_ip_without_authentication(self):
+        handler = Mock(application=Mock(authentication_options=None))
+        handler.request.remote_ip = '10.0.0.1'
+
+        expect(limits.get_client_key(handler)).to_equal('ip:10.0.0.1')
+
+    def test_uses_token_subject_when_authenticated(self):
+        jwt = utils.Jwt('SECRET')
+        handler = Mock(_authentication_result=None)
+        handler.application.authentication_options = {
+            'jwt': jwt, 'cookie_name': 'AUTH', 'expiration': 60,
+            'session_store': None,
+        }
+        handler.get_cookie.return_value = jwt.encode({'sub': 'user@email.com'})
+
+        expect(limits.get_client_key(handler)).to_equal('sub:user@email.com')
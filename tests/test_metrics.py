@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import os
+import shutil
+import tempfile
+
+from preggy import expect
+import tornado.web
+import tornado.testing as testing
+
+import bzz
+import bzz.model as model
+import bzz.signals as signals
+import bzz.utils as utils
+from bzz.cache import ListCache
+from bzz.metrics import Metrics, format_labels
+import tests.base as base
+from tests.test_models import Post
+
+
+def get_samples(text):
+    return [line for line in text.split('\n') if line and not line.startswith('#')]
+
+
+class MetricsTestCase(base.TestCase):
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1))
+        self.metrics.install()
+
+    def tearDown(self):
+        self.metrics.uninstall()
+
+    def test_renders_counters_and_histograms(self):
+        self.metrics.requests.inc(('user', 'GET', '200'), 2)
+        self.metrics.request_duration.observe(('user', 'GET'), 0.5)
+
+        text = self.metrics.render()
+        expect(text).to_include('# TYPE bzz_requests_total counter\n')
+        expect(get_samples(text)).to_equal([
+            'bzz_requests_total{resource="user",method="GET",status="200"} 2',
+            'bzz_request_duration_seconds_bucket{resource="user",method="GET",le="0.1"} 0',
+            'bzz_request_duration_seconds_bucket{resource="user",method="GET",le="1"} 1',
+            'bzz_request_duration_seconds_bucket{resource="user",method="GET",le="+Inf"} 1',
+            'bzz_request_duration_seconds_sum{resource="user",method="GET"} 0.5',
+            'bzz_request_duration_seconds_count{resource="user",method="GET"} 1',
+        ])
+
+    def test_label_values_are_escaped(self):
+        expect(format_labels(('name',), ('a "b"\\\n',))).to_equal('{name="a \\"b\\"\\\\\\n"}')
+
+    def test_times_signal_receivers_and_counts_token_decodes(self):
+        def receiver(sender, **kwargs):
+            pass
+
+        signal = signals.signal('bzz.test-metrics')
+        signal.connect(receiver)
+        signal.send(Post)
+        signals.token_decoded.send(None, authenticated=False, handler=None)
+
+        samples = get_samples(self.metrics.render())
+        expect(samples).to_include(
+            'bzz_signal_receiver_duration_seconds_count'
+            '{signal="bzz.test-metrics",receiver="tests.test_metrics.receiver"} 1'
+        )
+        expect(samples).to_include('bzz_auth_token_decodes_total{authenticated="false"} 1')
+
+    def test_every_installed_metrics_times_signal_receivers(self):
+        def receiver(sender, **kwargs):
+            pass
+
+        other = Metrics()
+        other.install()
+        self.metrics.install()
+        try:
+            signal = signals.signal('bzz.test-metrics-installed')
+            signal.connect(receiver)
+            signal.send(Post)
+        finally:
+            other.uninstall()
+
+        sample = (
+            'bzz_signal_receiver_duration_seconds_count'
+            '{signal="bzz.test-metrics-installed",receiver="tests.test_metrics.receiver"} 1'
+        )
+        expect(get_samples(self.metrics.render())).to_include(sample)
+        expect(get_samples(other.render())).to_include(sample)
+        expect(signals.Signal.timers).to_equal([self.metrics.on_signal_received])
+
+    def test_signal_receivers_are_not_timed_before_installing(self):
+        def receiver(sender, **kwargs):
+            pass
+
+        other = Metrics()
+        signal = signals.signal('bzz.test-metrics-not-installed')
+        signal.connect(receiver)
+        signal.send(Post)
+
+        expect(get_samples(other.render())).to_be_empty()
+
+
+class MultipleProcessesMetricsTestCase(base.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'metrics')
+        self.first = Metrics(path=self.path)
+        self.second = Metrics(path=self.path)
+        self.first.start(name='first')
+        self.second.start(name='second')
+
+    def tearDown(self):
+        self.first.stop()
+        self.second.stop()
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_metrics_of_all_processes_are_added_up(self):
+        self.first.requests.inc(('user', 'GET', '200'))
+        self.second.requests.inc(('user', 'GET', '200'), 2)
+        self.second.save()
+
+        expect(get_samples(self.first.render())).to_include(
+            'bzz_requests_total{resource="user",method="GET",status="200"} 3'
+        )
+
+    def test_metrics_of_exited_processes_are_dropped(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        exited = Metrics()
+        exited.requests.inc(('user', 'GET', '200'), 5)
+        filename = os.path.join(self.path, 'exited.json')
+        with open(filename, 'w') as state_file:
+            state_file.write(utils.dumps(dict(exited.get_state(), pid=pid)))
+
+        expect(get_samples(self.first.render())).not_to_include(
+            'bzz_requests_total{resource="user",method="GET",status="200"} 5'
+        )
+        expect(os.path.exists(filename)).to_be_false()
+
+    def test_metrics_of_previous_runs_are_removed(self):
+        Metrics(path=self.path)
+
+        expect(os.listdir(self.path)).to_be_empty()
+
+
+class MetricsRouteTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.metrics = Metrics()
+        application = tornado.web.Application(bzz.flatten([
+            bzz.MetricsHive.routes_for(self.metrics, prefix='/api'),
+            bzz.ModelHive.routes_for(
+                'tests.test_models.VersionedProvider', Post, prefix='/api', metrics=self.metrics,
+                list_cache=ListCache()
+            ),
+        ]))
+        application.dumped = 0
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(MetricsRouteTestCase, self).tearDown()
+
+    @testing.gen_test
+    def test_exports_the_metrics_of_model_routes(self):
+        yield self.http_client.fetch(self.get_url('/api/post/1'))
+        yield self.http_client.fetch(self.get_url('/api/post/'))
+        yield self.http_client.fetch(self.get_url('/api/post/'))
+
+        response = yield self.http_client.fetch(self.get_url('/api/metrics'))
+        expect(response.headers['Content-Type']).to_equal('text/plain; version=0.0.4; charset=utf-8')
+
+        samples = get_samples(response.body.decode('utf-8'))
+        for sample in [
+                'bzz_requests_total{resource="post",method="GET",status="200"} 3',
+                'bzz_request_duration_seconds_count{resource="post",method="GET"} 3',
+                'bzz_db_queries_total{resource="post",operation="get_instance"} 1',
+                'bzz_db_queries_total{resource="post",operation="count_list"} 1',
+                'bzz_db_queries_total{resource="post",operation="get_list"} 1',
+                'bzz_cache_requests_total{cache="list",result="hit"} 1',
+                'bzz_cache_requests_total{cache="list",result="miss"} 1',
+        ]:
+            expect(samples).to_include(sample)
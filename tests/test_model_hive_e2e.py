@@ -37,6 +37,9 @@ class MongoEngineEndToEndTestCase(base.ApiTestCase):
             ('GET', '/user/test%20user', {}, 200, to_json, self.__assert_user_data(name="test user", age=32)),
             ('PUT', '/user/test%20user', dict(body="age=31"), 200, None, None),
             ('GET', '/user/test%20user', {}, 200, to_json, self.__assert_user_data(name="test user", age=31)),
+            ('PATCH', '/user/test%20user', dict(body="age=30"), 200, None, None),
+            ('GET', '/user/test%20user', {}, 200, to_json, self.__assert_user_data(name="test user", age=30)),
+            ('PATCH', '/user/missing-user', dict(body="age=30"), 404, None, None),
             ('POST', '/user', dict(body="name=test-user2&age=32"), 200, None, None),
             ('DELETE', '/user/test-user2', {}, 200, None, None),
             ('GET', '/user', {}, 200, to_json, self.__assert_len(1)),
@@ -10,7 +10,25 @@
 
 from preggy import expect
 
+import os
+import stat
+import tempfile
+from datetime import datetime
+
+from mock import Mock, patch
+import tornado.web
+import tornado.gen as gen
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+import tornado.testing as testing
+from tornado.httpclient import HTTPError
+
+import bzz
 import bzz.core as core
+import bzz.model as model
+import bzz.signals as signals
+import bzz.utils as utils
+from bzz.cache import InstanceCache, ListCache
+from bzz.model import ModelProvider
 import tests.base as base
 
 
@@ -32,3 +50,820 @@ class MetaModelsTestCase(base.TestCase):
 
         found = node.find_by_path('inner.innerer')
         expect(found).to_equal(innerer)
+
+    def test_nodes_have_no_instance_dict(self):
+        node = core.Node('test')
+
+        expect(hasattr(node, '__dict__')).to_be_false()
+
+    def test_root_node_finds_nodes_by_class_not_name(self):
+        first = type('Model', (object,), {})
+        second = type('Model', (object,), {})
+
+        root = core.Node('root', is_root=True)
+        first_node = core.Node('first')
+        root.add_to_cache(first, first_node)
+
+        expect(root.find_by_class(first)).to_equal(first_node)
+        expect(root.find_by_class(second)).to_be_null()
+
+    def test_root_node_indexes_walked_paths(self):
+        root = core.Node('root', is_root=True)
+        inner = core.Node('inner')
+        innerer = core.Node('innerer')
+        root.children[inner.name] = inner
+        inner.children[innerer.name] = innerer
+
+        expect(root.find_by_path('inner.innerer')).to_equal(innerer)
+        expect(root.paths).to_include('inner.innerer')
+        expect(root.find_by_path('inner.missing')).to_be_null()
+        expect(root.paths).not_to_include('inner.missing')
+
+
+class Field(object):
+    def __init__(self, model=None, multiple=False, coerce=None, embedded=False):
+        self.model = model
+        self.multiple = multiple
+        self.coerce = coerce
+        self.embedded = embedded
+
+
+class OtherField(Field):
+    pass
+
+
+class Team(object):
+    pass
+
+
+class User(object):
+    pass
+
+
+class Address(object):
+    pass
+
+
+Team.fields = {'name': Field(), 'owner': Field(User), 'members': Field(User, multiple=True)}
+User.fields = {
+    'name': Field(), 'team': Field(Team), 'age': Field(coerce=int),
+    'scores': Field(multiple=True, coerce=float), 'address': Field(Address, embedded=True),
+}
+Address.fields = {'street': Field(), 'number': Field(coerce=int)}
+
+
+class Post(object):
+    fields = {'title': Field()}
+    updated = datetime(2014, 11, 30, 10, 20, 30)
+
+
+class PrivatePost(Post):
+    @classmethod
+    def get_instance_queryset(cls, model, queryset, instance_id, handler):
+        return queryset
+
+
+class TreeProvider(ModelProvider):
+    @classmethod
+    def get_model_name(cls, model):
+        return model.__name__
+
+    @classmethod
+    def get_model_collection(cls, model):
+        return None
+
+    @classmethod
+    def get_model_fields(cls, model):
+        return model.fields
+
+    @classmethod
+    def get_model(cls, field):
+        return field.model
+
+    @classmethod
+    def is_list_field(cls, field):
+        return field.multiple
+
+    @classmethod
+    def get_field_target_name(cls, field):
+        return None
+
+    @classmethod
+    def allows_create_on_associate(cls, field):
+        return False
+
+    @classmethod
+    def is_lazy_loaded(cls, field):
+        return field.model is not None and not field.embedded
+
+    @classmethod
+    def get_field_coercer(cls, field):
+        return field.coerce
+
+    @classmethod
+    def get_indexed_paths(cls, model):
+        return set(['name'])
+
+    @gen.coroutine
+    def get_model_from_path(self, path):
+        raise gen.Return(self.model)
+
+    @gen.coroutine
+    def get_instance(self, instance_id, model=None):
+        if instance_id == 'missing':
+            raise gen.Return(None)
+
+        self.count_query('get_instance')
+        instance = (model or self.model)()
+        instance.id = instance_id
+        self.application.loaded = getattr(self.application, 'loaded', 0) + 1
+        yield gen.moment
+        raise gen.Return(instance)
+
+    @gen.coroutine
+    def get_instance_property(self, obj, path):
+        raise AssertionError('Should not load the whole list')
+
+    @gen.coroutine
+    def remove_from_list(self, obj, field_name, instance):
+        self.application.removed.append((obj.id, field_name, instance.id))
+        raise gen.Return((instance, None))
+
+    @gen.coroutine
+    def partial_update_instance(self, pk, data, model=None):
+        if pk == 'missing':
+            raise gen.Return(((404, 'Not Found'), None))
+
+        paths = self.get_update_paths(data)
+        self.application.updates.append((pk, paths))
+        raise gen.Return((None, dict((path, {'to': value}) for path, value in paths.items())))
+
+    @gen.coroutine
+    def get_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        raise gen.Return([self.model.__name__])
+
+    def dump_list(self, items):
+        return items
+
+
+class ExplainedProvider(TreeProvider):
+    @gen.coroutine
+    def explain_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        raise gen.Return({
+            'query': dict((list_filter.path, list_filter.value) for list_filter in filters),
+            'sort': sort, 'skip': (page - 1) * per_page, 'limit': per_page,
+        })
+
+
+class VersionedProvider(TreeProvider):
+    @gen.coroutine
+    def get_list(self, items=None, page=1, per_page=20, filters=None, sort=None):
+        self.count_query('count_list')
+        self.count_query('get_list')
+        items = []
+        for instance_id in ['1', '2']:
+            item = self.model()
+            item.id = instance_id
+            items.append(item)
+        yield gen.moment
+        raise gen.Return(items)
+
+    @gen.coroutine
+    def get_instance_id(self, instance):
+        raise gen.Return(instance.id)
+
+    def dump_instance(self, instance):
+        self.application.dumped += 1
+        return {'id': instance.id}
+
+    def dump_list(self, items):
+        return [self.dump_instance(item) for item in items]
+
+
+class ModelTreeTestCase(base.TestCase):
+    def setUp(self):
+        model.TREE_CACHE.clear()
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+
+    def test_tree_indexes_paths_and_classes(self):
+        tree = TreeProvider.get_tree(Team)
+
+        expect(tree.paths).to_include('owner')
+        expect(tree.paths).to_include('owner.team')
+        expect(tree.find_by_path('owner.name')).to_equal(tree.children['owner'].children['name'])
+        expect(tree.find_by_class(Team)).to_equal(tree)
+        expect(tree.find_by_class(User)).to_equal(tree.children['owner'])
+
+    def test_tree_resolves_recursive_paths(self):
+        tree = TreeProvider.get_tree(Team)
+        node = tree.find_by_path('members.team.owner.name')
+
+        expect(node).to_equal(tree.children['owner'].children['name'])
+        expect(tree.children['members'].is_multiple).to_be_true()
+
+    def test_trees_are_built_once_per_model(self):
+        tree = TreeProvider.get_tree(Team)
+
+        expect(TreeProvider.get_tree(Team)).to_equal(tree)
+
+    def test_trees_share_sub_trees(self):
+        user_tree = TreeProvider.get_tree(User)
+        team_tree = TreeProvider.get_tree(Team)
+
+        expect(team_tree.children['owner'].children is user_tree.children).to_be_true()
+        expect(team_tree.find_by_class(User)).to_equal(team_tree.children['owner'])
+        expect(team_tree.find_by_path('owner.team.name')).not_to_be_null()
+
+    def test_can_save_and_load_trees(self):
+        TreeProvider.get_tree(Team)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            model.ModelHive.save_trees(path)
+            model.TREE_CACHE.clear()
+
+            expect(model.ModelHive.load_trees(path)).to_equal(1)
+        finally:
+            os.remove(path)
+
+        tree = TreeProvider.get_tree(Team)
+        expect(tree.model_type).to_equal(Team)
+        expect(tree.find_by_path('owner.name').name).to_equal('name')
+
+    def test_loading_trees_ignores_changed_models(self):
+        TreeProvider.get_tree(User)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            model.ModelHive.save_trees(path)
+            model.TREE_CACHE.clear()
+            User.fields['email'] = Field()
+
+            expect(model.ModelHive.load_trees(path)).to_equal(0)
+        finally:
+            User.fields.pop('email')
+            os.remove(path)
+
+    def test_loading_trees_ignores_changed_field_types(self):
+        TreeProvider.get_tree(Team)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        field = User.fields['name']
+        try:
+            model.ModelHive.save_trees(path)
+            model.TREE_CACHE.clear()
+            User.fields['name'] = OtherField()
+
+            expect(model.ModelHive.load_trees(path)).to_equal(0)
+        finally:
+            User.fields['name'] = field
+            os.remove(path)
+
+    def test_loading_trees_ignores_changed_references(self):
+        TreeProvider.get_tree(Team)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        field = Team.fields['owner']
+        try:
+            model.ModelHive.save_trees(path)
+            model.TREE_CACHE.clear()
+            Team.fields['owner'] = Field(Address)
+
+            expect(model.ModelHive.load_trees(path)).to_equal(0)
+        finally:
+            Team.fields['owner'] = field
+            os.remove(path)
+
+    def test_loading_trees_ignores_changed_indexes(self):
+        TreeProvider.get_tree(Team)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            model.ModelHive.save_trees(path)
+            model.TREE_CACHE.clear()
+
+            with patch.object(TreeProvider, 'get_indexed_paths', classmethod(lambda cls, model: set(['owner']))):
+                expect(model.ModelHive.load_trees(path)).to_equal(0)
+        finally:
+            os.remove(path)
+
+    def test_trees_writable_by_other_users_are_not_loaded(self):
+        TreeProvider.get_tree(User)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            model.ModelHive.save_trees(path)
+            expect(stat.S_IMODE(os.stat(path).st_mode)).to_equal(0o600)
+
+            model.TREE_CACHE.clear()
+            os.chmod(path, 0o666)
+
+            expect(model.ModelHive.load_trees(path)).to_equal(0)
+        finally:
+            os.remove(path)
+
+
+class HealthcheckHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write('WORKING')
+
+
+class RoutesForManyTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        routes = bzz.ModelHive.routes_for_many(
+            'tests.test_models.TreeProvider', [User, Team],
+            prefix='/api', resource_names={Team: 'teams'}
+        )
+        self.routes = routes
+        return tornado.web.Application(bzz.flatten([
+            ('/api/healthcheck/?', HealthcheckHandler),
+            routes,
+        ]))
+
+    def test_returns_a_single_route(self):
+        expect(self.routes).to_length(1)
+
+    @testing.gen_test
+    def test_dispatches_to_model_by_first_url_part(self):
+        response = yield self.http_client.fetch(self.get_url('/api/user/'))
+        expect(utils.loads(response.body)).to_equal(['User'])
+
+        response = yield self.http_client.fetch(self.get_url('/api/teams'))
+        expect(utils.loads(response.body)).to_equal(['Team'])
+
+    @testing.gen_test
+    def test_unknown_resources_are_not_found(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/api/team/'))
+
+        expect(err.error.code).to_equal(404)
+
+    @testing.gen_test
+    def test_routes_before_the_resources_are_reachable(self):
+        response = yield self.http_client.fetch(self.get_url('/api/healthcheck'))
+        expect(response.body).to_equal(b'WORKING')
+
+
+class RequestDataTestCase(base.TestCase):
+    def get_handler(self, body=b'', content_type=None, uri='/user/'):
+        headers = HTTPHeaders()
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+
+        request = HTTPServerRequest(
+            method='POST', uri=uri, body=body, headers=headers, connection=Mock()
+        )
+        request._parse_body()
+
+        return TreeProvider(
+            tornado.web.Application(), request,
+            model=User, name='user', prefix='', tree=None
+        )
+
+    def test_can_get_urlencoded_data(self):
+        handler = self.get_handler(b'name=Bernardo+Heynemann&team.name=a%3Db')
+
+        expect(handler.get_request_data()).to_equal({
+            'name': 'Bernardo Heynemann', 'team.name': 'a=b'
+        })
+
+    def test_can_get_json_data(self):
+        handler = self.get_handler(
+            b'{"name": "Bernardo", "team": {"name": "bzz"}, "age": 32}',
+            content_type='application/json; charset=UTF-8'
+        )
+
+        expect(handler.get_request_data()).to_equal({
+            'name': 'Bernardo', 'team': {'name': 'bzz'}, 'age': 32
+        })
+
+    def test_can_get_multipart_data(self):
+        body = (
+            b'--BOUNDARY\r\n'
+            b'Content-Disposition: form-data; name="name"\r\n\r\n'
+            b'Bernardo\r\n'
+            b'--BOUNDARY\r\n'
+            b'Content-Disposition: form-data; name="members[]"\r\n\r\n'
+            b'a\r\n'
+            b'--BOUNDARY--\r\n'
+        )
+        handler = self.get_handler(body, content_type='multipart/form-data; boundary=BOUNDARY')
+
+        expect(handler.get_request_data()).to_equal({'name': 'Bernardo', 'members[]': ['a']})
+
+    def test_can_get_query_string_data(self):
+        handler = self.get_handler(uri='/user/?page=2&name=')
+
+        expect(handler.get_request_data()).to_equal({'page': '2', 'name': None})
+
+    def test_request_body_is_parsed_once(self):
+        handler = self.get_handler(b'page=2&name=x')
+        data = handler.get_request_data()
+        data.pop('page')
+
+        handler.request.body = b''
+        expect(handler.get_request_data()).to_equal({'page': '2', 'name': 'x'})
+
+
+class CoercionTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.tree = TreeProvider.get_tree(User)
+        return tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', User)
+        ]))
+
+    def tearDown(self):
+        super(CoercionTestCase, self).tearDown()
+        model.TREE_CACHE.clear()
+
+    def get_handler(self):
+        return TreeProvider(
+            self._app, HTTPServerRequest(method='POST', uri='/user/', connection=Mock()),
+            model=User, name='user', prefix='', tree=self.tree
+        )
+
+    def test_tree_nodes_hold_field_coercers(self):
+        expect(self.tree.find_by_path('age').coerce).to_equal(int)
+        expect(self.tree.find_by_path('address.number').coerce).to_equal(int)
+        expect(self.tree.find_by_path('name').coerce).to_be_null()
+
+    def test_coerces_values_to_field_types(self):
+        data = self.get_handler().coerce_data(self.tree, {
+            'name': 'Bernardo', 'age': '32', 'scores': ['1.5', 2],
+            'address': {'street': 'Main', 'number': '10'},
+            'address.number': '11', 'unknown': '1',
+        })
+
+        expect(data).to_equal({
+            'name': 'Bernardo', 'age': 32, 'scores': [1.5, 2.0],
+            'address': {'street': 'Main', 'number': 10},
+            'address.number': 11, 'unknown': '1',
+        })
+
+    def test_invalid_values_fail_with_their_path(self):
+        err = expect.error_to_happen(core.CoercionError)
+        with err:
+            self.get_handler().coerce_data(self.tree, {'address': {'number': 'ten'}})
+
+        expect(err.error.path).to_equal('address.number')
+
+    def test_objects_are_not_accepted_for_references(self):
+        with expect.error_to_happen(core.CoercionError):
+            self.get_handler().coerce_data(self.tree, {'team': {'name': 'bzz'}})
+
+    @testing.gen_test
+    def test_invalid_values_are_rejected_before_saving(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(
+                self.get_url('/user/'), method='POST',
+                body=utils.dumps({'name': 'Bernardo', 'age': 'old'}),
+                headers={'Content-Type': 'application/json'}
+            )
+
+        expect(err.error.code).to_equal(400)
+        expect(err.error.response.body.decode('utf-8')).to_include("'age'")
+
+    @testing.gen_test
+    def test_malformed_bodies_are_rejected(self):
+        for body, content_type in [
+                (b'{"name": "Bernardo"', 'application/json'),
+                (b'name=\xff', 'application/x-www-form-urlencoded')]:
+            err = expect.error_to_happen(HTTPError)
+            with err:
+                yield self.http_client.fetch(
+                    self.get_url('/user/'), method='POST', body=body, headers={'Content-Type': content_type}
+                )
+
+            expect(err.error.code).to_equal(400)
+
+
+class PatchTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        app = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', User)
+        ]))
+        app.updates = []
+        return app
+
+    def setUp(self):
+        super(PatchTestCase, self).setUp()
+        self.updated = []
+        signals.post_update_instance.connect(self.handle_update, sender=User)
+
+    def tearDown(self):
+        signals.post_update_instance.disconnect(self.handle_update, sender=User)
+        model.TREE_CACHE.clear()
+        super(PatchTestCase, self).tearDown()
+
+    def handle_update(self, sender, instance, updated_fields, handler):
+        self.updated.append((instance, updated_fields))
+
+    def patch(self, url, data):
+        return self.http_client.fetch(
+            self.get_url(url), method='PATCH', body=utils.dumps(data),
+            headers={'Content-Type': 'application/json'}
+        )
+
+    @testing.gen_test
+    def test_updates_only_the_given_paths(self):
+        response = yield self.patch('/user/1', {'age': '33', 'address': {'number': '10'}})
+
+        expect(response.code).to_equal(200)
+        expect(self._app.updates).to_equal([('1', {'age': 33, 'address.number': 10})])
+        expect(self.updated).to_equal([
+            (None, {'age': {'to': 33}, 'address.number': {'to': 10}})
+        ])
+
+    @testing.gen_test
+    def test_missing_instances_are_not_found(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.patch('/user/missing', {'age': 33})
+
+        expect(err.error.code).to_equal(404)
+        expect(self.updated).to_be_empty()
+
+    @testing.gen_test
+    def test_list_fields_are_not_patched(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.patch('/user/1', {'scores[]': [1]})
+
+        expect(err.error.code).to_equal(400)
+        expect(self._app.updates).to_be_empty()
+
+
+class DissociationTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        app = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', Team)
+        ]))
+        app.removed = []
+        return app
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(DissociationTestCase, self).tearDown()
+
+    @testing.gen_test
+    def test_removes_references_from_lists_by_id(self):
+        response = yield self.http_client.fetch(self.get_url('/team/1/members/5'), method='DELETE')
+
+        expect(response.code).to_equal(200)
+        expect(self._app.removed).to_equal([('1', 'members', '5')])
+
+    @testing.gen_test
+    def test_unknown_references_are_not_removed(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/team/1/members/missing'), method='DELETE')
+
+        expect(err.error.code).to_equal(400)
+        expect(self._app.removed).to_be_empty()
+
+
+class ListFiltersTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        return tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.ExplainedProvider', User, allow_explain=True),
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', Team, indexed_filters_only=True),
+            bzz.ModelHive.routes_for('tests.test_models.TreeProvider', Post, allow_explain=True),
+        ]))
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(ListFiltersTestCase, self).tearDown()
+
+    @testing.gen_test
+    def test_can_filter_and_sort(self):
+        response = yield self.http_client.fetch(self.get_url('/user/?age__gte=18&sort=-name&page=1'))
+
+        expect(utils.loads(response.body)).to_equal(['User'])
+
+    @testing.gen_test
+    def test_invalid_filters_are_bad_requests(self):
+        for url in ['/user/?age__gte=old', '/user/?email=x', '/team/?owner.name=x', '/team/?sort=owner']:
+            err = expect.error_to_happen(HTTPError)
+            with err:
+                yield self.http_client.fetch(self.get_url(url))
+
+            expect(err.error.code).to_equal(400)
+
+        response = yield self.http_client.fetch(self.get_url('/team/?name=bzz&sort=name'))
+        expect(response.code).to_equal(200)
+
+    @testing.gen_test
+    def test_can_explain_list_queries(self):
+        response = yield self.http_client.fetch(self.get_url('/user/?_explain=1&age=18&sort=-name&page=2'))
+
+        expect(utils.loads(response.body)).to_equal({
+            'query': {'age': 18}, 'sort': [['name', True]], 'skip': 20, 'limit': 20,
+        })
+
+        response = yield self.http_client.fetch(self.get_url('/user/?_explain=0'))
+        expect(utils.loads(response.body)).to_equal(['User'])
+
+    @testing.gen_test
+    def test_explain_is_ignored_unless_allowed(self):
+        response = yield self.http_client.fetch(self.get_url('/team/?_explain=1&_=1700000000'))
+
+        expect(utils.loads(response.body)).to_equal(['Team'])
+
+    @testing.gen_test
+    def test_providers_that_cant_explain_refuse_to(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/post/?_explain=1'))
+
+        expect(err.error.code).to_equal(400)
+        expect(err.error.response.body).to_equal(b'TreeProvider can not explain list queries')
+
+
+class InstanceCacheTestCase(base.TestCase):
+    def get_handler(self, instance_cache):
+        request = HTTPServerRequest(method='GET', uri='/user/1', connection=Mock())
+        return TreeProvider(
+            tornado.web.Application(), request,
+            model=User, name='user', prefix='', tree=None, instance_cache=instance_cache
+        )
+
+    def test_caches_instances_by_model_and_id(self):
+        handler = self.get_handler(InstanceCache(models=[User]))
+        user = User()
+        handler.cache_instance(User, '1', user)
+        handler.cache_instance(Team, '1', Team())
+
+        expect(handler.get_cached_instance(User, '1')).to_be_instance_of(User)
+        expect(handler.get_cached_instance(User, '1') is user).to_be_false()
+        expect(handler.get_cached_instance(Team, '1')).to_be_null()
+
+        handler.invalidate_cached_instance(User, '1')
+        expect(handler.get_cached_instance(User, '1')).to_be_null()
+
+    def test_routes_without_cache_never_cache(self):
+        handler = self.get_handler(None)
+        handler.cache_instance(User, '1', User())
+
+        expect(handler.get_cached_instance(User, '1')).to_be_null()
+
+
+class ConditionalRequestsTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.VersionedProvider', Post, version_field='updated'),
+            bzz.ModelHive.routes_for('tests.test_models.VersionedProvider', User, version_field='updated'),
+        ]))
+        application.dumped = 0
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(ConditionalRequestsTestCase, self).tearDown()
+
+    @gen.coroutine
+    def fetch_not_modified(self, url, **headers):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url(url), headers=headers)
+
+        expect(err.error.code).to_equal(304)
+
+    @testing.gen_test
+    def test_instances_have_validators_from_the_version_field(self):
+        response = yield self.http_client.fetch(self.get_url('/post/1'))
+
+        etag = response.headers['Etag']
+        expect(etag).to_match(r'^W/"[0-9a-f]{40}"$')
+        expect(response.headers['Last-Modified']).to_equal('Sun, 30 Nov 2014 10:20:30 GMT')
+
+        other = yield self.http_client.fetch(self.get_url('/post/2'))
+        expect(other.headers['Etag']).not_to_equal(etag)
+
+    @testing.gen_test
+    def test_instances_are_not_dumped_when_not_modified(self):
+        response = yield self.http_client.fetch(self.get_url('/post/1'))
+        expect(self._app.dumped).to_equal(1)
+
+        yield self.fetch_not_modified('/post/1', **{'If-None-Match': response.headers['Etag']})
+        yield self.fetch_not_modified('/post/1', **{'If-Modified-Since': 'Sun, 30 Nov 2014 10:20:30 GMT'})
+        expect(self._app.dumped).to_equal(1)
+
+        response = yield self.http_client.fetch(
+            self.get_url('/post/1'), headers={'If-Modified-Since': 'Sun, 30 Nov 2014 10:20:29 GMT'}
+        )
+        expect(response.code).to_equal(200)
+        expect(self._app.dumped).to_equal(2)
+
+    @testing.gen_test
+    def test_lists_are_not_dumped_when_not_modified(self):
+        response = yield self.http_client.fetch(self.get_url('/post/'))
+        expect(utils.loads(response.body)).to_equal([{'id': '1'}, {'id': '2'}])
+        expect(self._app.dumped).to_equal(2)
+
+        yield self.fetch_not_modified('/post/', **{'If-None-Match': response.headers['Etag']})
+        expect(self._app.dumped).to_equal(2)
+
+    @testing.gen_test
+    def test_models_without_the_version_field_fall_back_to_hashing_the_body(self):
+        response = yield self.http_client.fetch(self.get_url('/user/1'))
+
+        expect(response.headers['Etag']).to_match(r'^"[0-9a-f]{40}"$')
+        expect(response.headers).not_to_include('Last-Modified')
+
+        yield self.fetch_not_modified('/user/1', **{'If-None-Match': response.headers['Etag']})
+        expect(self._app.dumped).to_equal(2)
+
+
+class ListCacheTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.list_cache = ListCache()
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.VersionedProvider', Post, list_cache=self.list_cache),
+        ]))
+        application.dumped = 0
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(ListCacheTestCase, self).tearDown()
+
+    @testing.gen_test
+    def test_list_responses_are_cached_until_instances_change(self):
+        for i in range(2):
+            response = yield self.http_client.fetch(self.get_url('/post/?page=1'))
+            expect(utils.loads(response.body)).to_equal([{'id': '1'}, {'id': '2'}])
+            expect(response.headers['Content-Type']).to_equal('application/json')
+
+        expect(self._app.dumped).to_equal(2)
+
+        yield signals.post_delete_instance.send(Post, instance=Post(), handler=None)
+
+        yield self.http_client.fetch(self.get_url('/post/?page=1'))
+        expect(self._app.dumped).to_equal(4)
+
+
+class CoalescedReadsTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for('tests.test_models.VersionedProvider', Post, coalesce_reads=True),
+            bzz.ModelHive.routes_for('tests.test_models.VersionedProvider', PrivatePost, coalesce_reads=True),
+        ]))
+        application.dumped = 0
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        signals.post_get_instance.receivers = {}
+        super(CoalescedReadsTestCase, self).tearDown()
+
+    @testing.gen_test
+    def test_concurrent_reads_share_the_query_and_response(self):
+        responses = yield [self.http_client.fetch(self.get_url('/post/1')) for i in range(3)]
+
+        for response in responses:
+            expect(utils.loads(response.body)).to_equal({'id': '1'})
+        expect(self._app.loaded).to_equal(1)
+        expect(self._app.dumped).to_equal(1)
+
+        yield self.http_client.fetch(self.get_url('/post/1'))
+        expect(self._app.loaded).to_equal(2)
+
+    @testing.gen_test
+    def test_receivers_change_the_shared_response(self):
+        instances = []
+
+        @signals.post_get_instance.connect
+        def hide_id(sender, instance, handler):
+            instances.append(instance)
+            instance.id = 'hidden'
+
+        responses = yield [self.http_client.fetch(self.get_url('/post/1')) for i in range(3)]
+
+        for response in responses:
+            expect(utils.loads(response.body)).to_equal({'id': 'hidden'})
+        expect(instances).to_length(1)
+
+    @testing.gen_test
+    def test_reads_of_instances_filtered_per_request_are_not_coalesced(self):
+        yield [self.http_client.fetch(self.get_url('/private_post/1')) for i in range(3)]
+
+        expect(self._app.loaded).to_equal(3)
+
+    @testing.gen_test
+    def test_missing_instances_are_not_found(self):
+        err = expect.error_to_happen(HTTPError)
+        with err:
+            yield self.http_client.fetch(self.get_url('/post/missing'))
+
+        expect(err.error.code).to_equal(404)
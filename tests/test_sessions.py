@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import os
+import time
+import tempfile
+
+from mock import patch
+from preggy import expect
+
+import bzz.sessions as sessions
+import tests.base as base
+
+
+class FakeRedis(object):
+    '''Stand-in for a redis client, implementing only what the store uses.'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, 0))
+        if expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value.encode('utf-8'), time.time() + ex)
+
+    def expire(self, key, seconds):
+        if key in self.data:
+            self.data[key] = (self.data[key][0], time.time() + seconds)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class SessionStoreTestCase(object):
+    def get_store(self):
+        raise NotImplementedError()
+
+    def test_can_create_and_get_session(self):
+        store = self.get_store()
+        session_id = store.create({'sub': 'user', 'data': {'id': 'user'}}, 60)
+
+        expect(store.get(session_id)).to_equal({'sub': 'user', 'data': {'id': 'user'}})
+
+    def test_sessions_expire(self):
+        store = self.get_store()
+        session_id = store.create({'sub': 'user'}, -1)
+
+        expect(store.get(session_id)).to_be_null()
+
+    def test_can_touch_session(self):
+        store = self.get_store()
+        session_id = store.create({'sub': 'user'}, -1)
+        store.touch(session_id, 60)
+
+        expect(store.get(session_id)).to_equal({'sub': 'user'})
+
+    def test_can_delete_session(self):
+        store = self.get_store()
+        session_id = store.create({'sub': 'user'}, 60)
+        store.delete(session_id)
+
+        expect(store.get(session_id)).to_be_null()
+
+    def test_unknown_sessions_are_not_found(self):
+        store = self.get_store()
+
+        expect(store.get('invalid')).to_be_null()
+        expect(store.get(None)).to_be_null()
+
+
+class MemorySessionStoreTestCase(SessionStoreTestCase, base.TestCase):
+    def get_store(self):
+        return sessions.MemorySessionStore()
+
+    def test_can_touch_session(self):
+        # expired sessions are dropped from memory as soon as they're read
+        store = self.get_store()
+        session_id = store.create({'sub': 'user'}, 60)
+        store.touch(session_id, 120)
+
+        expect(store.get(session_id)).to_equal({'sub': 'user'})
+
+
+class SQLiteSessionStoreTestCase(SessionStoreTestCase, base.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def get_store(self):
+        return sessions.SQLiteSessionStore(self.path)
+
+    def test_sessions_are_shared_between_stores(self):
+        session_id = self.get_store().create({'sub': 'user'}, 60)
+
+        expect(self.get_store().get(session_id)).to_equal({'sub': 'user'})
+
+    def test_expired_sessions_are_purged(self):
+        store = sessions.SQLiteSessionStore(self.path, purge_every=2)
+        store.create({'sub': 'user'}, -1)
+        store.create({'sub': 'user'}, 60)
+
+        count = store.connection.execute('SELECT COUNT(*) FROM bzz_sessions').fetchone()[0]
+        expect(count).to_equal(1)
+
+    def test_each_process_opens_its_own_connection(self):
+        store = self.get_store()
+        session_id = store.create({'sub': 'user'}, 60)
+        connection = store.connection
+
+        with patch('bzz.sessions.os.getpid', return_value=os.getpid() + 1):
+            expect(store.connection).not_to_equal(connection)
+            expect(store.get(session_id)).to_equal({'sub': 'user'})
+
+
+class RedisSessionStoreTestCase(SessionStoreTestCase, base.TestCase):
+    def get_store(self):
+        return sessions.RedisSessionStore(FakeRedis())
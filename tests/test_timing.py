@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+import socket
+
+from preggy import expect
+import tornado.web
+import tornado.testing as testing
+
+import bzz
+import bzz.model as model
+from bzz.timing import Timings, NULL_TIMINGS, Histogram, HistogramSink, StatsdSink
+import tests.base as base
+from tests.test_models import Post
+
+
+class TimingsTestCase(base.TestCase):
+    def test_durations_of_repeated_phases_add_up(self):
+        timings = Timings()
+        timings.add('signals', 0.001)
+        timings.add('get_list', 0.01)
+        timings.add('signals', 0.002)
+
+        expect(timings.get_spans()).to_equal([('signals', 0.003), ('get_list', 0.01)])
+        expect(timings.get_header()).to_equal('signals;dur=3.00, get_list;dur=10.00')
+
+    def test_spans_time_phases(self):
+        timings = Timings()
+        with timings.span('dump_list'):
+            pass
+
+        name, duration = timings.get_spans()[0]
+        expect(name).to_equal('dump_list')
+        expect(duration).to_be_greater_or_equal_to(0)
+
+    def test_null_timings_record_nothing(self):
+        with NULL_TIMINGS.span('dump_list'):
+            pass
+        NULL_TIMINGS.add('total', 1)
+
+        expect(NULL_TIMINGS.get_spans()).to_be_empty()
+
+
+class HistogramTestCase(base.TestCase):
+    def test_counts_values_in_buckets(self):
+        histogram = Histogram((0.1, 1))
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+
+        expect(histogram.get_stats()).to_equal({
+            'count': 4,
+            'sum': 2.65,
+            'buckets': [(0.1, 2), (1, 3), (None, 4)],
+        })
+
+    def test_sink_keeps_histograms_by_resource_method_and_phase(self):
+        sink = HistogramSink(buckets=(1,))
+        sink.record('user', 'GET', [('get_list', 0.5), ('total', 2)])
+        sink.record('user', 'GET', [('get_list', 0.5)])
+
+        stats = sink.get_stats()
+        expect(stats[('user', 'GET', 'get_list')]['buckets']).to_equal([(1, 2), (None, 2)])
+        expect(stats[('user', 'GET', 'total')]['count']).to_equal(1)
+
+
+class StatsdSinkTestCase(base.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_sends_the_timings_of_a_request_in_one_datagram(self):
+        sink = StatsdSink('127.0.0.1', self.server.getsockname()[1], prefix='api')
+        sink.record('user', 'GET', [('get_list', 0.0125), ('total', 0.02)])
+
+        message = self.server.recv(1024).decode('utf-8')
+        expect(message).to_equal('api.user.get.get_list:12.500|ms\napi.user.get.total:20.000|ms')
+        expect(sink.sent).to_equal(1)
+
+
+class ServerTimingTestCase(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        model.TREE_CACHE.clear()
+        self.sink = HistogramSink()
+        application = tornado.web.Application(bzz.flatten([
+            bzz.ModelHive.routes_for(
+                'tests.test_models.VersionedProvider', Post, server_timing=True, timing_sink=self.sink
+            ),
+        ]))
+        application.dumped = 0
+        return application
+
+    def tearDown(self):
+        model.TREE_CACHE.clear()
+        super(ServerTimingTestCase, self).tearDown()
+
+    def get_phases(self, response):
+        return [span.split(';')[0] for span in response.headers['Server-Timing'].split(', ')]
+
+    @testing.gen_test
+    def test_responses_have_the_timings_of_each_phase(self):
+        response = yield self.http_client.fetch(self.get_url('/post/'))
+        expect(self.get_phases(response)).to_equal([
+            'parse_arguments', 'signals', 'get_list', 'dump_list', 'write_json', 'total'
+        ])
+
+        response = yield self.http_client.fetch(self.get_url('/post/1'))
+        expect(self.get_phases(response)).to_equal([
+            'parse_arguments', 'signals', 'get_instance', 'dump_instance', 'write_json', 'total'
+        ])
+
+    @testing.gen_test
+    def test_timings_are_recorded_in_the_sink(self):
+        yield self.http_client.fetch(self.get_url('/post/'))
+        yield self.http_client.fetch(self.get_url('/post/'))
+
+        stats = self.sink.get_stats()
+        expect(stats[('post', 'GET', 'get_list')]['count']).to_equal(2)
+        expect(stats[('post', 'GET', 'total')]['count']).to_equal(2)
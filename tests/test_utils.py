@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of bzz.
+# https://github.com/heynemann/bzz
+
+# Licensed under the MIT license:
+# http://www.opensource.org/licenses/MIT-license
+# Copyright (c) 2014 Bernardo Heynemann heynemann@gmail.com
+
+from decimal import Decimal
+from datetime import datetime
+
+import jwt
+from preggy import expect
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+import bzz.utils as utils
+import tests.base as base
+
+
+def generate_rsa_pem():
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+
+def generate_ec_pem():
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+
+def public_pem(private_pem):
+    key = serialization.load_pem_private_key(private_pem, None, default_backend())
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+
+class JwtTestCase(base.TestCase):
+    def test_decode_is_pinned_to_configured_algorithm(self):
+        tokenizer = utils.Jwt('SECRET')
+        token = jwt.encode({'sub': 'user'}, 'SECRET', 'HS256')
+
+        expect(tokenizer.try_to_decode(token)).to_equal((False, None))
+
+    def test_can_encode_and_decode(self):
+        tokenizer = utils.Jwt('SECRET')
+        token = tokenizer.encode({'sub': 'user'})
+
+        expect(tokenizer.try_to_decode(token)).to_equal((True, {'sub': 'user'}))
+
+
+class KeySetJwtTestCase(base.TestCase):
+    def setUp(self):
+        self.rsa_pem = generate_rsa_pem()
+        self.ec_pem = generate_ec_pem()
+
+    def test_can_sign_and_verify_with_rsa_and_ec_keys(self):
+        for algo, pem in (('RS256', self.rsa_pem), ('ES256', self.ec_pem)):
+            tokenizer = utils.KeySetJwt([
+                utils.JwtKey('key-1', algo, private_key=pem)
+            ])
+            token = tokenizer.encode({'sub': 'user'})
+
+            expect(jwt.get_unverified_header(token)['kid']).to_equal('key-1')
+            expect(tokenizer.decode(token)).to_equal({'sub': 'user'})
+
+    def test_verifying_node_needs_only_public_keys(self):
+        signer = utils.KeySetJwt([
+            utils.JwtKey('key-1', 'RS256', private_key=self.rsa_pem)
+        ])
+        verifier = utils.KeySetJwt([
+            utils.JwtKey('key-1', 'RS256', public_key=public_pem(self.rsa_pem))
+        ])
+
+        expect(verifier.can_sign).to_be_false()
+        expect(verifier.decode(signer.encode({'sub': 'user'}))).to_equal({'sub': 'user'})
+
+        with expect.error_to_happen(ValueError):
+            verifier.encode({'sub': 'user'})
+
+    def test_can_rotate_signing_keys(self):
+        old_key = utils.JwtKey('old', 'RS256', private_key=self.rsa_pem)
+        new_key = utils.JwtKey('new', 'ES256', private_key=self.ec_pem)
+        tokenizer = utils.KeySetJwt([old_key, new_key], signing_key_id='old')
+        old_token = tokenizer.encode({'sub': 'old'})
+
+        tokenizer.set_signing_key('new')
+        new_token = tokenizer.encode({'sub': 'new'})
+
+        expect(jwt.get_unverified_header(new_token)['kid']).to_equal('new')
+        expect(tokenizer.decode(old_token)).to_equal({'sub': 'old'})
+        expect(tokenizer.decode(new_token)).to_equal({'sub': 'new'})
+
+        tokenizer.remove_key('old')
+        expect(tokenizer.try_to_decode(old_token)).to_equal((False, None))
+
+    def test_cant_decode_tokens_with_unknown_key_id(self):
+        signer = utils.KeySetJwt([
+            utils.JwtKey('other', 'RS256', private_key=self.rsa_pem)
+        ])
+        tokenizer = utils.KeySetJwt([
+            utils.JwtKey('key-1', 'RS256', private_key=self.rsa_pem)
+        ])
+
+        expect(tokenizer.try_to_decode(signer.encode({'sub': 'user'}))).to_equal((False, None))
+
+    def test_cant_create_key_with_unsupported_algorithm(self):
+        with expect.error_to_happen(ValueError):
+            utils.JwtKey('key-1', 'XX256', private_key=self.rsa_pem)
+
+
+class ParseFormTestCase(base.TestCase):
+    def test_can_parse_urlencoded_body(self):
+        data = utils.parse_form(b'name=Bernardo+Heynemann&email=heynemann%40gmail.com')
+
+        expect(data).to_equal({'name': 'Bernardo Heynemann', 'email': 'heynemann@gmail.com'})
+
+    def test_values_can_contain_equal_signs(self):
+        expect(utils.parse_form(b'query=a=b&other=%3D')).to_equal({'query': 'a=b', 'other': '='})
+
+    def test_list_keys_and_repeated_keys_hold_lists(self):
+        data = utils.parse_form(b'members[]=a&name=x&name=y&users%5B%5D=b')
+
+        expect(data).to_equal({'members[]': ['a'], 'name': ['x', 'y'], 'users[]': ['b']})
+
+    def test_items_without_value_are_stored_as_item(self):
+        expect(utils.parse_form(b'value&')).to_equal({'item': 'value'})
+
+    def test_decodes_utf8(self):
+        expect(utils.parse_form(b'name=Jos%C3%A9')).to_equal({'name': u'Jos\xe9'})
+
+
+class CoercionTestCase(base.TestCase):
+    def test_can_parse_booleans(self):
+        expect(utils.parse_bool('true')).to_be_true()
+        expect(utils.parse_bool('0')).to_be_false()
+        expect(utils.parse_bool(True)).to_be_true()
+
+        with expect.error_to_happen(ValueError):
+            utils.parse_bool('maybe')
+
+    def test_can_parse_datetimes(self):
+        expected = datetime(2014, 11, 30, 10, 20, 30)
+
+        expect(utils.parse_datetime('2014-11-30T10:20:30Z')).to_equal(expected)
+        expect(utils.parse_datetime('2014-11-30 10:20:30')).to_equal(expected)
+        expect(utils.parse_datetime(utils.default(expected))).to_equal(expected)
+        expect(utils.parse_datetime(str(utils.default(expected)))).to_equal(expected)
+
+        with expect.error_to_happen(ValueError):
+            utils.parse_datetime('yesterday')
+
+    def test_can_parse_decimals(self):
+        expect(utils.parse_decimal('10.50')).to_equal(Decimal('10.50'))
+
+        with expect.error_to_happen(ValueError):
+            utils.parse_decimal('abc')